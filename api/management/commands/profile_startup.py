@@ -0,0 +1,242 @@
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+from collections import defaultdict
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+# runs in a fresh interpreter under -X importtime, prints one JSON line
+CHILD = r'''
+import json, sys, time
+
+start = time.perf_counter()
+ms = lambda since: round((time.perf_counter() - since) * 1000, 3)
+
+from django.apps.config import AppConfig
+
+ready_ms = {}
+_create = AppConfig.create.__func__
+
+def create(cls, entry):
+    config = _create(cls, entry)
+    ready = config.ready
+
+    def timed_ready():
+        began = time.perf_counter()
+        try:
+            ready()
+        finally:
+            ready_ms[config.label] = ms(began)
+
+    config.ready = timed_ready
+    return config
+
+AppConfig.create = classmethod(create)
+
+entry, path = sys.argv[1:3]
+if entry == 'wsgi':
+    import io
+    from ecommerce.wsgi import application
+    setup_ms = ms(start)
+
+    began = time.perf_counter()
+    statuses = []
+    environ = {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '', 'SCRIPT_NAME': '',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'localhost', 'REMOTE_ADDR': '127.0.0.1',
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(),
+        'wsgi.errors': sys.stderr, 'wsgi.multithread': False, 'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    response = application(environ, lambda status, headers, exc_info=None: statuses.append(status))
+    b''.join(response)
+    response.close()
+    status = int(statuses[0].split()[0])
+else:
+    import asyncio
+    from ecommerce.asgi import application
+    setup_ms = ms(start)
+
+    began = time.perf_counter()
+    messages = []
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'GET',
+        'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': b'',
+        'root_path': '', 'headers': [(b'host', b'localhost')],
+        'client': ('127.0.0.1', 0), 'server': ('localhost', 80),
+    }
+
+    async def serve():
+        done = asyncio.Event()
+        requests = [{'type': 'http.request', 'body': b'', 'more_body': False}]
+
+        async def receive():
+            if requests:
+                return requests.pop()
+            await done.wait()
+            return {'type': 'http.disconnect'}
+
+        async def send(message):
+            messages.append(message)
+            if message['type'] == 'http.response.body' and not message.get('more_body'):
+                done.set()
+
+        await application(scope, receive, send)
+
+    asyncio.run(serve())
+    status = next(m['status'] for m in messages if m['type'] == 'http.response.start')
+
+print(json.dumps({
+    'setup_ms': setup_ms,
+    'first_request_ms': ms(began),
+    'total_ms': ms(start),
+    'status': status,
+    'ready_ms': ready_ms,
+}))
+'''
+
+
+def parse_importtime(stderr):
+    '''
+    {module: (self_us, cumulative_us)} from python -X importtime output
+    '''
+    modules = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return modules
+
+
+class Command(BaseCommand):
+    '''
+    Measures how long a worker takes to boot and serve its first request
+
+    Each run starts a fresh interpreter with -X importtime for the WSGI and
+    the ASGI entry point, times django.setup() with every AppConfig.ready(),
+    then sends one GET to --path through the application object. Timings
+    are the median over --runs. Write the JSON report with --output and
+    check it against the previous release with --compare:
+
+        python manage.py profile_startup --output startup.json
+        python manage.py profile_startup --compare startup.json
+    '''
+    help = 'Profile import time, app ready() cost and time to first request'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--entry', choices=['wsgi', 'asgi', 'both'], default='both')
+        parser.add_argument('--path', default='/api/csrf-token/', help='path of the first request')
+        parser.add_argument('--runs', type=int, default=3, help='fresh interpreters per entry point')
+        parser.add_argument('--top', type=int, default=20, help='slowest modules to list')
+        parser.add_argument('--output', help='write the JSON report to this file')
+        parser.add_argument('--compare', help='previous JSON report to show the change against')
+
+    def handle(self, *args, **options):
+        previous = None
+        if options['compare']:
+            try:
+                with open(options['compare']) as f:
+                    previous = json.load(f)
+            except (OSError, ValueError) as e:
+                raise CommandError(f"can not read {options['compare']}: {e}")
+
+        entries = ['wsgi', 'asgi'] if options['entry'] == 'both' else [options['entry']]
+        report = {
+            'generated_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'settings': settings.SETTINGS_MODULE,
+            'path': options['path'],
+            'runs': options['runs'],
+            'entries': {entry: self.profile(entry, options) for entry in entries},
+        }
+
+        for entry, result in report['entries'].items():
+            self.print_entry(entry, result, (previous or {}).get('entries', {}).get(entry))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"report written to {options['output']}")
+
+    def run_child(self, entry, path):
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        completed = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', CHILD, entry, path],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, timeout=300,
+        )
+        if completed.returncode != 0:
+            raise CommandError(f'{entry} start up failed:\n{completed.stderr[-2000:]}')
+        return json.loads(completed.stdout.strip().splitlines()[-1]), parse_importtime(completed.stderr)
+
+    def profile(self, entry, options):
+        runs = [self.run_child(entry, options['path']) for _ in range(options['runs'])]
+        median = lambda values: round(statistics.median(values), 3)
+
+        modules = defaultdict(lambda: ([], []))
+        for _, imports in runs:
+            for name, (self_us, cumulative_us) in imports.items():
+                modules[name][0].append(self_us)
+                modules[name][1].append(cumulative_us)
+        imports = {
+            name: (median(self_us) / 1000, median(cumulative_us) / 1000)
+            for name, (self_us, cumulative_us) in modules.items()
+        }
+
+        # self time summed per top level package: which SDK costs what
+        packages = defaultdict(float)
+        for name, (self_ms, _) in imports.items():
+            packages[name.split('.')[0]] += self_ms
+
+        labels = {label for result, _ in runs for label in result['ready_ms']}
+        return {
+            'status': runs[-1][0]['status'],
+            'total_ms': median([result['total_ms'] for result, _ in runs]),
+            'setup_ms': median([result['setup_ms'] for result, _ in runs]),
+            'first_request_ms': median([result['first_request_ms'] for result, _ in runs]),
+            'ready_ms': {
+                label: median([result['ready_ms'].get(label, 0) for result, _ in runs])
+                for label in sorted(labels)
+            },
+            'imports': {
+                'total_ms': round(sum(self_ms for self_ms, _ in imports.values()), 3),
+                'modules': len(imports),
+                'slowest': [
+                    {'module': name, 'cumulative_ms': round(cumulative_ms, 3), 'self_ms': round(self_ms, 3)}
+                    for name, (self_ms, cumulative_ms) in
+                    sorted(imports.items(), key=lambda item: -item[1][1])[:options['top']]
+                ],
+                'packages': [
+                    {'package': name, 'self_ms': round(self_ms, 3)}
+                    for name, self_ms in sorted(packages.items(), key=lambda item: -item[1])[:options['top']]
+                ],
+            },
+        }
+
+    def print_entry(self, entry, result, previous):
+        def change(key):
+            if not previous or key not in previous:
+                return ''
+            return f' ({result[key] - previous[key]:+.1f} ms)'
+
+        self.stdout.write(self.style.MIGRATE_HEADING(f"{entry.upper()} (first request: {result['status']})"))
+        for key, label in [('total_ms', 'total'), ('setup_ms', 'import + setup'), ('first_request_ms', 'first request')]:
+            self.stdout.write(f'  {label:<16}{result[key]:>10.1f} ms{change(key)}')
+        self.stdout.write(f"  {'imports':<16}{result['imports']['total_ms']:>10.1f} ms  {result['imports']['modules']} modules")
+
+        self.stdout.write('  ready():')
+        for label, ready_ms in sorted(result['ready_ms'].items(), key=lambda item: -item[1]):
+            self.stdout.write(f'    {label:<24}{ready_ms:>8.1f} ms')
+
+        self.stdout.write('  packages by import time:')
+        for package in result['imports']['packages'][:10]:
+            self.stdout.write(f"    {package['package']:<24}{package['self_ms']:>8.1f} ms")
@@ -0,0 +1,146 @@
+'''
+Request metrics
+
+Per-endpoint histograms filled by api.middleware.RequestMetricsMiddleware
+and served by the metrics view (GET /api/metrics/, admins only):
+
+    queries      SQL queries per request
+    sql_us       time spent in SQL
+    serialize_us time spent in serializer.data (queries it runs included)
+    render_us    time spent rendering the response (DRF renderers, templates)
+    latency_us   whole request, every middleware included
+
+Histogram follows HdrHistogram: values below 2**SUB_BUCKET_BITS are
+counted exactly, above that each power of two is split into
+2**(SUB_BUCKET_BITS - 1) equal buckets, so any recorded value is off by less
+than 1/64 and a histogram is a small dict of bucket counts whatever the
+range. Counts live in this process only; each gunicorn worker reports its
+own, the pid is part of the snapshot.
+'''
+import os
+import threading
+import time
+from collections import defaultdict
+
+
+SUB_BUCKET_BITS = 7
+SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+SUB_BUCKET_HALF = SUB_BUCKET_COUNT >> 1
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def _index(value):
+    if value < SUB_BUCKET_COUNT:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS
+    return SUB_BUCKET_COUNT + (shift - 1) * SUB_BUCKET_HALF + (value >> shift) - SUB_BUCKET_HALF
+
+
+def _highest_equivalent(index):
+    '''
+    Largest value counted in bucket `index`
+    '''
+    if index < SUB_BUCKET_COUNT:
+        return index
+    shift, sub_bucket = divmod(index - SUB_BUCKET_COUNT, SUB_BUCKET_HALF)
+    shift += 1
+    return ((sub_bucket + SUB_BUCKET_HALF) << shift) + (1 << shift) - 1
+
+
+class Histogram:
+
+    def __init__(self):
+        self.counts = defaultdict(int)
+        self.total = 0
+        self.sum = 0
+        self.min = None
+        self.max = 0
+
+    def record(self, value):
+        value = max(int(value), 0)
+        self.counts[_index(value)] += 1
+        self.total += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.min = value if self.min is None else min(self.min, value)
+
+    def percentile(self, percentile):
+        if not self.total:
+            return 0
+        wanted = max(1, -(-self.total * percentile // 100))
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= wanted:
+                return min(_highest_equivalent(index), self.max)
+        return self.max
+
+    def summary(self, scale=1):
+        '''
+        count, mean, min, max and PERCENTILES, values divided by `scale`
+        '''
+        result = {
+            'count': self.total,
+            'mean': round(self.sum / self.total / scale, 3) if self.total else 0,
+            'min': round((self.min or 0) / scale, 3),
+            'max': round(self.max / scale, 3),
+        }
+        for percentile in PERCENTILES:
+            result[f'p{percentile:g}'] = round(self.percentile(percentile) / scale, 3)
+        return result
+
+
+class EndpointMetrics:
+
+    def __init__(self):
+        self.queries = Histogram()
+        self.sql_us = Histogram()
+        self.serialize_us = Histogram()
+        self.render_us = Histogram()
+        self.latency_us = Histogram()
+        self.over_budget = 0
+
+
+class Registry:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.endpoints = defaultdict(EndpointMetrics)
+            self.started_at = time.time()
+
+    def record(self, endpoint, queries, sql_us, serialize_us, render_us, latency_us, over_budget):
+        with self._lock:
+            metrics = self.endpoints[endpoint]
+            metrics.queries.record(queries)
+            metrics.sql_us.record(sql_us)
+            metrics.serialize_us.record(serialize_us)
+            metrics.render_us.record(render_us)
+            metrics.latency_us.record(latency_us)
+            metrics.over_budget += over_budget
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'pid': os.getpid(),
+                'since': self.started_at,
+                'endpoints': {
+                    endpoint: {
+                        'requests': metrics.latency_us.total,
+                        'over_query_budget': metrics.over_budget,
+                        'queries': metrics.queries.summary(),
+                        'sql_ms': metrics.sql_us.summary(1000),
+                        'serialize_ms': metrics.serialize_us.summary(1000),
+                        'render_ms': metrics.render_us.summary(1000),
+                        'latency_ms': metrics.latency_us.summary(1000),
+                    }
+                    for endpoint, metrics in sorted(self.endpoints.items())
+                },
+            }
+
+
+registry = Registry()
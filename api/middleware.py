@@ -0,0 +1,165 @@
+'''
+Request metrics middleware
+
+Samples settings.REQUEST_METRICS['SAMPLE_RATE'] of the requests. For a
+sampled request it counts and times every SQL query through a database
+execute_wrapper, times serializer.data, the response rendering and the
+whole request, and records them in api.metrics under the URL name (the
+route when the URL has no name). A request that is not sampled costs one
+random() call.
+
+Serializers are timed by wrapping the data property of DRF's Serializer
+and ListSerializer once per process (install_serializer_timer()). The
+wrapper only reads a context variable when no sampled request is running,
+and a serializer whose fields build other serializers is counted once.
+
+Sampled requests over their query budget (BUDGETS[url name], else
+QUERY_BUDGET) are logged as warnings and counted per endpoint.
+'''
+import contextvars
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from rest_framework import serializers
+
+from .metrics import registry
+
+
+logger = logging.getLogger(__name__)
+
+
+def metrics_config():
+    config = getattr(settings, 'REQUEST_METRICS', {})
+    return {
+        'ENABLED': config.get('ENABLED', True),
+        'SAMPLE_RATE': config.get('SAMPLE_RATE', 0.05),
+        'QUERY_BUDGET': config.get('QUERY_BUDGET', 25),
+        'BUDGETS': config.get('BUDGETS', {}),
+    }
+
+
+class QueryCounter:
+    '''
+    connection.execute_wrapper() callable: counts queries and sums their time
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.elapsed = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.elapsed += time.perf_counter() - start
+            self.count += 1
+
+
+class SerializeTimer:
+    '''
+    Time spent in the outermost serializer.data calls of one request
+    '''
+
+    def __init__(self):
+        self.elapsed = 0.0
+        self.depth = 0
+
+
+_serialize_timer = contextvars.ContextVar('request_metrics_serialize_timer', default=None)
+
+
+def _timed_data(data):
+    def fget(serializer):
+        timer = _serialize_timer.get()
+        # nested .data calls (a SerializerMethodField building a serializer) are part of the outer one
+        if timer is None or timer.depth:
+            return data.fget(serializer)
+        timer.depth += 1
+        start = time.perf_counter()
+        try:
+            return data.fget(serializer)
+        finally:
+            timer.elapsed += time.perf_counter() - start
+            timer.depth -= 1
+
+    fget.timed = True
+    return property(fget, doc=data.__doc__)
+
+
+def install_serializer_timer():
+    for cls in (serializers.Serializer, serializers.ListSerializer):
+        if not getattr(cls.data.fget, 'timed', False):
+            cls.data = _timed_data(cls.data)
+
+
+def endpoint_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unresolved>'
+    # unnamed routes would otherwise show up as the dotted path of their view
+    return match.view_name if match.url_name else match.route
+
+
+class RequestMetricsMiddleware:
+
+    def __init__(self, get_response):
+        config = metrics_config()
+        if not config['ENABLED'] or config['SAMPLE_RATE'] <= 0:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.sample_rate = config['SAMPLE_RATE']
+        self.query_budget = config['QUERY_BUDGET']
+        self.budgets = config['BUDGETS']
+        install_serializer_timer()
+
+    def __call__(self, request):
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+
+        start = time.perf_counter()
+        counter = QueryCounter()
+        timer = SerializeTimer()
+        request._metrics_render = [0.0]
+        token = _serialize_timer.set(timer)
+        try:
+            with connection.execute_wrapper(counter):
+                response = self.get_response(request)
+        finally:
+            _serialize_timer.reset(token)
+        latency = time.perf_counter() - start
+
+        endpoint = endpoint_name(request)
+        budget = self.budgets.get(endpoint, self.query_budget)
+        over_budget = budget is not None and counter.count > budget
+        if over_budget:
+            logger.warning(f'{request.method} {request.path} ({endpoint}) ran {counter.count} queries, '
+                           f'budget is {budget}')
+
+        registry.record(
+            endpoint,
+            queries=counter.count,
+            sql_us=counter.elapsed * 1e6,
+            serialize_us=timer.elapsed * 1e6,
+            render_us=request._metrics_render[0] * 1e6,
+            latency_us=latency * 1e6,
+            over_budget=over_budget,
+        )
+        return response
+
+    def process_template_response(self, request, response):
+        # DRF Response is a template response, the handler renders it right after
+        # this hook (the last one to run, this middleware comes first in MIDDLEWARE)
+        timings = getattr(request, '_metrics_render', None)
+        if timings is not None:
+            start = time.perf_counter()
+
+            def rendered(response):
+                timings[0] += time.perf_counter() - start
+
+            response.add_post_render_callback(rendered)
+        return response
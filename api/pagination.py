@@ -1,12 +1,127 @@
-from rest_framework.pagination import LimitOffsetPagination,CursorPagination,PageNumberPagination
+from rest_framework.pagination import LimitOffsetPagination,CursorPagination,PageNumberPagination,BasePagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param,remove_query_param
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import FieldDoesNotExist,ValidationError
+from django.core.paginator import Paginator,EmptyPage
+from django.db import connections
+from django.db.models import Q,QuerySet
+from django.utils.functional import cached_property
+from bisect import bisect_left,bisect_right
+import base64
+import hashlib
+import json
+
+
+class CachedCountPaginator(Paginator):
+    '''
+    Paginator that avoids running COUNT(*) on every request
+
+    The total is served, in order of preference, from:
+      1. the cache, keyed by the query sql (at most STALE_AFTER seconds old)
+      2. postgres table statistics (pg_class.reltuples) for unfiltered
+         querysets on tables larger than ESTIMATE_ABOVE rows
+      3. an exact COUNT(*), which is then cached
+
+    exact=True always counts. Pages are sliced without clipping to the
+    count and a page past an estimated end re-counts before giving up, so a
+    stale total never hides rows.
+    '''
+
+    def __init__(self,object_list,per_page,exact=False,**kwargs):
+        super().__init__(object_list,per_page,**kwargs)
+        self.exact=exact
+        self.count_is_exact=True
+
+    @staticmethod
+    def config():
+        return getattr(settings,'PAGINATION_COUNT',{})
+
+    def _cache_key(self):
+        sql,params=self.object_list.query.sql_with_params()
+        digest=hashlib.md5(f'{sql}|{params!r}'.encode()).hexdigest()
+        return f'pagination_count:{digest}'
+
+    def _estimate(self):
+        queryset=self.object_list
+        connection=connections[queryset.db]
+        if connection.vendor!='postgresql' or queryset.query.where or queryset.query.distinct:
+            return None
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                           [queryset.model._meta.db_table])
+            row=cursor.fetchone()
+        estimate=row[0] if row else None
+        if estimate is None or estimate<self.config().get('ESTIMATE_ABOVE',100000):
+            return None
+        return estimate
+
+    @cached_property
+    def count(self):
+        if self.exact or not isinstance(self.object_list,QuerySet):
+            return super().count
+
+        config=self.config()
+        cache=caches[config.get('CACHE_ALIAS','default')]
+        key=self._cache_key()
+
+        total=cache.get(key)
+        if total is not None:
+            self.count_is_exact=False
+            return total
+
+        total=self._estimate()
+        if total is None:
+            # counted just now, exact for this response
+            total=self.object_list.count()
+        else:
+            self.count_is_exact=False
+        cache.set(key,total,config.get('STALE_AFTER',60))
+        return total
+
+    def validate_number(self,number):
+        try:
+            return super().validate_number(number)
+        except EmptyPage:
+            if self.count_is_exact:
+                raise
+            # the cached total may be behind, count for real before giving up
+            self.__dict__['count']=self.object_list.count()
+            self.__dict__.pop('num_pages',None)
+            self.count_is_exact=True
+            return super().validate_number(number)
+
+    def page(self,number):
+        number=self.validate_number(number)
+        bottom=(number-1)*self.per_page
+        return self._get_page(self.object_list[bottom:bottom+self.per_page],number,self)
 
 
 class StandardPagination(PageNumberPagination):
     '''
     use for handling pagination for apiview
+
+    counts come from CachedCountPaginator, pass ?exact_count=1 for an exact total
     '''
     page_size=5
     max_page_size=20
+    exact_count_query_param='exact_count'
+
+    def paginate_queryset(self,queryset,request,view=None):
+        self.exact_count=request.query_params.get(self.exact_count_query_param) in ('1','true')
+        return super().paginate_queryset(queryset,request,view)
+
+    def django_paginator_class(self,object_list,per_page):
+        # DRF calls self.django_paginator_class(queryset, page_size), a method lets us pass the flag
+        return CachedCountPaginator(object_list,per_page,exact=self.exact_count)
+
+    def get_paginated_response(self,data):
+        response=super().get_paginated_response(data)
+        response.data['count_exact']=self.page.paginator.count_is_exact
+        return response
 
 class StandardLimitOffset(LimitOffsetPagination):
     default_limit = 20
@@ -20,4 +135,215 @@ class ProductCursorPagination(CursorPagination):
     '''
     page_size = 3
     ordering = '-created_at'  # required — must specify ordering
-    
\ No newline at end of file
+
+
+class KeysetPagination(BasePagination):
+    '''
+    Keyset (seek) pagination with opaque cursors
+
+    A page is fetched with WHERE (sort key) > (key of the last row seen)
+    instead of OFFSET, and no COUNT(*) is issued, so page 10,000 costs the
+    same as page 1. Every ordering ends in a unique field so each row has
+    exactly one position and pages stay stable while rows are inserted.
+
+    Cursors are base64 json holding the ordering, the boundary key and the
+    direction. Works on querysets (paginate_queryset) and on id lists that
+    are already sorted by a key function (paginate_list).
+    '''
+    page_size=5
+    cursor_query_param='cursor'
+    ordering_query_param='ordering'
+    mode_query_param='pagination'
+
+    # name -> order_by fields, the last field must be unique
+    orderings={}
+    default_ordering=None
+
+    invalid_cursor_message='Invalid cursor'
+
+    @classmethod
+    def requested(cls,request):
+        '''
+        True when the client opted into keyset mode (?pagination=cursor or a cursor)
+        '''
+        params=request.query_params
+        return params.get(cls.mode_query_param)=='cursor' or cls.cursor_query_param in params
+
+    def encode_cursor(self,ordering,key,reverse=False):
+        raw=json.dumps({'o':ordering,'k':list(key),'r':int(reverse)},default=str,separators=(',',':'))
+        return base64.urlsafe_b64encode(raw.encode()).decode()
+
+    def decode_cursor(self,request):
+        encoded=request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            data=json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            if not isinstance(data['o'],str) or not isinstance(data['k'],list) or not data['k']:
+                raise ValueError('malformed cursor')
+            return data['o'],tuple(data['k']),bool(data['r'])
+        except (TypeError,ValueError,KeyError,UnicodeDecodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def parse_key(self,key,fields,model):
+        '''
+        Cursor key converted field by field to the python values of the ordering fields
+
+        a cursor is client input: wrong length or values the fields can not
+        hold are an invalid cursor, not a database error
+        '''
+        if len(key)!=len(fields):
+            raise NotFound(self.invalid_cursor_message)
+        try:
+            return tuple(
+                model._meta.get_field(field.lstrip('-')).to_python(value)
+                for field,value in zip(fields,key)
+            )
+        except (TypeError,ValueError,ValidationError,FieldDoesNotExist):
+            raise NotFound(self.invalid_cursor_message)
+
+    def check_list_key(self,key,sample):
+        '''
+        Rejects a cursor key that can not be compared with the live keys (sample is one of them)
+        '''
+        if len(key)!=len(sample):
+            raise NotFound(self.invalid_cursor_message)
+        for value,live in zip(key,sample):
+            number=isinstance(value,(int,float)) and not isinstance(value,bool)
+            if number!=(isinstance(live,(int,float)) and not isinstance(live,bool)) \
+                    or (not number and type(value) is not type(live)):
+                raise NotFound(self.invalid_cursor_message)
+        return key
+
+    def get_ordering_name(self,request,cursor):
+        if cursor is not None:
+            name=cursor[0]
+        else:
+            name=request.query_params.get(self.ordering_query_param,self.default_ordering)
+        if name not in self.orderings:
+            if cursor is not None:
+                raise NotFound(self.invalid_cursor_message)
+            name=self.default_ordering
+        return name
+
+    def _keyset_filter(self,fields,key,reverse):
+        # (a,b) > (x,y)  ==  a > x OR (a = x AND b > y), flipped per descending field
+        if len(key)!=len(fields):
+            raise NotFound(self.invalid_cursor_message)
+        condition=Q()
+        equal=Q()
+        for field,value in zip(fields,key):
+            name=field.lstrip('-')
+            descending=field.startswith('-')
+            lookup='lt' if descending!=reverse else 'gt'
+            condition|=equal & Q(**{f'{name}__{lookup}':value})
+            equal&=Q(**{name:value})
+
+        # redundant bound on the leading column so the planner can seek the index
+        # instead of filtering the OR row by row
+        name=fields[0].lstrip('-')
+        lookup='lte' if fields[0].startswith('-')!=reverse else 'gte'
+        return Q(**{f'{name}__{lookup}':key[0]}) & condition
+
+    def paginate_queryset(self,queryset,request,view=None):
+        self.request=request
+        cursor=self.decode_cursor(request)
+        self.ordering=self.get_ordering_name(request,cursor)
+        fields=self.orderings[self.ordering]
+        reverse=bool(cursor and cursor[2])
+
+        if reverse:
+            queryset=queryset.order_by(*[f[1:] if f.startswith('-') else f'-{f}' for f in fields])
+        else:
+            queryset=queryset.order_by(*fields)
+        if cursor is not None:
+            key=self.parse_key(cursor[1],fields,queryset.model)
+            queryset=queryset.filter(self._keyset_filter(fields,key,reverse))
+
+        # one extra row tells us whether there is another page, no COUNT needed
+        rows=list(queryset[:self.page_size+1])
+        has_more=len(rows)>self.page_size
+        rows=rows[:self.page_size]
+        if reverse:
+            rows.reverse()
+
+        def key(obj):
+            return tuple(getattr(obj,f.lstrip('-')) for f in fields)
+
+        self._set_links(rows,key,cursor,reverse,has_more)
+        return rows
+
+    def paginate_list(self,ids,key,request,ordering):
+        '''
+        Keyset pagination over ids already sorted ascending by key(id)
+
+        key must return json-native values (ints, floats, strings) so a
+        decoded cursor compares equal to the live key.
+        '''
+        self.request=request
+        self.ordering=ordering
+        cursor=self.decode_cursor(request)
+        if cursor is not None and cursor[0]!=ordering:
+            raise NotFound(self.invalid_cursor_message)
+        reverse=bool(cursor and cursor[2])
+
+        keys=[key(pid) for pid in ids]
+        if cursor is not None and keys:
+            self.check_list_key(cursor[1],keys[0])
+        if cursor is None:
+            start,end=0,min(self.page_size,len(ids))
+        elif reverse:
+            end=bisect_left(keys,cursor[1])
+            start=max(0,end-self.page_size)
+        else:
+            start=bisect_right(keys,cursor[1])
+            end=min(start+self.page_size,len(ids))
+
+        self.next_cursor=self.encode_cursor(ordering,keys[end-1]) if end<len(ids) and end>start else None
+        self.previous_cursor=self.encode_cursor(ordering,keys[start],reverse=True) if start>0 and end>start else None
+        return ids[start:end]
+
+    def _set_links(self,rows,key,cursor,reverse,has_more):
+        self.next_cursor=self.previous_cursor=None
+        if not rows:
+            return
+        has_next=has_more if not reverse else True
+        has_previous=has_more if reverse else cursor is not None
+        if has_next:
+            self.next_cursor=self.encode_cursor(self.ordering,key(rows[-1]))
+        if has_previous:
+            self.previous_cursor=self.encode_cursor(self.ordering,key(rows[0]),reverse=True)
+
+    def _link(self,cursor):
+        if cursor is None:
+            return None
+        url=self.request.build_absolute_uri()
+        url=remove_query_param(url,'page')
+        return replace_query_param(url,self.cursor_query_param,cursor)
+
+    def get_next_link(self):
+        return self._link(self.next_cursor)
+
+    def get_previous_link(self):
+        return self._link(self.previous_cursor)
+
+    def get_paginated_response(self,data):
+        return Response({
+            'next':self.get_next_link(),
+            'previous':self.get_previous_link(),
+            'results':data,
+        })
+
+
+class CatalogKeysetPagination(KeysetPagination):
+    '''
+    Keyset orderings for product listings, backed by the
+    (created_at, id) and (base_price, id) indexes on Product
+    '''
+    orderings={
+        '-created_at':('-created_at','-id'),
+        'created_at':('created_at','id'),
+        'price':('base_price','id'),
+        '-price':('-base_price','-id'),
+    }
+    default_ordering='-created_at'
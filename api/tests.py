@@ -1,3 +1,106 @@
-from django.test import TestCase
+import base64
+import json
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import TestCase,override_settings
+
+from api.models import User
+from inventory.models import Seller
+from user import models as user_models
+from user.cache import get_product_cache
+from user.search import price_index,search_index
+
+
+LOCMEM_CACHES={'default':{'BACKEND':'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def cursor(ordering,key,reverse=False):
+    raw=json.dumps({'o':ordering,'k':key,'r':int(reverse)})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TamperedCursorTest(TestCase):
+    '''
+    KeysetPagination answers 404 to cursors a client edited, never 500
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        seller_user=User.objects.create_user('seller','seller@example.com','pw',role_model='seller')
+        seller=Seller.objects.create(user=seller_user,business_name='seller',gst_number='GST1')
+        category=user_models.Category.objects.create(name='phones')
+        brand=user_models.Brand.objects.create(name='samsung')
+        for i in range(8):
+            user_models.Product.objects.create(seller=seller,name=f'galaxy phone {i}',base_price=100+i,
+                                               category=category,brand=brand,sku=f'P{i}')
+
+    def setUp(self):
+        search_index.rebuild()
+        price_index.rebuild()
+
+    def assertInvalid(self,url):
+        response=self.client.get(url)
+        self.assertEqual(response.status_code,404,url)
+
+    def test_valid_cursors_still_page(self):
+        first=self.client.get('/user/products/?pagination=cursor').json()
+        second=self.client.get(first['next']).json()
+        self.assertEqual(len(second['results']),3)
+
+        first=self.client.get('/user/product/search/?sort=price&pagination=cursor').json()
+        second=self.client.get(first['next']).json()
+        self.assertEqual(len(second['results']),3)
+
+    def test_queryset_cursor_with_wrong_types(self):
+        self.assertInvalid(f"/user/products/?cursor={cursor('-created_at',['foo',1])}")
+        self.assertInvalid(f"/user/products/?cursor={cursor('price',['cheap',1])}")
+        self.assertInvalid(f"/user/products/?cursor={cursor('price',[100,'x'])}")
+        self.assertInvalid(f"/user/products/?cursor={cursor('price',[[1],1])}")
+
+    def test_queryset_cursor_with_wrong_length(self):
+        self.assertInvalid(f"/user/products/?cursor={cursor('price',[100])}")
+        self.assertInvalid(f"/user/products/?cursor={cursor('price',[100,1,2])}")
+        self.assertInvalid(f"/user/products/?cursor={cursor('price',[])}")
+
+    def test_list_cursor_with_wrong_types(self):
+        self.assertInvalid(f"/user/product/search/?sort=price&cursor={cursor('price',['a'])}")
+        self.assertInvalid(f"/user/product/search/?sort=price&cursor={cursor('price',['a',1])}")
+        self.assertInvalid(f"/user/product/search/?sort=price&cursor={cursor('price',[100.0,None])}")
+        self.assertInvalid(f"/user/product/search/?n=galaxy&cursor={cursor('relevance',[True,1])}")
+        self.assertInvalid(f"/user/product/search/?cursor={cursor('id',[1,2])}")
+
+    def test_malformed_cursor(self):
+        self.assertInvalid('/user/products/?cursor=garbage')
+        self.assertInvalid(f"/user/products/?cursor={cursor(1,[1,1])}")
+        self.assertInvalid(f"/user/products/?cursor={cursor('price','ab')}")
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class MetricsViewTest(TestCase):
+    '''
+    /api/metrics/ reports the product detail cache counters of the process
+    '''
+
+    def setUp(self):
+        cache.clear()
+        get_product_cache().reset_stats()
+        seller_user=User.objects.create_user('seller','seller@example.com','pw',role_model='seller')
+        seller=Seller.objects.create(user=seller_user,business_name='seller',gst_number='GST1')
+        self.product=user_models.Product.objects.create(
+            seller=seller,name='phone',base_price=100,sku='P1',
+            category=user_models.Category.objects.create(name='phones'),
+            brand=user_models.Brand.objects.create(name='samsung'))
+        admin=User.objects.create_superuser('admin','admin@example.com','pw')
+        self.client.force_login(admin)
+
+    def test_cache_hits_and_misses(self):
+        for _ in range(3):
+            self.assertEqual(self.client.get(f'/user/product/detail/{self.product.id}').status_code,200)
+
+        stats=self.client.get('/api/metrics/').json()['product_detail_cache']
+        self.assertEqual(stats,{'hits':2,'misses':1,'hit_ratio':0.6667})
+
+        self.assertEqual(self.client.delete('/api/metrics/').status_code,204)
+        stats=self.client.get('/api/metrics/').json()['product_detail_cache']
+        self.assertEqual(stats,{'hits':0,'misses':0,'hit_ratio':0.0})
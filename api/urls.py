@@ -14,6 +14,7 @@ urlpatterns = [
     path('register/', views.UserRegistrationView.as_view(),name='register' ),
     path('refresh/', views.CookieTokenRefreshView.as_view(),name='refresh' ),
     path('csrf-token/', views.CSRFTokenView.as_view(), name='csrf-token'),
+    path('metrics/', views.RequestMetricsView.as_view(), name='metrics'),
 
 
     # Useful for token-based auth (mostly for Postman / mobile / DRF clients)       
@@ -1,7 +1,7 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import generics, status
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, AllowAny, IsAdminUser
 
 from rest_framework_simplejwt.serializers import TokenRefreshSerializer
 from rest_framework_simplejwt.views import TokenRefreshView
@@ -13,6 +13,10 @@ from django.middleware.csrf import get_token
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.utils.decorators import method_decorator
 
+from user.cache import get_product_cache
+
+from .metrics import registry
+from .middleware import metrics_config
 from .models import User
 from .serializers import UserRegistrationSerializer
 
@@ -218,4 +222,32 @@ class CSRFTokenView(APIView):
         # get_token() guarantees the token is generated and stored in the
         # session/cookie — request.META.get('CSRF_COOKIE') can be None
         # if the middleware hasn't run the response phase yet.
-        return Response({'csrfToken': get_token(request)})
\ No newline at end of file
+        return Response({'csrfToken': get_token(request)})
+
+
+class RequestMetricsView(APIView):
+    """
+    GET /api/metrics/
+    Query count, SQL time, render time and latency histograms per URL name,
+    from the sampled requests this worker process has served
+    (api.middleware.RequestMetricsMiddleware), and the hit ratio of the
+    product detail cache in this process (user.cache.ProductDetailCache).
+
+    DELETE /api/metrics/
+    Starts the histograms and the cache counters of this process over.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, format=None):
+        config = metrics_config()
+        return Response({
+            'sample_rate': config['SAMPLE_RATE'],
+            'query_budget': config['QUERY_BUDGET'],
+            **registry.snapshot(),
+            'product_detail_cache': get_product_cache().stats(),
+        })
+
+    def delete(self, request, format=None):
+        registry.reset()
+        get_product_cache().reset_stats()
+        return Response(status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,124 @@
+'''
+External SDK clients
+
+Every client is built on first use and then kept for the life of the
+process, so requests and tasks reuse its open connections instead of paying
+for client setup and a TLS handshake each time:
+
+    s3()          boto3 S3 client, shared (boto3 clients are thread safe)
+    sns()         boto3 SNS client, shared
+    razorpay()    razorpay.Client, one per thread (it wraps a requests.Session)
+    anthropic()   anthropic.Anthropic, shared (its httpx pool is thread safe)
+
+Pool sizes, timeouts and retries come from settings.EXTERNAL_CLIENTS,
+credentials are the lazy secrets of settings.py (ecommerce/config.py). The
+SDKs are imported inside the factories so a process only loads the ones it
+uses. Clients are dropped in forked children (celery prefork, gunicorn
+--preload), a socket must not be shared between processes.
+'''
+import os
+import threading
+
+from django.conf import settings
+
+
+_lock = threading.Lock()
+_shared = {}
+_local = threading.local()
+
+
+def _config():
+    config = getattr(settings, 'EXTERNAL_CLIENTS', {})
+    return {
+        'AWS_MAX_POOL_CONNECTIONS': config.get('AWS_MAX_POOL_CONNECTIONS', 50),
+        'AWS_CONNECT_TIMEOUT': config.get('AWS_CONNECT_TIMEOUT', 5),
+        'AWS_READ_TIMEOUT': config.get('AWS_READ_TIMEOUT', 30),
+        'AWS_MAX_ATTEMPTS': config.get('AWS_MAX_ATTEMPTS', 3),
+        'ANTHROPIC_TIMEOUT': config.get('ANTHROPIC_TIMEOUT', 120),
+        'ANTHROPIC_MAX_RETRIES': config.get('ANTHROPIC_MAX_RETRIES', 2),
+    }
+
+
+def _shared_client(name, factory):
+    client = _shared.get(name)
+    if client is None:
+        with _lock:
+            client = _shared.get(name)
+            if client is None:
+                client = _shared[name] = factory()
+    return client
+
+
+def _thread_client(name, factory):
+    client = getattr(_local, name, None)
+    if client is None:
+        client = factory()
+        setattr(_local, name, client)
+    return client
+
+
+def reset():
+    '''
+    Forgets every client, the next call builds a new one
+    '''
+    global _local
+    with _lock:
+        _shared.clear()
+        _local = threading.local()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset)
+
+
+def _boto3_client(service, **credentials):
+    import boto3
+    from botocore.config import Config
+
+    config = _config()
+    return boto3.client(
+        service,
+        region_name=str(settings.AWS_S3_REGION_NAME),
+        config=Config(
+            max_pool_connections=config['AWS_MAX_POOL_CONNECTIONS'],
+            connect_timeout=config['AWS_CONNECT_TIMEOUT'],
+            read_timeout=config['AWS_READ_TIMEOUT'],
+            retries={'max_attempts': config['AWS_MAX_ATTEMPTS'], 'mode': 'standard'},
+            tcp_keepalive=True,
+        ),
+        **credentials,
+    )
+
+
+def s3():
+    return _shared_client('s3', lambda: _boto3_client(
+        's3',
+        aws_access_key_id=str(settings.AWS_ACCESS_KEY_ID),
+        aws_secret_access_key=str(settings.AWS_SECRET_ACCESS_KEY),
+    ))
+
+
+def sns():
+    # default credential chain (instance role), as before
+    return _shared_client('sns', lambda: _boto3_client('sns'))
+
+
+def razorpay():
+    def factory():
+        import razorpay
+        return razorpay.Client(auth=(str(settings.RAZORPAY_KEY_ID), str(settings.RAZORPAY_KEY_SECRET)))
+
+    return _thread_client('razorpay', factory)
+
+
+def anthropic():
+    def factory():
+        import anthropic
+        config = _config()
+        return anthropic.Anthropic(
+            api_key=str(settings.ANTHROPIC_API_KEY),
+            timeout=config['ANTHROPIC_TIMEOUT'],
+            max_retries=config['ANTHROPIC_MAX_RETRIES'],
+        )
+
+    return _shared_client('anthropic', factory)
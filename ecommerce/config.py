@@ -0,0 +1,146 @@
+'''
+Lazy secrets
+
+settings.py declares its secrets with SecretStore.get(). Nothing is fetched
+at import: each value is a lazy string that resolves the first time it is
+used, so processes that never touch a secret (most manage.py commands,
+workers that only run some tasks) start without calling AWS at all.
+
+A value comes from, in order:
+
+    1. the environment variable named in get()  (offline runs, tests, overrides)
+    2. the encrypted cache file, if younger than the TTL
+    3. SSM, every secret still missing in one get_parameters batch per 10 names
+    4. the expired cache file, when SSM can not be reached
+
+The first fetch from SSM is written to the cache file, encrypted with
+Fernet under SECRETS_CACHE_KEY. Without that key, or without the optional
+cryptography package, values are only kept in memory.
+
+Lazy values behave like str for formatting, comparison and str methods but
+are not str instances; call str() before handing one to an SDK that checks
+types (boto3 parameters, razorpay's hmac key).
+'''
+import base64
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import lazy
+
+
+logger = logging.getLogger(__name__)
+
+
+# get_parameters accepts at most 10 names per call
+SSM_BATCH_SIZE = 10
+
+
+class SecretStore:
+
+    def __init__(self, region, cache_path=None, ttl=60 * 60, key=None):
+        self.region = region
+        self.cache_path = cache_path
+        self.ttl = ttl
+        self.key = key
+        self._env = {}       # ssm name -> environment variable
+        self._values = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def get(self, name, env=None):
+        '''
+        Lazy value of SSM parameter `name`, environment variable `env` takes precedence
+        '''
+        self._env[name] = env
+        return lazy(self.resolve, str)(name)
+
+    def resolve(self, name):
+        env = self._env.get(name)
+        if env and os.environ.get(env):
+            return os.environ[env]
+
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self._load()
+                    self._loaded = True
+
+        if name not in self._values:
+            raise ImproperlyConfigured(
+                f'secret {name} is not in SSM' + (f' and {env} is not set' if env else ''))
+        return self._values[name]
+
+    def _wanted(self):
+        return sorted(name for name, env in self._env.items() if not (env and os.environ.get(env)))
+
+    def _load(self):
+        wanted = self._wanted()
+        cached = self._read_cache(self.ttl)
+        # names SSM did not have count as cached too, they are not asked for again until the TTL
+        if cached is not None and set(wanted) <= set(cached['names']):
+            self._values = cached['values']
+            return
+
+        try:
+            self._values = self._fetch(wanted)
+        except Exception as e:
+            stale = self._read_cache(None)
+            if stale is None:
+                raise ImproperlyConfigured(f'could not load secrets from SSM: {e}') from e
+            logger.warning(f'could not load secrets from SSM, using the expired cache: {e}')
+            self._values = stale['values']
+            return
+
+        self._write_cache({'names': wanted, 'values': self._values})
+
+    def _fetch(self, names):
+        import boto3
+
+        ssm = boto3.client('ssm', region_name=self.region)
+        values = {}
+        for i in range(0, len(names), SSM_BATCH_SIZE):
+            response = ssm.get_parameters(Names=names[i:i + SSM_BATCH_SIZE], WithDecryption=True)
+            values.update({parameter['Name']: parameter['Value'] for parameter in response['Parameters']})
+            if response.get('InvalidParameters'):
+                logger.warning(f"SSM parameters not found: {', '.join(response['InvalidParameters'])}")
+        return values
+
+    def _fernet(self):
+        if not (self.key and self.cache_path):
+            return None
+        try:
+            from cryptography.fernet import Fernet
+        except ImportError:
+            logger.debug('cryptography is not installed, secrets are not cached on disk')
+            return None
+        # any passphrase works, Fernet wants 32 url-safe base64 encoded bytes
+        return Fernet(base64.urlsafe_b64encode(hashlib.sha256(self.key.encode()).digest()))
+
+    def _read_cache(self, ttl):
+        fernet = self._fernet()
+        if fernet is None:
+            return None
+        try:
+            with open(self.cache_path, 'rb') as f:
+                return json.loads(fernet.decrypt(f.read(), ttl=ttl))
+        except Exception:
+            # missing, expired, written under another key or corrupt
+            return None
+
+    def _write_cache(self, cached):
+        fernet = self._fernet()
+        if fernet is None:
+            return
+        token = fernet.encrypt(json.dumps(cached).encode())
+        tmp_path = f'{self.cache_path}.{os.getpid()}.tmp'
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as f:
+                f.write(token)
+            os.replace(tmp_path, self.cache_path)
+        except OSError as e:
+            logger.warning(f'could not write the secrets cache {self.cache_path}: {e}')
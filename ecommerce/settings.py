@@ -12,14 +12,24 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 
 from pathlib import Path
 import datetime
-import boto3
 import os
+import tempfile
+from celery.schedules import crontab
 
+from ecommerce.config import SecretStore
 
-ssm=boto3.client('ssm',region_name=os.getenv('AWS_REGION','ap-south-1'))
 
-def get_ssm_param(name):
-  return ssm.get_parameter(Name=name,WithDecryption=True)['Parameter']['Value']
+# secrets are read from SSM on first use, not at import (ecommerce/config.py)
+#   an environment variable named like the setting wins over SSM (offline runs, tests)
+#   SECRETS_CACHE_KEY    -> passphrase for the encrypted cache file, unset keeps secrets in memory only
+#   SECRETS_CACHE_TTL    -> seconds the cache file is trusted before SSM is asked again
+#   SECRETS_CACHE_PATH   -> where the cache file lives
+secrets=SecretStore(
+  region=os.getenv('AWS_REGION','ap-south-1'),
+  cache_path=os.getenv('SECRETS_CACHE_PATH',os.path.join(tempfile.gettempdir(),'ecommerce-secrets.cache')),
+  ttl=int(os.getenv('SECRETS_CACHE_TTL',60*60)),
+  key=os.getenv('SECRETS_CACHE_KEY'),
+)
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -81,6 +91,7 @@ CORS_ALLOW_HEADERS = [
     'x-csrftoken',
     'x-requested-with',
     'mcp_server',
+    'idempotency-key',
 ]
 
 INSTALLED_APPS = [
@@ -101,10 +112,12 @@ INSTALLED_APPS = [
     'rest_framework_simplejwt', 
     "corsheaders",
     'rest_framework', 
+    'django_celery_beat',
    
 ]
 
 MIDDLEWARE = [
+    'api.middleware.RequestMetricsMiddleware',   # first, so its latency covers every other middleware
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -143,6 +156,17 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # sqlite ignores SELECT ... FOR UPDATE: every transaction takes the
+        # write lock when it begins, so checkouts queue as they do on row locks,
+        # and waits up to `timeout` seconds for it
+        'OPTIONS': {
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20,
+        },
+        # a file, so the threads of the concurrency tests each get a connection
+        'TEST': {
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -151,10 +175,10 @@ DATABASES = {
 # DATABASES = {
 #     'default': {
 #         'ENGINE': 'django.db.backends.postgresql',
-#         'NAME': get_ssm_param('/Ecommerce/db_name'),  # Database name
+#         'NAME': secrets.get('/Ecommerce/db_name','DB_NAME'),  # Database name
 #         'USER': 'postgres',  # MySQL username (e.g., 'root')
-#         'PASSWORD': get_ssm_param('/Ecommerce/db_passowrd'),  # MySQL password
-#         'HOST':get_ssm_param('/Ecommerce/db_DNS'),  # Or '127.0.0.1' or your MySQL server IP
+#         'PASSWORD': secrets.get('/Ecommerce/db_passowrd','DB_PASSWORD'),  # MySQL password
+#         'HOST':secrets.get('/Ecommerce/db_DNS','DB_HOST'),  # Or '127.0.0.1' or your MySQL server IP
 #         'PORT': '5432',  # Default MySQL port
 #         'OPTIONS': {
 #          'connect_timeout': 10,
@@ -221,6 +245,99 @@ REST_FRAMEWORK={
   
 }
 
+# Shared cache, every gunicorn/celery worker reads and writes the same redis db
+# (product detail, stock availability). Falls back to LocMemCache, one per
+# process, only when CACHE_URL is set to 'locmem://'
+CACHE_URL=os.getenv('CACHE_URL','redis://localhost:6379/2')
+CACHES={
+  'default':{
+    'BACKEND':'django.core.cache.backends.locmem.LocMemCache',
+  } if CACHE_URL=='locmem://' else {
+    'BACKEND':'django.core.cache.backends.redis.RedisCache',
+    'LOCATION':CACHE_URL,
+  },
+}
+
+# Product detail cache (user/cache.py)
+#   BACKEND 'django' -> CACHES[ALIAS], shared by all workers
+#   BACKEND 'lru'    -> in-process LRU per worker, single process only (writes
+#                       made by other workers are not seen until TIMEOUT)
+#   MAX_VERSIONS     -> 'lru' version counters kept (default 4 * MAX_ENTRIES)
+PRODUCT_DETAIL_CACHE={
+  'BACKEND':'django',
+  'ALIAS':'default',
+  'MAX_ENTRIES':1024,
+  'TIMEOUT':300,
+}
+
+# In-memory catalog indexes (user/search.py)
+#   REFRESH_INTERVAL -> seconds before a worker rebuilds its copy in a background
+#                       thread to pick up writes made by other workers (0 disables)
+#   PRICE_BUCKETS    -> lower edges of the price facet buckets
+SEARCH_INDEX={
+  'REFRESH_INTERVAL':300,
+  'PRICE_BUCKETS':[0,1000,5000,10000,25000,50000,100000],
+}
+
+# Page totals for StandardPagination (api/pagination.py CachedCountPaginator)
+#   STALE_AFTER    -> seconds a cached COUNT(*) may be served for
+#   ESTIMATE_ABOVE -> unfiltered postgres tables above this many rows use table statistics
+#   clients can always ask for an exact total with ?exact_count=1
+PAGINATION_COUNT={
+  'STALE_AFTER':60,
+  'ESTIMATE_ABOVE':100000,
+  'CACHE_ALIAS':'default',
+}
+
+# Cart line storage (user/cart_store.py)
+#   BACKEND 'database' -> Cart/CartItem rows on every write
+#   BACKEND 'redis'    -> one hash per user at URL, written to Cart/CartItem on idle flush
+#   BACKEND 'local'    -> in-process stand-in for 'redis' (single process only)
+#   IDLE_FLUSH_SECONDS -> carts untouched this long are flushed by user.tasks.flush_idle_carts
+CART_STORAGE={
+  'BACKEND':'database',
+  'URL':'redis://localhost:6379/3',
+  'IDLE_FLUSH_SECONDS':15*60,
+}
+
+# Checkout stock reservations (inventory/reservations.py)
+#   TTL         -> seconds units stay reserved for an unpaid order
+#   SWEEP_BATCH -> expired reservations released per transaction by the sweeper
+STOCK_RESERVATION={
+  'TTL':15*60,
+  'SWEEP_BATCH':500,
+}
+
+# Inventory ledger upkeep (inventory/snapshots.py)
+#   RETENTION_DAYS -> InventoryLog rows older than this are compacted into daily summaries
+#   SNAPSHOT_LAG   -> seconds a log row must be old before a snapshot covers it
+#   BATCH_SIZE     -> variants / log rows handled per query and transaction
+INVENTORY_LEDGER={
+  'RETENTION_DAYS':90,
+  'SNAPSHOT_LAG':60,
+  'BATCH_SIZE':1000,
+}
+
+# Sellable quantity per variant / product (inventory/availability.py)
+#   CACHE_ALIAS -> CACHES entry, must be shared (redis): invalidations reach
+#                  every worker only through it, a per-process cache serves
+#                  stale counts for up to TIMEOUT
+#   TIMEOUT     -> seconds an entry may live, writes invalidate it sooner
+STOCK_AVAILABILITY={
+  'CACHE_ALIAS':'default',
+  'TIMEOUT':60,
+}
+
+# Idempotency-Key handling for order / payment creation (user/idempotency.py)
+#   keys are IdempotencyKey rows, unique per user/scope/key
+#   WINDOW       -> seconds a stored response is replayed for, older rows are
+#                   purged by user.tasks.purge_idempotency_keys
+#   LOCK_TIMEOUT -> seconds a key stays claimed by a request that is still running
+IDEMPOTENCY={
+  'WINDOW':24*60*60,
+  'LOCK_TIMEOUT':60,
+}
+
 SIMPLE_JWT={
   'AUTH_HEADER_TYPES':["Bearer"],
   "ACCESS_TOKEN_LIFETIME":datetime.timedelta(minutes=45) ,
@@ -229,11 +346,11 @@ SIMPLE_JWT={
 
 }
 
-AWS_ACCESS_KEY_ID = get_ssm_param('/Ecommerce/aws_access_key')
-AWS_SECRET_ACCESS_KEY = get_ssm_param('/Ecommerce/aws_secret_access_key')
-AWS_S3_REGION_NAME = get_ssm_param('/Ecommerce/aws_s3_region_name')
-AWS_STORAGE_BUCKET_NAME = get_ssm_param('/StudyBud/s3_bucket_name')
-AWS_SNS_ARN=get_ssm_param('/StudyBud/sns_arn')
+AWS_ACCESS_KEY_ID = secrets.get('/Ecommerce/aws_access_key','AWS_ACCESS_KEY_ID')
+AWS_SECRET_ACCESS_KEY = secrets.get('/Ecommerce/aws_secret_access_key','AWS_SECRET_ACCESS_KEY')
+AWS_S3_REGION_NAME = secrets.get('/Ecommerce/aws_s3_region_name','AWS_S3_REGION_NAME')
+AWS_STORAGE_BUCKET_NAME = secrets.get('/StudyBud/s3_bucket_name','AWS_STORAGE_BUCKET_NAME')
+AWS_SNS_ARN=secrets.get('/StudyBud/sns_arn','AWS_SNS_ARN')
 
 DJANGO_MCP_GLOBAL_SERVER_CONFIG = {
     "name": "Ecommerce MCP Server",
@@ -244,7 +361,7 @@ DJANGO_MCP_GLOBAL_SERVER_CONFIG = {
 # ── Anthropic / MCP proxy ────────────────────────────────────────────────────
 # Replace these values with your real keys before running.
 # In production, load them from SSM / env vars just like the AWS keys above.
-ANTHROPIC_API_KEY = get_ssm_param('/Ecommerce/aws_anthropic_ai_api_key')   # TODO: move to SSM
+ANTHROPIC_API_KEY = secrets.get('/Ecommerce/aws_anthropic_ai_api_key','ANTHROPIC_API_KEY')
 MCP_SERVER_URL    =  "https://lid-canon-sedative.ngrok-free.dev"    # TODO: public URL for prod
 # ────────────────────────────────────────────────────────────────────────────
 
@@ -287,8 +404,84 @@ CELERY_TASK_TRACK_STARTED = True      # marks task as STARTED (not just PENDING)
 CELERY_TASK_TIME_LIMIT = 30 * 60      # hard kill after 30 min
 CELERY_TASK_SOFT_TIME_LIMIT = 25 * 60 # SoftTimeLimitExceeded raised at 25 min
 
-# For periodic tasks (requires django-celery-beat):
-# INSTALLED_APPS += ['django_celery_beat']  something like inventory sync or any db sync we can use this
+CELERY_BEAT_SCHEDULE = {
+    'flush-idle-carts': {
+        'task': 'user.tasks.flush_idle_carts',
+        'schedule': 5 * 60,
+    },
+    'release-expired-reservations': {
+        'task': 'inventory.tasks.release_expired_reservations',
+        'schedule': 60,
+    },
+    'snapshot-inventory': {
+        'task': 'inventory.tasks.snapshot_inventory',
+        'schedule': crontab(hour=2, minute=0),
+    },
+    'compact-inventory-log': {
+        'task': 'inventory.tasks.compact_inventory_log',
+        'schedule': crontab(hour=2, minute=30),
+    },
+    'process-pending-webhook-events': {
+        'task': 'user.tasks.process_pending_webhook_events',
+        'schedule': 60,
+    },
+    'reconcile-payments': {
+        'task': 'user.tasks.reconcile_payments',
+        'schedule': 30 * 60,
+    },
+    'purge-idempotency-keys': {
+        'task': 'user.tasks.purge_idempotency_keys',
+        'schedule': crontab(minute=15),
+    },
+}
+
+# razorpay webhook queue (user/webhooks.py)
+#   BATCH_SIZE   -> pending events looked at per beat sweep
+#   MAX_ATTEMPTS -> tries before an event is marked failed and stops holding back its order
+WEBHOOKS={
+  'BATCH_SIZE':100,
+  'MAX_ATTEMPTS':10,
+}
+
+# pending payment reconciliation against the gateway (user/reconciliation.py)
+#   CLIENT        -> GatewayClient class, user.reconciliation.FakeGatewayClient for local runs
+#   GRACE_SECONDS -> payments younger than this are left to the verify call / webhook
+#   BATCH_SIZE    -> payments per keyset page and per write transaction
+#   CHUNK_SIZE    -> order ids per gateway lookup
+#   WORKERS       -> concurrent gateway lookups
+PAYMENT_RECONCILIATION={
+  'CLIENT':'user.reconciliation.RazorpayGatewayClient',
+  'GRACE_SECONDS':15*60,
+  'BATCH_SIZE':500,
+  'CHUNK_SIZE':50,
+  'WORKERS':8,
+}
+
+# periodic tasks: the schedule above is copied into django-celery-beat's tables on
+# beat start up and can be edited in the admin from there
+CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+
+# per endpoint query count / latency histograms (api/metrics.py), served at /api/metrics/
+#   SAMPLE_RATE  -> share of requests measured, the rest only pay for one random() call
+#   QUERY_BUDGET -> sampled requests running more queries than this are logged as warnings
+#   BUDGETS      -> per URL name overrides of QUERY_BUDGET, e.g. {'order': 40}
+REQUEST_METRICS={
+  'ENABLED':True,
+  'SAMPLE_RATE':0.05,
+  'QUERY_BUDGET':25,
+  'BUDGETS':{},
+}
+
+# external SDK clients, built once per process (ecommerce/clients.py)
+EXTERNAL_CLIENTS={
+  'AWS_MAX_POOL_CONNECTIONS':50,   # botocore default is 10
+  'AWS_CONNECT_TIMEOUT':5,
+  'AWS_READ_TIMEOUT':30,
+  'AWS_MAX_ATTEMPTS':3,
+  'ANTHROPIC_TIMEOUT':120,
+  'ANTHROPIC_MAX_RETRIES':2,
+}
 
-RAZORPAY_KEY_ID =  get_ssm_param('/Ecommerce/aws_razorpay_id')
-RAZORPAY_KEY_SECRET = get_ssm_param('/Ecommerce/aws_razorpay_key_secret')
\ No newline at end of file
+RAZORPAY_KEY_ID =  secrets.get('/Ecommerce/aws_razorpay_id','RAZORPAY_KEY_ID')
+RAZORPAY_KEY_SECRET = secrets.get('/Ecommerce/aws_razorpay_key_secret','RAZORPAY_KEY_SECRET')
+RAZORPAY_WEBHOOK_SECRET = secrets.get('/Ecommerce/aws_razorpay_webhook_secret','RAZORPAY_WEBHOOK_SECRET')
\ No newline at end of file
@@ -0,0 +1,127 @@
+'''
+Stock availability
+
+The one answer to "how many of this can still be sold", used by the cart
+and by checkout:
+
+    variant line      Inventory.available_stock (reserved units excluded),
+                      ProductVariant.stock_qty while the variant has no Inventory row
+    product only line Product.stock_qty
+
+Values live in the shared Django cache (settings.STOCK_AVAILABILITY, redis
+in settings.CACHES), keyed per variant or per product, so a check over a whole cart is one get_many plus
+at most one query per table for the misses. Every stock write invalidates
+its keys after commit: user.stock, inventory.reservations and the model
+signals in user/signals.py. Checks here are advisory: checkout checks again
+against the rows it locks (user/checkout.py price_lines) and the
+reservation engine holds the units.
+'''
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+
+def _config():
+    config = getattr(settings, 'STOCK_AVAILABILITY', {})
+    return caches[config.get('CACHE_ALIAS', 'default')], config.get('TIMEOUT', 60)
+
+
+def _variant_key(variant_id):
+    return f'stock:v:{variant_id}'
+
+
+def _product_key(product_id):
+    return f'stock:p:{product_id}'
+
+
+def _load(product_ids, variant_ids):
+    '''
+    {cache key: value} straight from the database
+
+    variant values are (product_id, sellable) so callers can also check the
+    variant belongs to the product they were given
+    '''
+    from user.models import Product, ProductVariant
+
+    values = {}
+    if variant_ids:
+        rows = ProductVariant.objects \
+            .filter(id__in=variant_ids) \
+            .values_list('id', 'product_id', 'stock_qty', 'inventory__available_stock')
+        for variant_id, product_id, stock_qty, available in rows:
+            values[_variant_key(variant_id)] = (product_id, stock_qty if available is None else available)
+    if product_ids:
+        for product_id, stock_qty in Product.objects.filter(id__in=product_ids).values_list('id', 'stock_qty'):
+            values[_product_key(product_id)] = stock_qty
+    return values
+
+
+def sellable_many(lines):
+    '''
+    {(product_id, variant_id): sellable quantity} for (product_id, variant_id) pairs
+
+    Pairs whose product or variant does not exist, or whose variant belongs
+    to another product, are left out.
+    '''
+    lines = {(int(product_id), int(variant_id) if variant_id else None) for product_id, variant_id in lines}
+    if not lines:
+        return {}
+
+    cache, timeout = _config()
+    keys = {line: _variant_key(line[1]) if line[1] else _product_key(line[0]) for line in lines}
+    values = cache.get_many(list(keys.values()))
+
+    missing = [line for line, key in keys.items() if key not in values]
+    if missing:
+        loaded = _load({p for p, v in missing if not v}, {v for p, v in missing if v})
+        cache.set_many(loaded, timeout)
+        values.update(loaded)
+
+    result = {}
+    for (product_id, variant_id), key in keys.items():
+        value = values.get(key)
+        if value is None:
+            continue
+        if variant_id:
+            owner, value = value
+            if owner != product_id:
+                continue
+        result[(product_id, variant_id)] = value
+    return result
+
+
+def sellable(product_id, variant_id=None):
+    '''
+    Sellable quantity of one product or variant, None when it does not exist
+    '''
+    return sellable_many([(product_id, variant_id)]).get(
+        (int(product_id), int(variant_id) if variant_id else None))
+
+
+def shortages(lines):
+    '''
+    Checks (product_id, variant_id, quantity) lines, quantities of repeated
+    pairs are added up. Returns [(product_id, variant_id, wanted, sellable)]
+    for pairs that can not be met, sellable is None when the pair does not exist.
+    '''
+    wanted = defaultdict(int)
+    for product_id, variant_id, quantity in lines:
+        wanted[(int(product_id), int(variant_id) if variant_id else None)] += quantity
+
+    available = sellable_many(wanted)
+    return [
+        (product_id, variant_id, quantity, available.get((product_id, variant_id)))
+        for (product_id, variant_id), quantity in wanted.items()
+        if available.get((product_id, variant_id)) is None or available[(product_id, variant_id)] < quantity
+    ]
+
+
+def invalidate(product_ids=(), variant_ids=()):
+    '''
+    Drops cached values after the current transaction commits (now when there is none)
+    '''
+    keys = [_product_key(p) for p in product_ids if p] + [_variant_key(v) for v in variant_ids if v]
+    if keys:
+        transaction.on_commit(lambda: _config()[0].delete_many(keys))
@@ -0,0 +1,70 @@
+'''
+Inventory ledger
+
+InventoryLog is append-only: rows are never updated. Rows past
+INVENTORY_LEDGER['RETENTION_DAYS'] are folded into daily summaries and
+moved to InventoryLogArchive by snapshots.compact(), the one retention policy.
+
+Writers hand their rows to write(), one bulk_create per stock operation:
+the multi-order paths (reservations.release_orders(), sweep_expired())
+already write each batch of orders with one call.
+
+Reads go through the two composite indexes on InventoryLog:
+variant_history() uses (product_variant, -created_at), movements() uses (created_at).
+'''
+from django.utils import timezone
+
+from .models import InventoryLog, InventoryLogArchive
+
+
+BATCH_SIZE = 1000
+
+
+def write(rows):
+    '''
+    Inserts InventoryLog rows
+    '''
+    rows = list(rows)
+    if rows:
+        InventoryLog.objects.bulk_create(rows, batch_size=BATCH_SIZE)
+
+
+def variant_history(variant_id, limit=50, before=None):
+    logs = InventoryLog.objects.filter(product_variant_id=variant_id)
+    if before is not None:
+        logs = logs.filter(created_at__lt=before)
+    return logs.order_by('-created_at')[:limit]
+
+
+def movements(start, end, variant_ids=None):
+    logs = InventoryLog.objects.filter(created_at__gte=start, created_at__lt=end)
+    if variant_ids is not None:
+        logs = logs.filter(product_variant_id__in=variant_ids)
+    return logs.order_by('created_at', 'id')
+
+
+def archive_rows(logs):
+    '''
+    Copies InventoryLog rows to InventoryLogArchive, the caller deletes them
+    '''
+    InventoryLogArchive.objects.bulk_create(
+        [
+            InventoryLogArchive(
+                id=log.id,
+                month=timezone.localtime(log.created_at).date().replace(day=1),
+                product_variant_id=log.product_variant_id,
+                change_type=log.change_type,
+                quantity_change=log.quantity_change,
+                previous_quantity=log.previous_quantity,
+                new_quantity=log.new_quantity,
+                reason=log.reason,
+                reference_id=log.reference_id,
+                performed_by_id=log.performed_by_id,
+                created_at=log.created_at,
+            )
+            for log in logs
+        ],
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+
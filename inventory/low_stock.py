@@ -0,0 +1,76 @@
+'''
+Low-stock index
+
+Inventory.low_stock stores is_low_stock and is indexed only where it is
+true, so "which variants are low" is an index lookup, not a scan over every
+Inventory row.
+
+Stock writers pass the Inventory objects they changed to track() before
+saving them. It costs O(changed rows): flags are flipped in memory, the
+caller adds 'low_stock' to its bulk_update fields, and variants that just
+went low are handed to tasks.notify_low_stock after the commit, which
+bulk-creates product_restock notifications for their sellers. When the
+broker can not be reached the notifications are written in the committing
+process instead: the hook never raises, the order is already committed and
+the hooks registered after this one (cache invalidation) still have to run.
+'''
+import logging
+
+from django.db import transaction
+
+
+logger = logging.getLogger(__name__)
+
+
+def track(inventories):
+    '''
+    Refreshes low_stock on changed Inventory objects, returns the variant ids that became low
+    '''
+    crossed = []
+    for inventory in inventories:
+        low = inventory.is_low_stock
+        if low and not inventory.low_stock:
+            crossed.append(inventory.product_variant_id)
+        inventory.low_stock = low
+
+    if crossed:
+        transaction.on_commit(lambda: _notify(crossed))
+    return crossed
+
+
+def _notify(variant_ids):
+    from .tasks import notify_low_stock
+
+    try:
+        notify_low_stock.delay(variant_ids)
+        return
+    except Exception as e:
+        logger.warning(f'could not queue low stock notifications for variants {variant_ids}: {e}')
+    try:
+        notify_low_stock(variant_ids)
+    except Exception:
+        logger.exception(f'low stock notifications for variants {variant_ids} were lost')
+
+
+def notifications_for(variant_ids):
+    '''
+    Unsaved product_restock Notifications for the sellers of `variant_ids`, one per variant
+    '''
+    from marketing.models import Notification
+    from .models import Inventory
+
+    rows = Inventory.objects \
+        .filter(product_variant_id__in=variant_ids, low_stock=True) \
+        .values_list('available_stock', 'low_stock_threshold', 'product_variant__sku',
+                     'product_variant__product__name', 'product_variant__product__seller__user_id')
+
+    return [
+        Notification(
+            user_id=seller_user_id,
+            notification_type='product_restock',
+            title=f'Low stock: {product_name}',
+            message=f'{product_name} ({sku}) is down to {available} units, '
+                    f'at or below your threshold of {threshold}. Restock soon.',
+        )
+        for available, threshold, sku, product_name, seller_user_id in rows
+    ]
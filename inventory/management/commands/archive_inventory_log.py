@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from inventory import snapshots
+
+
+class Command(BaseCommand):
+    '''
+    Compacts InventoryLog rows past settings.INVENTORY_LEDGER['RETENTION_DAYS']
+
+    Same as the compact-inventory-log beat task (inventory/snapshots.py):
+    rows a snapshot covers are folded into InventoryLogSummary rows and moved
+    to InventoryLogArchive. For backfills and deployments without beat:
+
+        python manage.py archive_inventory_log
+    '''
+    help = 'Compact InventoryLog rows older than INVENTORY_LEDGER RETENTION_DAYS'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None, help='rows moved per transaction')
+
+    def handle(self, *args, **options):
+        compacted = snapshots.compact(batch_size=options['batch_size'])
+        self.stdout.write(f'{compacted} rows compacted' if compacted else 'nothing to compact')
@@ -20,11 +20,25 @@ class Inventory(models.Model):
     available_stock=models.IntegerField(default=0)
     reserved_stock=models.IntegerField(default=0)  
     low_stock_threshold=models.IntegerField(default=10)
+    # stored is_low_stock, kept current by every stock write (inventory/low_stock.py)
+    low_stock=models.BooleanField(default=False)
     warehouse_location=models.CharField(max_length=200, null=True, blank=True)
     last_restocked=models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # only the low rows are indexed, the seller list never scans the table
+            models.Index(fields=['product_variant'], condition=models.Q(low_stock=True), name='inventory_low_stock_idx'),
+        ]
     
     def __str__(self):
         return f"Inventory: {self.product_variant}"
+
+    def save(self, *args, **kwargs):
+        self.low_stock = self.is_low_stock
+        if kwargs.get('update_fields') is not None:
+            kwargs['update_fields'] = set(kwargs['update_fields']) | {'low_stock'}
+        super().save(*args, **kwargs)
     
     @property
     def total_stock(self):
@@ -58,8 +72,122 @@ class InventoryLog(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            # history of one variant, newest first
+            models.Index(fields=['product_variant', '-created_at'], name='invlog_variant_created_idx'),
+            # movements in a time range, and compaction (inventory/snapshots.py)
+            models.Index(fields=['created_at'], name='invlog_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.change_type} - {self.quantity_change} units"
 
 
+class InventoryLogArchive(models.Model):
+    '''
+    InventoryLog rows past the retention window, moved here by snapshots.compact()
+
+    rows keep their original id and created_at, month is the first day of
+    their month so a whole month can be exported or dropped at once
+    '''
+
+    id = models.BigIntegerField(primary_key=True)
+    month = models.DateField()
+    product_variant_id = models.BigIntegerField()
+    change_type = models.CharField(max_length=20, choices=InventoryLog.CHANGE_TYPES)
+    quantity_change = models.IntegerField()
+    previous_quantity = models.IntegerField()
+    new_quantity = models.IntegerField()
+    reason = models.TextField(null=True, blank=True)
+    reference_id = models.CharField(max_length=100, null=True, blank=True)
+    performed_by_id = models.BigIntegerField(null=True)
+    created_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['month', 'product_variant_id'], name='invlog_archive_month_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.month:%Y-%m} {self.change_type} - {self.quantity_change} units"
+
+
+
+
+class StockReservation(models.Model):
+    '''
+    Units of a variant held for an unpaid order (inventory/reservations.py)
+
+    active rows hold Inventory.reserved_stock until the order is paid (committed),
+    fails (released) or expires_at passes (expired, by the sweeper)
+    '''
+
+    STATUS = [
+        ('active', 'Active'),
+        ('committed', 'Committed'),
+        ('released', 'Released'),
+        ('expired', 'Expired'),
+    ]
+
+    order = models.ForeignKey("user.Order", on_delete=models.CASCADE, related_name='stock_reservations')
+    product_variant = models.ForeignKey("user.ProductVariant", on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    status = models.CharField(max_length=20, choices=STATUS, default='active')
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            # the sweeper scans active rows by expiry
+            models.Index(fields=['status', 'expires_at'], name='reservation_expiry_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.status} - {self.quantity} x {self.product_variant_id} for order {self.order_id}"
+
+
+class InventorySnapshot(models.Model):
+    '''
+    On-hand stock of a variant as of InventoryLog row last_log_id (inventory/snapshots.py)
+
+    stock at any later time is this stock plus the on-hand deltas of log
+    rows (or compacted summaries) after last_log_id
+    '''
+
+    product_variant = models.ForeignKey("user.ProductVariant", on_delete=models.CASCADE, related_name='inventory_snapshots')
+    stock = models.IntegerField()
+    reserved_stock = models.IntegerField(default=0)
+    last_log_id = models.BigIntegerField(default=0)
+    taken_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product_variant', '-taken_at'], name='snapshot_variant_taken_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.product_variant_id} @ {self.taken_at:%Y-%m-%d %H:%M}: {self.stock}"
+
+
+class InventoryLogSummary(models.Model):
+    '''
+    One day of InventoryLog rows of a variant and change type, written by ledger compaction
+
+    a day with a snapshot cut in it gets one row for each side of the cut
+    '''
+
+    product_variant = models.ForeignKey("user.ProductVariant", on_delete=models.CASCADE, related_name='inventory_log_summaries')
+    day = models.DateField()
+    change_type = models.CharField(max_length=20, choices=InventoryLog.CHANGE_TYPES)
+    quantity_change = models.IntegerField()
+    entries = models.IntegerField()
+    last_log_id = models.BigIntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['product_variant', 'day'], name='invlog_summary_variant_day_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.day} {self.change_type} - {self.quantity_change} units ({self.entries} rows)"
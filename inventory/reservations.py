@@ -0,0 +1,310 @@
+'''
+Stock reservations
+
+Checkout moves units from Inventory.available_stock to reserved_stock for a
+limited time (settings.STOCK_RESERVATION['TTL']), so two unpaid orders can
+not both count on the same units.
+
+    reserve(order)       checkout     available -> reserved   log 'reserved'
+    commit_order(order)  payment      reserved  -> sold       log 'sale'
+    release_order(order) failure      reserved  -> available  log 'released'
+    release_orders(ids)  failure      same, for many orders in one batch
+    sweep_expired()      celery beat  reserved  -> available  log 'released'
+    sync_stock(ids)      restock      stock_qty -> available  log 'restock' / 'adjustment'
+
+Inventory rows are locked with one SELECT ... FOR UPDATE in variant id order
+and updated with bulk_update, logs go through ledger.write() in one batch
+and low_stock.track() keeps the low-stock index current, availability.py
+cache entries are dropped on commit.
+Variants without an Inventory row get one on their first reservation,
+seeded from ProductVariant.stock_qty. From then on total_stock (available
+plus reserved) follows stock_qty: payments take the sold units from both
+(user.stock.commit_order() and commit_order() here) and any other write to
+stock_qty (seller restock, admin) is applied by sync_stock() from the
+ProductVariant post_save signal. Product lines without a variant are not
+reserved.
+
+Lock order: products, variants (checkout / user.stock), then reservations,
+then inventory. Payment paths call user.stock.commit_order() before
+commit_order() here.
+'''
+import datetime
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from user.stock import InsufficientStock, StockLine
+
+from . import availability, ledger, low_stock
+from .models import Inventory, InventoryLog, StockReservation
+
+
+def _config():
+    config = getattr(settings, 'STOCK_RESERVATION', {})
+    return config.get('TTL', 15 * 60), config.get('SWEEP_BATCH', 500)
+
+
+def _variant_totals(order):
+    totals = defaultdict(int)
+    for variant_id, quantity in order.items.filter(product_variant__isnull=False) \
+            .values_list('product_variant_id', 'quantity'):
+        totals[variant_id] += quantity
+    return totals
+
+
+def _ensure_inventory(variant_ids):
+    from user.models import ProductVariant
+
+    if not ProductVariant.objects.filter(id__in=variant_ids, inventory__isnull=True).exists():
+        return
+
+    # checked again under the variant locks (already held by checkout): a
+    # concurrent first reservation waits here and then finds the rows, so
+    # every row below is inserted by this call and logged once
+    missing = list(ProductVariant.objects.select_for_update(of=('self',))
+                   .filter(id__in=variant_ids, inventory__isnull=True)
+                   .order_by('id')
+                   .values_list('id', 'stock_qty'))
+    if not missing:
+        return
+
+    inventories = [Inventory(product_variant_id=variant_id, available_stock=stock_qty) for variant_id, stock_qty in missing]
+    low_stock.track(inventories)
+    Inventory.objects.bulk_create(inventories)
+    availability.invalidate(variant_ids=[variant_id for variant_id, _ in missing])
+    # opening balance, so the ledger alone adds up to the stock (snapshots.py)
+    ledger.write(
+        _log(inventory, 'adjustment', inventory.available_stock, 0, inventory.available_stock,
+             None, reason='opening balance')
+        for inventory in inventories
+    )
+
+
+def _lock_inventory(variant_ids):
+    return {
+        inventory.product_variant_id: inventory
+        for inventory in Inventory.objects.select_for_update()
+        .filter(product_variant_id__in=variant_ids)
+        .order_by('product_variant_id')
+    }
+
+
+def _log(inventory, change_type, change, previous, new, reference, user=None, reason=None):
+    return InventoryLog(
+        product_variant_id=inventory.product_variant_id,
+        change_type=change_type,
+        quantity_change=change,
+        previous_quantity=previous,
+        new_quantity=new,
+        reason=reason,
+        reference_id=reference,
+        performed_by=user,
+    )
+
+
+@transaction.atomic
+def reserve(order, user=None, ttl=None):
+    '''
+    Reserves every variant line of `order`, all or nothing
+
+    Raises InsufficientStock with the lines that could not be reserved.
+    Log quantities are available_stock before and after.
+    '''
+    totals = _variant_totals(order)
+    if not totals:
+        return []
+
+    _ensure_inventory(totals)
+    inventories = _lock_inventory(totals)
+
+    failed = [
+        StockLine(None, variant_id, quantity)
+        for variant_id, quantity in totals.items()
+        if inventories[variant_id].available_stock < quantity
+    ]
+    if failed:
+        raise InsufficientStock(failed)
+
+    ttl = _config()[0] if ttl is None else ttl
+    expires_at = timezone.now() + datetime.timedelta(seconds=ttl)
+
+    reservations, logs = [], []
+    for variant_id, quantity in totals.items():
+        inventory = inventories[variant_id]
+        previous = inventory.available_stock
+        inventory.available_stock -= quantity
+        inventory.reserved_stock += quantity
+
+        reservations.append(StockReservation(order=order, product_variant_id=variant_id,
+                                             quantity=quantity, expires_at=expires_at))
+        logs.append(_log(inventory, 'reserved', -quantity, previous, inventory.available_stock,
+                         order.order_number, user))
+
+    low_stock.track(inventories.values())
+    availability.invalidate(variant_ids=inventories.keys())
+    Inventory.objects.bulk_update(inventories.values(), ['available_stock', 'reserved_stock', 'low_stock'])
+    StockReservation.objects.bulk_create(reservations)
+    ledger.write(logs)
+    return reservations
+
+
+@transaction.atomic
+def commit_order(order, user=None):
+    '''
+    Turns the order's reservations into a sale
+
+    Units whose reservation already expired are taken from available_stock
+    again, raises InsufficientStock when they are gone. Variants without an
+    Inventory row are not tracked and are skipped. Log quantities are
+    total_stock before and after.
+    '''
+    totals = _variant_totals(order)
+    if not totals:
+        return
+
+    reservations = list(order.stock_reservations.select_for_update().filter(status='active'))
+    inventories = _lock_inventory(totals)
+
+    reserved = defaultdict(int)
+    for reservation in reservations:
+        reserved[reservation.product_variant_id] += reservation.quantity
+
+    failed, logs = [], []
+    for variant_id, quantity in totals.items():
+        inventory = inventories.get(variant_id)
+        if inventory is None:
+            continue
+
+        from_reserved = min(reserved[variant_id], quantity, inventory.reserved_stock)
+        from_available = quantity - from_reserved
+        if from_available > inventory.available_stock:
+            failed.append(StockLine(None, variant_id, quantity))
+            continue
+
+        previous = inventory.total_stock
+        inventory.reserved_stock -= from_reserved
+        inventory.available_stock -= from_available
+        logs.append(_log(inventory, 'sale', -quantity, previous, inventory.total_stock,
+                         order.order_number, user))
+
+    if failed:
+        raise InsufficientStock(failed)
+
+    now = timezone.now()
+    for reservation in reservations:
+        reservation.status = 'committed'
+        reservation.updated_at = now
+
+    low_stock.track(inventories.values())
+    availability.invalidate(variant_ids=inventories.keys())
+    Inventory.objects.bulk_update(inventories.values(), ['available_stock', 'reserved_stock', 'low_stock'])
+    StockReservation.objects.bulk_update(reservations, ['status', 'updated_at'])
+    ledger.write(logs)
+
+
+def _release(reservations, status, reason, user=None):
+    '''
+    Returns the units of active `reservations` (locked by the caller) to available_stock
+    '''
+    if not reservations:
+        return 0
+
+    inventories = _lock_inventory({reservation.product_variant_id for reservation in reservations})
+    now = timezone.now()
+    logs = []
+
+    for reservation in reservations:
+        inventory = inventories.get(reservation.product_variant_id)
+        if inventory is not None:
+            quantity = min(reservation.quantity, inventory.reserved_stock)
+            previous = inventory.available_stock
+            inventory.reserved_stock -= quantity
+            inventory.available_stock += quantity
+            logs.append(_log(inventory, 'released', quantity, previous, inventory.available_stock,
+                             reservation.order.order_number, user, reason))
+        reservation.status = status
+        reservation.updated_at = now
+
+    low_stock.track(inventories.values())
+    availability.invalidate(variant_ids=inventories.keys())
+    Inventory.objects.bulk_update(inventories.values(), ['available_stock', 'reserved_stock', 'low_stock'])
+    StockReservation.objects.bulk_update(reservations, ['status', 'updated_at'])
+    ledger.write(logs)
+    return len(reservations)
+
+
+@transaction.atomic
+def release_order(order, user=None, reason='payment failed'):
+    return release_orders([order.id], user, reason)
+
+
+def release_orders(order_ids, user=None, reason='payment failed'):
+    '''
+    Releases the active reservations of several orders with one lock and one bulk write
+    '''
+    reservations = list(StockReservation.objects.select_for_update(of=('self',)).select_related('order')
+                        .filter(order_id__in=order_ids, status='active').order_by('product_variant_id', 'id'))
+    return _release(reservations, 'released', reason, user)
+
+
+@transaction.atomic
+def sync_stock(variant_ids, user=None, reason='stock_qty changed'):
+    '''
+    Moves the difference between ProductVariant.stock_qty and total_stock into available_stock
+
+    For variants that have an Inventory row, returns how many rows changed.
+    A stock_qty below the reserved units leaves available_stock at 0.
+    '''
+    from user.models import ProductVariant
+
+    inventories = _lock_inventory(variant_ids)
+    if not inventories:
+        return 0
+
+    stock = dict(ProductVariant.objects.filter(id__in=inventories).values_list('id', 'stock_qty'))
+    changed, logs = [], []
+    for variant_id, inventory in inventories.items():
+        previous = inventory.available_stock
+        inventory.available_stock = max(stock[variant_id] - inventory.reserved_stock, 0)
+        change = inventory.available_stock - previous
+        if change:
+            changed.append(inventory)
+            logs.append(_log(inventory, 'restock' if change > 0 else 'adjustment', change, previous,
+                             inventory.available_stock, None, user, reason))
+
+    if changed:
+        low_stock.track(changed)
+        availability.invalidate(variant_ids=[inventory.product_variant_id for inventory in changed])
+        Inventory.objects.bulk_update(changed, ['available_stock', 'low_stock'])
+        ledger.write(logs)
+    return len(changed)
+
+
+def sweep_expired(batch_size=None, now=None):
+    '''
+    Releases expired reservations in batches of `batch_size`, returns how many
+
+    Each batch is its own transaction. On postgres rows locked by a running
+    payment are skipped and picked up by the next sweep.
+    '''
+    batch_size = batch_size or _config()[1]
+    now = now or timezone.now()
+    skip_locked = connection.features.has_select_for_update_skip_locked
+    released = 0
+
+    while True:
+        with transaction.atomic():
+            batch = list(
+                StockReservation.objects
+                .select_for_update(skip_locked=skip_locked, of=('self',))
+                .select_related('order')
+                .filter(status='active', expires_at__lte=now)
+                .order_by('expires_at', 'id')[:batch_size]
+            )
+            batch.sort(key=lambda reservation: reservation.product_variant_id)
+            released += _release(batch, 'expired', 'reservation expired')
+
+        if len(batch) < batch_size:
+            return released
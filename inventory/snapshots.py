@@ -0,0 +1,194 @@
+'''
+Inventory snapshots and ledger compaction
+
+On-hand stock (Inventory.total_stock) only moves with the change types in
+ON_HAND_TYPES, 'reserved' and 'released' shift units between available and
+reserved and are left out. So the stock of a variant at time t is
+
+    latest InventorySnapshot taken at or before t
+    + quantity_change of its on-hand InventoryLog rows after snapshot.last_log_id
+
+and a read touches the rows since the last snapshot, not the whole history.
+
+take_snapshots() (daily, celery beat) writes a snapshot for every variant
+whose ledger moved since its previous one. compact() then folds log rows
+older than INVENTORY_LEDGER['RETENTION_DAYS'] that a snapshot already covers
+into one InventoryLogSummary per variant, day and change type, and moves the
+detail rows to InventoryLogArchive. A day is split where a snapshot was cut
+(its last_log_id), so a summary is either all before or all after any
+snapshot and stock_at() never adds rows the snapshot already counts. Past the retention window stock_at() is
+exact at snapshot times and day grained in between.
+'''
+import datetime
+from bisect import bisect_left
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, OuterRef, Q, Subquery, Sum
+from django.utils import timezone
+
+from . import ledger
+from .models import Inventory, InventoryLog, InventoryLogSummary, InventorySnapshot
+
+
+ON_HAND_TYPES = ('restock', 'sale', 'return', 'damage', 'adjustment')
+
+
+def _config():
+    config = getattr(settings, 'INVENTORY_LEDGER', {})
+    return (
+        config.get('RETENTION_DAYS', 90),
+        config.get('SNAPSHOT_LAG', 60),
+        config.get('BATCH_SIZE', 1000),
+    )
+
+
+def _on_hand_deltas(conditions):
+    '''
+    {variant_id: summed quantity_change} of on-hand log rows matching `conditions`
+    '''
+    rows = InventoryLog.objects \
+        .filter(conditions, change_type__in=ON_HAND_TYPES) \
+        .order_by() \
+        .values('product_variant_id') \
+        .annotate(delta=Sum('quantity_change')) \
+        .values_list('product_variant_id', 'delta')
+    return dict(rows)
+
+
+def take_snapshots(now=None, batch_size=None):
+    '''
+    Snapshots every variant with ledger rows since its last snapshot, returns how many
+
+    Log rows younger than SNAPSHOT_LAG seconds are left for the next run, so
+    a transaction that inserted a lower id but has not committed yet is not
+    skipped over.
+    '''
+    _, lag, default_batch = _config()
+    batch_size = batch_size or default_batch
+    now = now or timezone.now()
+
+    cut_id = InventoryLog.objects \
+        .filter(created_at__lte=now - datetime.timedelta(seconds=lag)) \
+        .aggregate(last=Max('id'))['last'] or 0
+
+    latest = InventorySnapshot.objects \
+        .filter(product_variant=OuterRef('product_variant')) \
+        .order_by('-taken_at', '-id')
+    inventories = Inventory.objects \
+        .annotate(snapshot_stock=Subquery(latest.values('stock')[:1]),
+                  snapshot_log_id=Subquery(latest.values('last_log_id')[:1])) \
+        .order_by('product_variant_id')
+
+    written = 0
+    last_variant = 0
+    while True:
+        batch = list(inventories.filter(product_variant_id__gt=last_variant)[:batch_size])
+        if not batch:
+            return written
+        last_variant = batch[-1].product_variant_id
+
+        known = [inventory for inventory in batch if inventory.snapshot_log_id is not None]
+        new = [inventory for inventory in batch if inventory.snapshot_log_id is None]
+
+        since = Q(pk__in=[])
+        for inventory in known:
+            since |= Q(product_variant_id=inventory.product_variant_id,
+                       id__gt=inventory.snapshot_log_id, id__lte=cut_id)
+        deltas = _on_hand_deltas(since) if known else {}
+        moved = set(InventoryLog.objects.filter(since).values_list('product_variant_id', flat=True)) if known else set()
+
+        # first snapshot of a variant: current stock minus what happened after the cut
+        after_cut = _on_hand_deltas(Q(product_variant_id__in=[i.product_variant_id for i in new], id__gt=cut_id)) \
+            if new else {}
+
+        snapshots = [
+            InventorySnapshot(
+                product_variant_id=inventory.product_variant_id,
+                stock=inventory.snapshot_stock + deltas.get(inventory.product_variant_id, 0),
+                reserved_stock=inventory.reserved_stock,
+                last_log_id=cut_id,
+                taken_at=now,
+            )
+            for inventory in known if inventory.product_variant_id in moved
+        ] + [
+            InventorySnapshot(
+                product_variant_id=inventory.product_variant_id,
+                stock=inventory.total_stock - after_cut.get(inventory.product_variant_id, 0),
+                reserved_stock=inventory.reserved_stock,
+                last_log_id=cut_id,
+                taken_at=now,
+            )
+            for inventory in new
+        ]
+        InventorySnapshot.objects.bulk_create(snapshots)
+        written += len(snapshots)
+
+
+def stock_at(variant_id, at=None):
+    '''
+    On-hand stock of a variant at time `at` (default now)
+    '''
+    at = at or timezone.now()
+    snapshot = InventorySnapshot.objects \
+        .filter(product_variant_id=variant_id, taken_at__lte=at) \
+        .order_by('-taken_at', '-id') \
+        .first()
+    stock, after_id = (snapshot.stock, snapshot.last_log_id) if snapshot else (0, 0)
+
+    detailed = InventoryLog.objects \
+        .filter(product_variant_id=variant_id, change_type__in=ON_HAND_TYPES,
+                id__gt=after_id, created_at__lte=at) \
+        .aggregate(delta=Sum('quantity_change'))['delta'] or 0
+    compacted = InventoryLogSummary.objects \
+        .filter(product_variant_id=variant_id, change_type__in=ON_HAND_TYPES,
+                last_log_id__gt=after_id, day__lt=timezone.localtime(at).date()) \
+        .aggregate(delta=Sum('quantity_change'))['delta'] or 0
+    return stock + detailed + compacted
+
+
+def compact(now=None, batch_size=None):
+    '''
+    Folds old, snapshot covered log rows into InventoryLogSummary rows, returns how many
+
+    Each batch writes its summaries, archives the detail rows and deletes
+    them in one transaction.
+    '''
+    retention_days, _, default_batch = _config()
+    batch_size = batch_size or default_batch
+    now = now or timezone.now()
+
+    covered_id = InventorySnapshot.objects.aggregate(last=Max('last_log_id'))['last'] or 0
+    old = InventoryLog.objects \
+        .filter(id__lte=covered_id, created_at__lt=now - datetime.timedelta(days=retention_days)) \
+        .order_by('id')
+
+    compacted = 0
+    while True:
+        with transaction.atomic():
+            batch = list(old[:batch_size])
+            if not batch:
+                return compacted
+
+            # snapshot cuts inside the batch, a log row with id <= cut belongs before it
+            cuts = sorted(set(InventorySnapshot.objects
+                              .filter(last_log_id__gte=batch[0].id, last_log_id__lt=batch[-1].id)
+                              .values_list('last_log_id', flat=True)))
+
+            groups = defaultdict(lambda: [0, 0, 0])
+            for log in batch:
+                group = groups[(log.product_variant_id, timezone.localtime(log.created_at).date(), log.change_type,
+                                bisect_left(cuts, log.id))]
+                group[0] += log.quantity_change
+                group[1] += 1
+                group[2] = max(group[2], log.id)
+
+            InventoryLogSummary.objects.bulk_create([
+                InventoryLogSummary(product_variant_id=variant_id, day=day, change_type=change_type,
+                                    quantity_change=change, entries=entries, last_log_id=last_id)
+                for (variant_id, day, change_type, _), (change, entries, last_id) in groups.items()
+            ])
+            ledger.archive_rows(batch)
+            InventoryLog.objects.filter(id__in=[log.id for log in batch]).delete()
+            compacted += len(batch)
@@ -0,0 +1,50 @@
+from celery import shared_task
+import logging
+
+from . import reservations
+
+logger = logging.getLogger(__name__)
+
+@shared_task
+def release_expired_reservations():
+  '''
+  returns the units of expired checkout reservations to available stock
+  '''
+  released=reservations.sweep_expired()
+  if released:
+    logger.info(f'released {released} expired stock reservations')
+  return released
+
+@shared_task
+def snapshot_inventory():
+  '''
+  writes a stock snapshot for every variant whose ledger moved since its last one
+  '''
+  from . import snapshots
+
+  written=snapshots.take_snapshots()
+  logger.info(f'wrote {written} inventory snapshots')
+  return written
+
+@shared_task
+def compact_inventory_log():
+  '''
+  folds InventoryLog rows past the retention window into daily summaries
+  '''
+  from . import snapshots
+
+  compacted=snapshots.compact()
+  if compacted:
+    logger.info(f'compacted {compacted} inventory log rows')
+  return compacted
+
+@shared_task
+def notify_low_stock(variant_ids):
+  '''
+  tells sellers that variants went at or below their low stock threshold
+  '''
+  from marketing.models import Notification
+  from . import low_stock
+
+  notifications=Notification.objects.bulk_create(low_stock.notifications_for(variant_ids))
+  return len(notifications)
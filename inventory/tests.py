@@ -1,3 +1,205 @@
-from django.test import TestCase
+import datetime
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.test import TestCase,override_settings
+from django.utils import timezone
+from kombu.exceptions import OperationalError
+from rest_framework.test import APIClient
+
+from api.models import User
+from marketing.models import Notification
+from user import models as user_models
+from inventory import reservations,snapshots
+from inventory.models import Inventory,InventoryLog,InventoryLogSummary,InventorySnapshot,Seller,StockReservation
+from user.stock import InsufficientStock
+
+
+LOCMEM_CACHES={'default':{'BACKEND':'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def make_variant(stock_qty=5,low_stock_threshold=None):
+    '''
+    a product with one variant, and an Inventory row when low_stock_threshold is given
+    '''
+    seller_user=User.objects.create_user('seller','seller@example.com','pw',role_model='seller')
+    seller=Seller.objects.create(user=seller_user,business_name='seller',gst_number='GST1')
+    product=user_models.Product.objects.create(
+        seller=seller,name='phone',base_price=100,stock_qty=stock_qty,sku='P1',
+        category=user_models.Category.objects.create(name='phones'),
+        brand=user_models.Brand.objects.create(name='samsung'))
+    variant=user_models.ProductVariant.objects.create(product=product,color='blue',size='m',price=90,
+                                                      stock_qty=stock_qty,sku='V1')
+    if low_stock_threshold is not None:
+        Inventory.objects.create(product_variant=variant,available_stock=stock_qty,
+                                 low_stock_threshold=low_stock_threshold)
+    return variant
+
+
+def make_order(variant,quantity,number):
+    '''
+    an unpaid order with one line of `variant`
+    '''
+    buyer,_=User.objects.get_or_create(username='buyer',defaults={'email':'buyer@example.com','role_model':'buyer'})
+    order=user_models.Order.objects.create(user=buyer,order_number=number,subtotal=0,total_amount=0)
+    user_models.OrderItem.objects.create(order=order,product=variant.product,product_variant=variant,
+                                         quantity=quantity,unit_price=1,total_price=quantity)
+    return order
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ReservationTest(TestCase):
+    '''
+    reservations: available and reserved stock through reserve, release, expiry, payment and restock
+    '''
+
+    def setUp(self):
+        cache.clear()
+        self.variant=make_variant(stock_qty=10)
+
+    def stock(self):
+        inventory=Inventory.objects.get(product_variant=self.variant)
+        return inventory.available_stock,inventory.reserved_stock
+
+    def test_reserve_and_release(self):
+        order=make_order(self.variant,4,'O1')
+        reservations.reserve(order)
+        self.assertEqual(self.stock(),(6,4))
+
+        self.assertEqual(reservations.release_order(order),1)
+        self.assertEqual(self.stock(),(10,0))
+        self.assertEqual(StockReservation.objects.get(order=order).status,'released')
+        # the first reserve() seeds the Inventory row with an 'adjustment'
+        self.assertEqual(list(InventoryLog.objects.exclude(change_type='adjustment').order_by('id').values_list('change_type','quantity_change')),
+                         [('reserved',-4),('released',4)])
+
+        # nothing left to release
+        self.assertEqual(reservations.release_order(order),0)
+        self.assertEqual(self.stock(),(10,0))
+
+    def test_expired_reservation_paid_after_the_sweep(self):
+        order=make_order(self.variant,4,'O1')
+        reservations.reserve(order,ttl=0)
+        self.assertEqual(reservations.sweep_expired(now=timezone.now()+datetime.timedelta(seconds=1)),1)
+        self.assertEqual(self.stock(),(10,0))
+        self.assertEqual(StockReservation.objects.get(order=order).status,'expired')
+
+        # the units come out of available_stock again
+        reservations.commit_order(order)
+        self.assertEqual(self.stock(),(6,0))
+        self.assertEqual(InventoryLog.objects.latest('id').change_type,'sale')
+
+    def test_expired_reservation_paid_after_the_units_were_taken(self):
+        order=make_order(self.variant,4,'O1')
+        reservations.reserve(order,ttl=0)
+        reservations.sweep_expired(now=timezone.now()+datetime.timedelta(seconds=1))
+        reservations.reserve(make_order(self.variant,8,'O2'))
+
+        with self.assertRaises(InsufficientStock) as raised:
+            reservations.commit_order(order)
+        self.assertEqual([(line.variant_id,line.quantity) for line in raised.exception.failed],[(self.variant.id,4)])
+        self.assertEqual(self.stock(),(2,8))
+
+    def test_reserve_is_all_or_nothing(self):
+        reservations.reserve(make_order(self.variant,7,'O1'))
+
+        with self.assertRaises(InsufficientStock) as raised:
+            reservations.reserve(make_order(self.variant,4,'O2'))
+        self.assertEqual([(line.variant_id,line.quantity) for line in raised.exception.failed],[(self.variant.id,4)])
+        self.assertEqual(self.stock(),(3,7))
+        self.assertEqual(StockReservation.objects.count(),1)
+
+    def test_sync_stock_below_reserved(self):
+        reservations.reserve(make_order(self.variant,6,'O1'))
+
+        # a seller corrects stock_qty to fewer units than are reserved
+        user_models.ProductVariant.objects.filter(id=self.variant.id).update(stock_qty=4)
+        self.assertEqual(reservations.sync_stock([self.variant.id]),1)
+        self.assertEqual(self.stock(),(0,6))
+        self.assertEqual(InventoryLog.objects.latest('id').change_type,'adjustment')
+
+        # and back up: available follows stock_qty minus what is reserved
+        user_models.ProductVariant.objects.filter(id=self.variant.id).update(stock_qty=9)
+        self.assertEqual(reservations.sync_stock([self.variant.id]),1)
+        self.assertEqual(self.stock(),(3,6))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class LowStockBrokerDownTest(TestCase):
+    '''
+    an order that takes a variant below its threshold while the broker is down
+    '''
+
+    def setUp(self):
+        cache.clear()
+        self.variant=make_variant(stock_qty=5)
+        self.buyer=User.objects.create_user('buyer','buyer@example.com','pw',role_model='buyer')
+        address=user_models.Address.objects.create(user=self.buyer,city='c',state='s',country='in',phone_number='1')
+        self.client=APIClient()
+        self.client.force_authenticate(self.buyer)
+        self.body={
+            'shipping_address':address.id,
+            'billing_address':address.id,
+            'items':[{'product':self.variant.product_id,'product_variant':self.variant.id,'quantity':1}],
+        }
+
+    def place_order(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/user/order/',self.body,format='json',HTTP_IDEMPOTENCY_KEY='order-1')
+
+    @mock.patch('inventory.tasks.notify_low_stock.delay',side_effect=OperationalError('broker down'))
+    def test_order_is_placed_once_and_sellers_are_told(self,delay):
+        response=self.place_order()
+
+        self.assertEqual(response.status_code,201)
+        self.assertTrue(delay.called)
+        self.assertEqual(user_models.Order.objects.count(),1)
+        # written in process instead of by the worker
+        self.assertEqual(Notification.objects.filter(notification_type='product_restock').count(),1)
+
+        # the Idempotency-Key was kept, the retry is a replay
+        retry=self.place_order()
+        self.assertEqual(retry.status_code,201)
+        self.assertEqual(retry['Idempotent-Replayed'],'true')
+        self.assertEqual(user_models.Order.objects.count(),1)
+
+
+class CompactionTest(TestCase):
+    '''
+    snapshots.compact() / stock_at() around a snapshot cut in the middle of a day
+    '''
+
+    def setUp(self):
+        self.variant=make_variant(stock_qty=100)
+        self.now=timezone.now()
+        self.day=timezone.localtime(self.now-datetime.timedelta(days=200)).replace(hour=0,minute=0,second=0,microsecond=0)
+
+    def at(self,days=0,hours=0):
+        return self.day+datetime.timedelta(days=days,hours=hours)
+
+    def log(self,change,created_at):
+        log=InventoryLog.objects.create(product_variant=self.variant,change_type='sale',quantity_change=change,
+                                        previous_quantity=0,new_quantity=0)
+        InventoryLog.objects.filter(id=log.id).update(created_at=created_at)
+        return log
+
+    def snapshot(self,stock,log,taken_at):
+        InventorySnapshot.objects.create(product_variant=self.variant,stock=stock,reserved_stock=0,
+                                         last_log_id=log.id,taken_at=taken_at)
+
+    def test_snapshot_cut_mid_day_is_not_counted_twice(self):
+        morning=self.log(-5,self.at(hours=10))
+        self.snapshot(95,morning,self.at(hours=12))
+        afternoon=self.log(-10,self.at(hours=14))
+        self.snapshot(85,afternoon,self.at(days=5))
+
+        self.assertEqual(snapshots.stock_at(self.variant.id,self.at(days=1,hours=1)),85)
+
+        self.assertEqual(snapshots.compact(now=self.now),2)
+        self.assertFalse(InventoryLog.objects.exists())
+        # one summary on each side of the noon snapshot
+        self.assertEqual(sorted(InventoryLogSummary.objects.values_list('quantity_change',flat=True)),[-10,-5])
+
+        self.assertEqual(snapshots.stock_at(self.variant.id,self.at(days=1,hours=1)),85)
+        self.assertEqual(snapshots.stock_at(self.variant.id,self.at(hours=13)),95)
+        self.assertEqual(snapshots.stock_at(self.variant.id,self.at(days=6)),85)
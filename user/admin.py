@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Payment,Product,Brand,Category,ProductVariant,ProductImage,Review,Order,OrderItem
+from .models import Payment,Product,Brand,Category,ProductVariant,ProductImage,Review,Order,OrderItem,WebhookEvent
 from inventory import models
 
 
@@ -11,4 +11,5 @@ admin.site.register(ProductVariant)
 admin.site.register(ProductImage)
 admin.site.register(Review)
 admin.site.register(Order)
-admin.site.register(OrderItem)
\ No newline at end of file
+admin.site.register(OrderItem)
+admin.site.register(WebhookEvent)
\ No newline at end of file
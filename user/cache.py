@@ -0,0 +1,215 @@
+'''
+Product detail cache
+
+Read-through cache for ProductDetailView payloads.
+
+Entries are keyed by product id plus a per-product version counter and a
+catalog version. Writes to a product (or its variants, images, reviews,
+questions) bump the product's version, renaming a brand, a category or a
+seller bumps the catalog version (the payload embeds their names), both
+from signals.py. Older entries are never read again and simply age out of
+the backend.
+
+Backends:
+    django : a Django cache alias, shared by all workers when it is redis (default)
+    lru    : in-process LRU, one per worker. Writes handled by another worker
+             are not seen, only fit for a single process (runserver, tests)
+'''
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+class LRUBackend:
+    '''
+    Bounded in-process LRU with per-entry expiry.
+
+    Version counters are kept apart from the entries and bounded to
+    max_versions. Versions are drawn from one increasing counter and an
+    evicted key reads as a floor raised past every version handed out so
+    far, so eviction can never reset a product back to an older version.
+    '''
+
+    def __init__(self, max_entries=1024, max_versions=None):
+        self.max_entries = max_entries
+        self.max_versions = max_versions or max_entries * 4
+        self._entries = OrderedDict()
+        self._versions = OrderedDict()
+        self._counter = 0
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        expires_at = time.monotonic() + timeout if timeout else None
+        with self._lock:
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_versions(self, keys):
+        with self._lock:
+            return [self._versions.get(key, self._floor) for key in keys]
+
+    def incr_version(self, key):
+        with self._lock:
+            self._counter += 1
+            self._versions[key] = self._counter
+            self._versions.move_to_end(key)
+            if len(self._versions) > self.max_versions:
+                self._versions.popitem(last=False)
+                # the evicted key now reads as the floor, above any version it had
+                self._counter += 1
+                self._floor = self._counter
+            return self._counter
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._versions.clear()
+            # entries are gone, counters keep increasing
+            self._counter += 1
+            self._floor = self._counter
+
+
+class DjangoCacheBackend:
+    '''
+    Wraps a Django cache alias so every worker shares entries and versions
+    '''
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    @property
+    def cache(self):
+        # caches[] hands out one instance per thread, it must not be kept across threads
+        return caches[self.alias]
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, value, timeout=None):
+        self.cache.set(key, value, timeout)
+
+    def get_versions(self, keys):
+        found = self.cache.get_many(keys)
+        return [found.get(key, 0) for key in keys]
+
+    def incr_version(self, key):
+        # version keys never expire, add() is a no-op when the key exists
+        self.cache.add(key, 0, None)
+        return self.cache.incr(key)
+
+    def clear(self):
+        self.cache.clear()
+
+
+class ProductDetailCache:
+    '''
+    Versioned read-through cache with hit/miss counters (reported by /api/metrics/)
+    '''
+
+    def __init__(self, backend, timeout=300):
+        self.backend = backend
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    CATALOG_VERSION_KEY = 'product_detail:catalog:version'
+
+    def _version_key(self, product_id):
+        return f'product_detail:{product_id}:version'
+
+    def _entry_key(self, product_id, version, catalog_version, variant):
+        return f'product_detail:{product_id}:v{version}.{catalog_version}:{variant}'
+
+    def bump(self, product_id):
+        return self.backend.incr_version(self._version_key(product_id))
+
+    def bump_catalog(self):
+        '''
+        Invalidates every product, for writes shared by many of them (brand, category, seller names)
+        '''
+        return self.backend.incr_version(self.CATALOG_VERSION_KEY)
+
+    def get_or_set(self, product_id, loader, variant=''):
+        '''
+        Returns the cached payload for a product, calling loader() on a miss
+
+        variant separates payloads that differ per request (absolute urls
+        depend on the host the request came in on)
+        '''
+        version, catalog_version = self.backend.get_versions(
+            [self._version_key(product_id), self.CATALOG_VERSION_KEY])
+        key = self._entry_key(product_id, version, catalog_version, variant)
+
+        payload = self.backend.get(key)
+        if payload is not None:
+            self._count(hit=True)
+            return payload, True
+
+        self._count(hit=False)
+        payload = loader()
+        self.backend.set(key, payload, self.timeout)
+        return payload, False
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else 0.0,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+
+
+_product_cache = None
+_product_cache_lock = threading.Lock()
+
+
+def get_product_cache():
+    '''
+    Builds the process wide ProductDetailCache from settings.PRODUCT_DETAIL_CACHE
+    '''
+    global _product_cache
+
+    if _product_cache is None:
+        with _product_cache_lock:
+            if _product_cache is None:
+                config = getattr(settings, 'PRODUCT_DETAIL_CACHE', {})
+
+                if config.get('BACKEND', 'django') == 'lru':
+                    backend = LRUBackend(config.get('MAX_ENTRIES', 1024), config.get('MAX_VERSIONS'))
+                else:
+                    backend = DjangoCacheBackend(config.get('ALIAS', 'default'))
+
+                _product_cache = ProductDetailCache(backend, config.get('TIMEOUT', 300))
+    return _product_cache
@@ -0,0 +1,432 @@
+'''
+Cart storage
+
+CartItem (cart_views.py) reads and writes cart lines through a cart store,
+so the hot add/patch/delete path can be moved off the primary database
+without changing the API.
+
+Backends (settings.CART_STORAGE['BACKEND']):
+    database : Cart/CartItem rows, the default
+    redis    : one redis hash per user, written to Cart/CartItem only on
+               idle flush (tasks.flush_idle_carts) and dropped at checkout
+    local    : in-process stand-in with the redis semantics, for development
+               and single process setups
+
+Hash layout: key "cart:<user id>", field "<product id>:<variant id or 0>",
+value quantity. A "~" field marks a hash that was loaded from the database,
+so an empty cart is not reloaded on every read.
+'''
+import threading
+import time
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import DecimalField,ExpressionWrapper,F,prefetch_related_objects
+from django.db.models.functions import Coalesce
+
+from . import models
+
+
+LOADED_FIELD = '~'
+TOUCHED_KEY = 'cart:touched'
+
+ITEM_SELECT_RELATED = ('product_variant', 'product__category', 'product__brand', 'product__seller__user')
+ITEM_PREFETCH_RELATED = ('product__images', 'product__variants', 'product__reviews')
+
+PRICE_FIELD = DecimalField(max_digits=12, decimal_places=2)
+
+
+def _field(product_id, variant_id):
+    return f'{int(product_id)}:{int(variant_id or 0)}'
+
+
+def _parse_field(field):
+    product_id, variant_id = field.split(':')
+    return int(product_id), int(variant_id) or None
+
+
+def _line_order(line):
+    # hash fields have no order, keep pages stable
+    (product_id, variant_id), _ = line
+    return product_id, variant_id or 0
+
+
+class DatabaseCartStore:
+    '''
+    Cart lines stored as Cart/CartItem rows
+    '''
+
+    def items(self, user):
+        # everything the nested serializers touch is joined or prefetched up front,
+        # so the query count does not grow with the number of items or reviews
+        return models.CartItem.objects \
+            .filter(cart__user=user) \
+            .select_related(*ITEM_SELECT_RELATED) \
+            .prefetch_related(*ITEM_PREFETCH_RELATED) \
+            .order_by('added_at', 'id')
+
+    def priced_lines(self, user):
+        '''
+        Cart lines with unit_price and line_total, in one query
+        '''
+        lines = models.CartItem.objects \
+            .filter(cart__user=user) \
+            .annotate(
+                unit_price=Coalesce('product_variant__price', 'product__base_price', output_field=PRICE_FIELD),
+            ) \
+            .annotate(
+                line_total=ExpressionWrapper(F('unit_price') * F('quantity'), output_field=PRICE_FIELD),
+            ) \
+            .order_by('added_at', 'id') \
+            .values('product', 'product_variant', 'quantity', 'unit_price', 'line_total')
+        return list(lines)
+
+    def lines(self, user):
+        rows = models.CartItem.objects.filter(cart__user=user) \
+            .values_list('product_id', 'product_variant_id', 'quantity')
+        return {(product_id, variant_id): quantity for product_id, variant_id, quantity in rows}
+
+    def get(self, user, product_id, variant_id=None):
+        return models.CartItem.objects.filter(
+            cart__user=user,
+            product_id=product_id,
+            product_variant_id=variant_id or None,
+        ).values_list('quantity', flat=True).first()
+
+    def set(self, user, product_id, variant_id, quantity):
+        cart, _ = models.Cart.objects.get_or_create(user=user)
+        models.CartItem.objects.update_or_create(
+            cart=cart,
+            product_id=product_id,
+            product_variant_id=variant_id or None,
+            defaults={'quantity': quantity},
+        )
+
+    def remove(self, user, product_id, variant_id=None):
+        deleted, _ = models.CartItem.objects.filter(
+            cart__user=user,
+            product_id=product_id,
+            product_variant_id=variant_id or None,
+        ).delete()
+        return deleted > 0
+
+    def apply(self, user, changes):
+        '''
+        Applies {(product_id, variant_id): quantity} in one transaction,
+        a quantity of 0 removes the line
+        '''
+        with transaction.atomic():
+            cart, _ = models.Cart.objects.get_or_create(user=user)
+            existing = {
+                (item.product_id, item.product_variant_id): item
+                for item in models.CartItem.objects.select_for_update().filter(cart=cart)
+            }
+
+            to_create, to_update, to_delete = [], [], []
+            for (product_id, variant_id), quantity in changes.items():
+                item = existing.get((product_id, variant_id))
+                if quantity <= 0:
+                    if item is not None:
+                        to_delete.append(item.id)
+                elif item is None:
+                    to_create.append(models.CartItem(cart=cart, product_id=product_id,
+                                                     product_variant_id=variant_id, quantity=quantity))
+                elif item.quantity != quantity:
+                    item.quantity = quantity
+                    to_update.append(item)
+
+            if to_delete:
+                models.CartItem.objects.filter(id__in=to_delete).delete()
+            if to_update:
+                models.CartItem.objects.bulk_update(to_update, ['quantity'])
+            if to_create:
+                models.CartItem.objects.bulk_create(to_create)
+
+    def clear(self, user):
+        models.CartItem.objects.filter(cart__user=user).delete()
+
+    def flush_idle(self, idle_seconds):
+        return 0
+
+
+class LocalHash:
+    '''
+    In-process stand-in for the handful of redis commands HashCartStore uses
+    '''
+
+    def __init__(self):
+        self._hashes = {}
+        self._touched = {}
+        self._lock = threading.Lock()
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._hashes.get(key, {}))
+
+    def hget(self, key, field):
+        with self._lock:
+            return self._hashes.get(key, {}).get(field)
+
+    def hset(self, key, mapping):
+        with self._lock:
+            self._hashes.setdefault(key, {}).update({f: str(v) for f, v in mapping.items()})
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            data = self._hashes.get(key, {})
+            return sum(1 for field in fields if data.pop(field, None) is not None)
+
+    def exists(self, key):
+        with self._lock:
+            return key in self._hashes
+
+    def delete(self, key):
+        with self._lock:
+            self._hashes.pop(key, None)
+
+    def delete_if_unchanged(self, key, snapshot):
+        with self._lock:
+            if self._hashes.get(key, {}) != snapshot:
+                return False
+            self._hashes.pop(key, None)
+            return True
+
+    def touch(self, member, when):
+        with self._lock:
+            self._touched[member] = when
+
+    def untouch(self, member):
+        with self._lock:
+            self._touched.pop(member, None)
+
+    def idle(self, before):
+        with self._lock:
+            return [member for member, when in self._touched.items() if when <= before]
+
+
+class RedisHash:
+    '''
+    Same interface as LocalHash on top of a redis client
+    '''
+
+    def __init__(self, url):
+        import redis  # only needed when the redis backend is configured
+
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+
+    def hgetall(self, key):
+        return self.client.hgetall(key)
+
+    def hget(self, key, field):
+        return self.client.hget(key, field)
+
+    def hset(self, key, mapping):
+        self.client.hset(key, mapping=mapping)
+
+    def hdel(self, key, *fields):
+        return self.client.hdel(key, *fields)
+
+    def exists(self, key):
+        return bool(self.client.exists(key))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def delete_if_unchanged(self, key, snapshot):
+        import redis
+
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if pipe.hgetall(key) != snapshot:
+                    return False
+                pipe.multi()
+                pipe.delete(key)
+                pipe.execute()
+                return True
+            except redis.WatchError:
+                return False
+
+    def touch(self, member, when):
+        self.client.zadd(TOUCHED_KEY, {member: when})
+
+    def untouch(self, member):
+        self.client.zrem(TOUCHED_KEY, member)
+
+    def idle(self, before):
+        return self.client.zrangebyscore(TOUCHED_KEY, 0, before)
+
+
+class HashCartStore:
+    '''
+    Cart lines kept in a per-user hash, persisted to Cart/CartItem on idle flush
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _key(self, user_id):
+        return f'cart:{user_id}'
+
+    def _load(self, user):
+        '''
+        Returns the hash for a user, seeding it from Cart/CartItem on first use
+        '''
+        key = self._key(user.id)
+        data = self.backend.hgetall(key)
+        if data:
+            return data
+
+        data = {_field(p, v): str(q) for (p, v), q in DatabaseCartStore().lines(user).items()}
+        data[LOADED_FIELD] = '1'
+        self.backend.hset(key, data)
+        return data
+
+    def _touch(self, user):
+        self.backend.touch(str(user.id), time.time())
+
+    def lines(self, user):
+        return {
+            _parse_field(field): int(quantity)
+            for field, quantity in self._load(user).items()
+            if field != LOADED_FIELD
+        }
+
+    def items(self, user):
+        '''
+        Unsaved CartItem objects with the same relations loaded as the database store
+        '''
+        lines = self.lines(user)
+        cart_id = models.Cart.objects.filter(user=user).values_list('id', flat=True).first()
+
+        products = models.Product.objects \
+            .select_related('category', 'brand', 'seller__user') \
+            .in_bulk({product_id for product_id, _ in lines})
+        variants = models.ProductVariant.objects.in_bulk({v for _, v in lines if v})
+
+        items = [
+            models.CartItem(
+                cart_id=cart_id,
+                product=products[product_id],
+                product_variant=variants.get(variant_id),
+                quantity=quantity,
+            )
+            for (product_id, variant_id), quantity in sorted(lines.items(), key=_line_order)
+            if product_id in products
+        ]
+        prefetch_related_objects([item.product for item in items],
+                                 *[p.split('__', 1)[1] for p in ITEM_PREFETCH_RELATED])
+        return items
+
+    def priced_lines(self, user):
+        lines = self.lines(user)
+        base_prices = dict(models.Product.objects
+                           .filter(id__in={product_id for product_id, _ in lines})
+                           .values_list('id', 'base_price'))
+        variant_prices = dict(models.ProductVariant.objects
+                              .filter(id__in={v for _, v in lines if v})
+                              .values_list('id', 'price'))
+
+        result = []
+        for (product_id, variant_id), quantity in sorted(lines.items(), key=_line_order):
+            if product_id not in base_prices:
+                continue
+            unit_price = variant_prices.get(variant_id, base_prices[product_id])
+            result.append({
+                'product': product_id,
+                'product_variant': variant_id,
+                'quantity': quantity,
+                'unit_price': unit_price,
+                'line_total': unit_price * quantity,
+            })
+        return result
+
+    def get(self, user, product_id, variant_id=None):
+        self._load(user)
+        quantity = self.backend.hget(self._key(user.id), _field(product_id, variant_id))
+        return int(quantity) if quantity is not None else None
+
+    def set(self, user, product_id, variant_id, quantity):
+        self._load(user)
+        self.backend.hset(self._key(user.id), {_field(product_id, variant_id): quantity})
+        self._touch(user)
+
+    def remove(self, user, product_id, variant_id=None):
+        self._load(user)
+        removed = self.backend.hdel(self._key(user.id), _field(product_id, variant_id))
+        self._touch(user)
+        return removed > 0
+
+    def apply(self, user, changes):
+        self._load(user)
+        key = self._key(user.id)
+        to_set = {_field(p, v): quantity for (p, v), quantity in changes.items() if quantity > 0}
+        to_delete = [_field(p, v) for (p, v), quantity in changes.items() if quantity <= 0]
+        if to_set:
+            self.backend.hset(key, to_set)
+        if to_delete:
+            self.backend.hdel(key, *to_delete)
+        self._touch(user)
+
+    def clear(self, user):
+        self.backend.delete(self._key(user.id))
+        self.backend.untouch(str(user.id))
+        models.CartItem.objects.filter(cart__user=user).delete()
+
+    def persist(self, user_id, data):
+        '''
+        Replaces the user's CartItem rows with the lines of a hash snapshot
+        '''
+        lines = {_parse_field(f): int(q) for f, q in data.items() if f != LOADED_FIELD}
+
+        with transaction.atomic():
+            cart, _ = models.Cart.objects.get_or_create(user_id=user_id)
+            models.CartItem.objects.filter(cart=cart).delete()
+            models.CartItem.objects.bulk_create([
+                models.CartItem(cart=cart, product_id=product_id,
+                                product_variant_id=variant_id, quantity=quantity)
+                for (product_id, variant_id), quantity in lines.items()
+            ])
+
+    def flush_idle(self, idle_seconds):
+        '''
+        Writes carts untouched for idle_seconds to the database and drops them
+        from the hash store, returns how many were flushed
+        '''
+        flushed = 0
+        for member in self.backend.idle(time.time() - idle_seconds):
+            key = self._key(member)
+            data = self.backend.hgetall(key)
+            if data:
+                self.persist(int(member), data)
+                # a write that raced the flush keeps the hash, it is flushed next round
+                if not self.backend.delete_if_unchanged(key, data):
+                    continue
+            self.backend.untouch(member)
+            flushed += 1
+        return flushed
+
+
+_cart_store = None
+_cart_store_lock = threading.Lock()
+
+
+def get_cart_store():
+    '''
+    Builds the process wide cart store from settings.CART_STORAGE
+    '''
+    global _cart_store
+
+    if _cart_store is None:
+        with _cart_store_lock:
+            if _cart_store is None:
+                config = getattr(settings, 'CART_STORAGE', {})
+                backend = config.get('BACKEND', 'database')
+
+                if backend == 'redis':
+                    _cart_store = HashCartStore(RedisHash(config.get('URL', 'redis://localhost:6379/3')))
+                elif backend == 'local':
+                    _cart_store = HashCartStore(LocalHash())
+                else:
+                    _cart_store = DatabaseCartStore()
+    return _cart_store
@@ -5,8 +5,11 @@ from rest_framework.permissions import IsAuthenticated,AllowAny,IsAdminUser
 
 from .permissions import IsBuyer,IsSeller,IsSellerOrReadOnly,IsProductOwner,IsAdminOrReadonly
 from django.db.models import Q
+from decimal import Decimal
 from . import models
 from . import serializers
+from .cart_store import get_cart_store
+from inventory import availability
 from api.pagination import StandardPagination,LimitOffsetPagination,ProductCursorPagination
 
 from django.shortcuts import get_object_or_404
@@ -21,6 +24,9 @@ class CartItem(APIView):
         - Add Products to cart
         - Remove products from cart
         - Update the quantity
+
+    cart lines are read and written through the configured cart store
+    (settings.CART_STORAGE, see cart_store.py)
     '''
 
     permission_classes=[IsBuyer]
@@ -77,9 +83,7 @@ class CartItem(APIView):
         ]
             ```
         '''
-        # retrives cart if Exists else creates a New one
-        cart=models.Cart.objects.get_or_create(user=self.request.user)
-        cartitem=models.CartItem.objects.filter(Q(cart__user=cart[0].user))
+        cartitem=get_cart_store().items(request.user)
 
         paginator=StandardPagination()
         result_page=paginator.paginate_queryset(cartitem,request)
@@ -116,55 +120,45 @@ class CartItem(APIView):
         if quantity <=0:
               return Response({"error":"quantity should be positive"},status=400)
 
-        # create a Cart object if does not exits
-        cart,_=models.Cart.objects.get_or_create(user=request.user)
-        
-        try:
-            # if cart item already exists update it
-            cart_item=models.CartItem.objects.get(
-                cart=cart,
-                product_id=product_id,
-                product_variant_id=variant_id if variant_id else None
-                )
-            
-            if cart_item:
-                cart_item.quantity+=quantity
-
-                if cart_item.product_variant:
-                    available_stock=cart_item.product_variant.stock_qty
-                else :
-                    available_stock=cart_item.product.stock_qty
-
-                if cart_item.quantity>available_stock:
-                    return Response(
-                        {"error":f'only {available_stock} are available'}
-                        ,status=status.HTTP_400_BAD_REQUEST
-                    )
-                cart_item.save()
-                serializer=serializers.CartItemCreateSerializers(cart_item)
+        store=get_cart_store()
+        current=store.get(request.user,product_id,variant_id)
+
+        # if cart item already exists update it
+        if current is not None:
+            quantity+=current
 
+            available_stock=_available_stock(product_id,variant_id)
+            if quantity>available_stock:
                 return Response(
-                {
-                    "message": "Cart updated", 
-                    "item": serializer.data
-                },
-                status=status.HTTP_200_OK
-            )
+                    {"error":f'only {available_stock} are available'}
+                    ,status=status.HTTP_400_BAD_REQUEST
+                )
+            store.set(request.user,product_id,variant_id,quantity)
+            serializer=serializers.CartItemCreateSerializers(
+                models.CartItem(product_id=product_id,product_variant_id=variant_id or None,quantity=quantity))
+
+            return Response(
+            {
+                "message": "Cart updated", 
+                "item": serializer.data
+            },
+            status=status.HTTP_200_OK
+        )
 
         #if cart item does not exists add it 
-        except models.CartItem.DoesNotExist:
-                
-                serializer=serializers.CartItemCreateSerializers(data=request.data,
-                                                                 context={'request':request})
-                
-                if serializer.is_valid():
-                    serializer.save()
-
-                    return Response(
-                    {"message": "Item added", "item":serializer.data},
-                    status=status.HTTP_201_CREATED)
+        serializer=serializers.CartItemCreateSerializers(data=request.data,
+                                                         context={'request':request})
+        
+        if serializer.is_valid():
+            variant=serializer.validated_data.get('product_variant')
+            store.set(request.user,serializer.validated_data['product'].id,
+                      variant.id if variant else None,serializer.validated_data['quantity'])
+
+            return Response(
+            {"message": "Item added", "item":serializer.data},
+            status=status.HTTP_201_CREATED)
             
-        return Response(serializer.error_messages,status=status.HTTP_400_BAD_REQUEST)
+        return Response(serializer.errors,status=status.HTTP_400_BAD_REQUEST)
     
     def patch(self,request):
         '''
@@ -238,43 +232,32 @@ class CartItem(APIView):
                 {'error':"invalid quantity"}
             )
          
-        cart=get_object_or_404(models.Cart,user=request.user)
-      
-        try:
-            # updates the existing cart item if exists 
-            cart_item=models.CartItem.objects.get(
-                cart=cart,
-                product_id=product_id,
-                product_variant_id=variant_id if variant_id else None
-                )
-            
-        except models.CartItem.DoesNotExist:
+        store=get_cart_store()
+
+        # updates the existing cart item if exists 
+        if store.get(request.user,product_id,variant_id) is None:
             return Response(
                 {"error": "Item not found in cart"}, 
                 status=status.HTTP_404_NOT_FOUND
             )
         
         if quantity<0:
-            cart_item.delete()
+            store.remove(request.user,product_id,variant_id)
             return Response({"message": "Item removed from cart"},
                 status=status.HTTP_200_OK
             )
         
-
-        if cart_item.product_variant:
-            available_stock=cart_item.product_variant.stock_qty
-        else :
-            available_stock=cart_item.product.stock_qty
-
-        if cart_item.quantity>available_stock:
+        available_stock=_available_stock(product_id,variant_id)
+        if quantity>available_stock:
             return Response(
-                {"error":f'only {available_stock} are available'}
+                {"error":f'only {available_stock} are available'},
+                status=status.HTTP_400_BAD_REQUEST
             )
         
         #updates the cart item quantity
-        cart_item.quantity = quantity
-        cart_item.save()
-        serializer=serializers.CartItemCreateSerializers(cart_item)
+        store.set(request.user,product_id,variant_id,quantity)
+        serializer=serializers.CartItemCreateSerializers(
+            models.CartItem(product_id=product_id,product_variant_id=variant_id or None,quantity=quantity))
 
         return Response(
         {
@@ -303,32 +286,229 @@ class CartItem(APIView):
                 {"error": "Product ID is required"}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
-        cart = get_object_or_404(models.Cart, user=request.user)
-        
-        try:
-            # if cartitem exists delete it 
-            cart_item = models.CartItem.objects.get(
-                cart=cart,
-                product_id=product_id,
-                product_variant_id=variant_id if variant_id and variant_id != "0" else None
-            )
-            cart_item.delete()
-            
+        # if cartitem exists delete it 
+        removed=get_cart_store().remove(
+            request.user,
+            product_id,
+            variant_id if variant_id and variant_id not in ("0","None") else None
+        )
+
+        if removed:
             return Response(
                 {"message": "Item removed from cart"},
                 status=status.HTTP_200_OK
             )
             
-        except models.CartItem.DoesNotExist:
-            return Response(
-                {"error": "Item not found in cart"}, 
-                status=status.HTTP_404_NOT_FOUND
-            )
+        return Response(
+            {"error": "Item not found in cart"}, 
+            status=status.HTTP_404_NOT_FOUND
+        )
 
               
 cartitem_view=CartItem.as_view()
 
 
+def _available_stock(product_id,variant_id):
+    '''
+    sellable quantity of the variant when one is selected, otherwise of the product
+    '''
+    return availability.sellable(product_id,variant_id) or 0
+
+
+class CartSummaryView(APIView):
+    '''
+    Cart Summary API
+
+    Allows Authenticated customers to:
+        - get item count, line prices and subtotal of their cart
+
+    cheap enough for a header badge on every page load:
+    one query, no product payloads
+    '''
+
+    permission_classes=[IsBuyer]
+
+    def get(self,request):
+        '''
+        Returns the cart totals computed on the server
+
+        Note:
+            unit_price is the variant price when a variant is selected,
+            otherwise the product base_price
+
+        Response:
+            200 OK : cart summary
+            ```json
+            {
+                "items": 1,
+                "quantity": 2,
+                "lines": [
+                    {
+                        "product": 1,
+                        "product_variant": 12,
+                        "quantity": 2,
+                        "unit_price": 123455.0,
+                        "line_total": 246910.0
+                    }
+                ],
+                "subtotal": 246910.0
+            }
+            ```
+        '''
+        lines=get_cart_store().priced_lines(request.user)
+
+        return Response({
+            'items':len(lines),
+            'quantity':sum(line['quantity'] for line in lines),
+            'lines':lines,
+            'subtotal':sum((line['line_total'] for line in lines),Decimal('0')),
+        },status=status.HTTP_200_OK)
+
+cart_summary_view=CartSummaryView.as_view()
+
+
+class CartBatchView(APIView):
+    '''
+    Cart Batch API
+
+    Allows Authenticated customers to:
+        - add, set and remove many cart items in one request
+        - merge a guest cart into their cart after login (one round trip)
+
+    stock for every operation is checked with one availability lookup and the
+    changes are applied together, either all operations succeed or none do
+    '''
+
+    permission_classes=[IsBuyer]
+
+    OPERATIONS=('add','set','remove')
+    MAX_OPERATIONS=100
+
+    def post(self,request):
+        '''
+        Applies a list of cart operations in order
+
+        Request body:
+        ```json
+        {
+            "merge": false,
+            "operations": [
+                {"op": "add", "product": 1, "product_variant": 12, "quantity": 2},
+                {"op": "set", "product": 4, "quantity": 1},
+                {"op": "remove", "product": 7, "product_variant": 3}
+            ]
+        }
+        ```
+
+        Note:
+            - add    : increases the quantity (creates the item if missing)
+            - set    : replaces the quantity, 0 removes the item
+            - remove : removes the item
+            - merge  : when true, quantities above the available stock are
+                       capped instead of rejected (use it to merge a guest cart)
+
+        Responses:
+            200 OK : cart updated
+            ```json
+            {
+                "message": "Cart updated",
+                "items": [
+                    {"product": 1, "product_variant": 12, "quantity": 2},
+                    {"product": 4, "product_variant": null, "quantity": 1}
+                ],
+                "removed": [
+                    {"product": 7, "product_variant": 3}
+                ]
+            }
+            ```
+            400 Bad request : validation error, nothing is applied
+            ```json
+            {
+                "errors": [
+                    {"index": 0, "error": "only 5 are available"}
+                ]
+            }
+            ```
+        '''
+        operations=request.data.get('operations')
+        merge=bool(request.data.get('merge',False))
+
+        if not isinstance(operations,list) or not operations:
+            return Response({"error":"operations must be a non empty list"},status=status.HTTP_400_BAD_REQUEST)
+
+        if len(operations)>self.MAX_OPERATIONS:
+            return Response({"error":f'at most {self.MAX_OPERATIONS} operations are allowed'},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        parsed,errors=[],[]
+        for index,operation in enumerate(operations):
+            try:
+                op=operation.get('op')
+                product_id=int(operation['product'])
+                variant_id=int(operation['product_variant']) if operation.get('product_variant') else None
+                quantity=int(operation.get('quantity',1 if op=='add' else 0))
+            except (AttributeError,KeyError,TypeError,ValueError):
+                errors.append({"index":index,"error":"product and a valid quantity are required"})
+                continue
+
+            if op not in self.OPERATIONS:
+                errors.append({"index":index,"error":f'op should be one of {", ".join(self.OPERATIONS)}'})
+            elif (op=='add' and quantity<=0) or (op=='set' and quantity<0):
+                errors.append({"index":index,"error":"quantity should be positive"})
+            else:
+                parsed.append((index,op,product_id,variant_id,quantity))
+
+        if errors:
+            return Response({"errors":errors},status=status.HTTP_400_BAD_REQUEST)
+
+        # one cache lookup, variants that do not belong to their product are left out
+        stock=availability.sellable_many((operation[2],operation[3]) for operation in parsed)
+        store=get_cart_store()
+        quantities=store.lines(request.user)
+        changes={}
+
+        for index,op,product_id,variant_id,quantity in parsed:
+            line=(product_id,variant_id)
+            if line not in stock:
+                errors.append({"index":index,"error":"product or variant not found"})
+                continue
+
+            if op=='add':
+                quantity+=quantities.get(line,0)
+            elif op=='remove':
+                quantity=0
+
+            available_stock=stock[line]
+            if quantity>available_stock:
+                if not merge:
+                    errors.append({"index":index,"error":f'only {available_stock} are available'})
+                    continue
+                quantity=available_stock
+
+            quantities[line]=quantity
+            changes[line]=quantity
+
+        if errors:
+            return Response({"errors":errors},status=status.HTTP_400_BAD_REQUEST)
+
+        store.apply(request.user,changes)
+
+        return Response({
+            "message":"Cart updated",
+            "items":[
+                {"product":product_id,"product_variant":variant_id,"quantity":quantity}
+                for (product_id,variant_id),quantity in changes.items() if quantity>0
+            ],
+            "removed":[
+                {"product":product_id,"product_variant":variant_id}
+                for (product_id,variant_id),quantity in changes.items() if quantity<=0
+            ],
+        },status=status.HTTP_200_OK)
+
+cart_batch_view=CartBatchView.as_view()
+
+
+
 
 class WhishView(APIView):
     '''
@@ -0,0 +1,179 @@
+'''
+Checkout engine
+
+Rejects lines the availability cache (inventory/availability.py) says can
+not be met before any lock is taken, then locks every product and variant
+of the order with one SELECT ... FOR UPDATE per table, always in ascending
+id order. Concurrent checkouts that share products then queue on the same
+first row instead of each holding a lock the other one needs. Stock is
+checked again against the locked rows, the cache may be behind: that check
+is the one that holds. Product.stock_qty only drops on payment, so units of
+unpaid orders younger than the reservation TTL are taken off it first;
+they are read under the product lock, after any checkout that held it has
+committed. Prices are computed in memory from the locked rows
+and the order items are written with one bulk insert. The stock
+reservation taken after (inventory/reservations.py) also holds the units
+of variants with an Inventory row.
+
+Must run inside transaction.atomic(), the locks are held until it commits.
+sqlite has no row locks, there the write lock each transaction takes at
+BEGIN IMMEDIATE (settings.DATABASES) queues whole checkouts instead.
+'''
+import datetime
+from collections import defaultdict, namedtuple
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Sum
+from django.utils import timezone
+from rest_framework import serializers
+
+from inventory import availability
+
+from . import models
+
+
+CheckoutLine = namedtuple('CheckoutLine', ['product_id', 'variant_id', 'quantity'])
+
+
+def lines_from_items(items):
+    '''
+    CheckoutLines from validated OrderItemSerializer data
+    '''
+    return [
+        CheckoutLine(
+            product_id=item['product'].id,
+            variant_id=item['product_variant'].id if item.get('product_variant') else None,
+            quantity=item['quantity'],
+        )
+        for item in items
+    ]
+
+
+def lock_stock(lines):
+    '''
+    Locks the products and variants of `lines`, returns ({id: product}, {id: variant})
+    '''
+    if not transaction.get_connection().in_atomic_block:
+        raise RuntimeError('lock_stock() must run inside transaction.atomic()')
+
+    product_ids = sorted({line.product_id for line in lines})
+    variant_ids = sorted({line.variant_id for line in lines if line.variant_id})
+
+    # products before variants, ids ascending: every checkout takes locks in the same order
+    products = {
+        product.id: product
+        for product in models.Product.objects.select_for_update().filter(id__in=product_ids).order_by('id')
+    }
+    variants = {}
+    if variant_ids:
+        variants = {
+            variant.id: variant
+            for variant in models.ProductVariant.objects.select_for_update().filter(id__in=variant_ids).order_by('id')
+        }
+    return products, variants
+
+
+def check_availability(lines):
+    '''
+    Rejects lines the availability cache says can not be met, before any lock is taken
+
+    Early rejection only, price_lines() checks again under the locks
+    '''
+    errors = []
+    for product_id, variant_id, wanted, available in availability.shortages(lines):
+        label = f'variant {variant_id}' if variant_id else f'product {product_id}'
+        if available is None:
+            errors.append(f'{label} does not belong to product {product_id}' if variant_id
+                          else f'{label} does not exist')
+        else:
+            errors.append(f'{label} only has {available} units left')
+    if errors:
+        raise serializers.ValidationError(errors)
+
+
+def held_units(product_ids):
+    '''
+    {product_id: units} in unpaid orders placed within STOCK_RESERVATION['TTL']
+    '''
+    ttl = getattr(settings, 'STOCK_RESERVATION', {}).get('TTL', 15 * 60)
+    since = timezone.now() - datetime.timedelta(seconds=ttl)
+    rows = models.OrderItem.objects \
+        .filter(product_id__in=product_ids, order__status='pending', order__order_date__gte=since) \
+        .exclude(order__payment__status='failed') \
+        .values('product_id') \
+        .annotate(units=Sum('quantity')) \
+        .values_list('product_id', 'units')
+    return dict(rows)
+
+
+def price_lines(lines, products, variants):
+    '''
+    Validates stock for `lines` against locked rows and builds unsaved OrderItems
+
+    Quantities of lines sharing a product (or variant) are added up before
+    they are compared with its stock, variant lines count against their
+    product too and so do the units held by other unpaid orders
+    (held_units()). Returns (order_items, subtotal).
+    '''
+    wanted_products = defaultdict(int)
+    wanted_variants = defaultdict(int)
+    errors = []
+
+    for line in lines:
+        product = products.get(line.product_id)
+        if product is None:
+            errors.append(f'product {line.product_id} does not exist')
+            continue
+
+        if line.variant_id:
+            variant = variants.get(line.variant_id)
+            if variant is None or variant.product_id != product.id:
+                errors.append(f"Selected variant does not belong to '{product.name}'")
+                continue
+            wanted_variants[variant.id] += line.quantity
+        wanted_products[product.id] += line.quantity
+
+    held = held_units(list(wanted_products)) if wanted_products else {}
+    for product_id, quantity in wanted_products.items():
+        product = products[product_id]
+        left = product.stock_qty - held.get(product_id, 0)
+        if left < quantity:
+            errors.append(f"'{product.name}' only has {max(left, 0)} units left")
+
+    for variant_id, quantity in wanted_variants.items():
+        variant = variants[variant_id]
+        if variant.stock_qty < quantity:
+            errors.append(f"'{products[variant.product_id].name}' ({variant.sku}) only has {variant.stock_qty} units left")
+
+    if errors:
+        raise serializers.ValidationError(errors)
+
+    subtotal = Decimal('0')
+    order_items = []
+    for line in lines:
+        product = products[line.product_id]
+        variant = variants.get(line.variant_id) if line.variant_id else None
+
+        unit_price = variant.price if variant else product.base_price
+        total_price = line.quantity * unit_price
+        subtotal += total_price
+
+        order_items.append(
+            models.OrderItem(
+                product=product,
+                product_variant=variant,
+                quantity=line.quantity,
+                unit_price=unit_price,
+                total_price=total_price,
+                discount_applied=Decimal('0'),
+            )
+        )
+    return order_items, subtotal
+
+
+def create_order_items(order, order_items):
+    for item in order_items:
+        item.order = order
+    return models.OrderItem.objects.bulk_create(order_items)
@@ -0,0 +1,150 @@
+'''
+Idempotency keys
+
+Views wrapped with @idempotent('scope') honor an Idempotency-Key request
+header. The first request with a key runs the view and its response is
+stored; repeats from the same user within settings.IDEMPOTENCY['WINDOW']
+get that response replayed (Idempotent-Replayed: true) without running the
+view again, so a retry storm costs one indexed lookup per retry.
+
+    no key                      view runs as usual
+    first request               view runs, 2xx/4xx response stored
+    repeat, same body           stored response replayed
+    repeat, different body      422
+    repeat while first running  409, Retry-After
+    view raised or answered 5xx key released, the retry runs the view
+
+Keys are IdempotencyKey rows, unique per (user, scope, key): the INSERT
+that claims a key is committed before the view runs, so of two workers
+racing on one key the database lets exactly one through. A claim left by a
+request that died is taken over after LOCK_TIMEOUT, rows past the window
+are reused and deleted by purge() (celery beat, user.tasks.purge_idempotency_keys).
+Rows hold the body fingerprint, status and rendered response data only.
+'''
+import datetime
+import functools
+import hashlib
+import json
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from rest_framework import status
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+
+from .models import IdempotencyKey
+
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+
+def _config():
+    config = getattr(settings, 'IDEMPOTENCY', {})
+    return config.get('WINDOW', 24 * 60 * 60), config.get('LOCK_TIMEOUT', 60)
+
+
+def _fingerprint(request):
+    try:
+        body = json.dumps(request.data, sort_keys=True, default=str)
+    except (TypeError, ValueError):
+        body = repr(request.data)
+    return hashlib.sha256(body.encode()).hexdigest()[:16]
+
+
+def _claim(user, scope, key, fingerprint):
+    '''
+    (row, claimed): claimed is True when this request owns the key and runs the view
+    '''
+    window, lock_timeout = _config()
+    now = timezone.now()
+    locked_until = now + datetime.timedelta(seconds=lock_timeout)
+
+    try:
+        with transaction.atomic():
+            row = IdempotencyKey.objects.create(user=user, scope=scope, key=key,
+                                                fingerprint=fingerprint, locked_until=locked_until)
+        return row, True
+    except IntegrityError:
+        pass
+
+    row = IdempotencyKey.objects.filter(user=user, scope=scope, key=key).first()
+    if row is None:
+        # released between our insert and this read, the client retries
+        return None, False
+
+    expired = row.created_at < now - datetime.timedelta(seconds=window)
+    abandoned = row.status_code is None and row.locked_until < now
+    if expired or abandoned:
+        # conditional on what we just read: of two takers only one updates the row
+        taken = IdempotencyKey.objects \
+            .filter(pk=row.pk, status_code=row.status_code, locked_until=row.locked_until) \
+            .update(fingerprint=fingerprint, status_code=None, response=None,
+                    locked_until=locked_until, created_at=now)
+        if taken:
+            row.fingerprint, row.status_code, row.response = fingerprint, None, None
+            return row, True
+    return row, False
+
+
+def idempotent(scope):
+    '''
+    Decorator for APIView handlers: post(self, request, *args, **kwargs)
+    '''
+    def decorator(handler):
+
+        @functools.wraps(handler)
+        def wrapper(view, request, *args, **kwargs):
+            key = request.headers.get(HEADER)
+            if not key:
+                return handler(view, request, *args, **kwargs)
+
+            if len(key) > MAX_KEY_LENGTH:
+                return Response({'error': f'{HEADER} must be at most {MAX_KEY_LENGTH} characters'},
+                                status=status.HTTP_400_BAD_REQUEST)
+
+            fingerprint = _fingerprint(request)
+            row, claimed = _claim(request.user, scope, key, fingerprint)
+
+            if not claimed:
+                if row is None or row.status_code is None:
+                    response = Response({'error': 'a request with this Idempotency-Key is in progress'},
+                                        status=status.HTTP_409_CONFLICT)
+                    response['Retry-After'] = '1'
+                    return response
+
+                if row.fingerprint != fingerprint:
+                    return Response({'error': f'{HEADER} was already used with a different request body'},
+                                    status=status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+                response = Response(row.response, status=row.status_code)
+                response['Idempotent-Replayed'] = 'true'
+                return response
+
+            try:
+                response = handler(view, request, *args, **kwargs)
+            except Exception:
+                IdempotencyKey.objects.filter(pk=row.pk).delete()
+                raise
+
+            if response.status_code >= 500:
+                IdempotencyKey.objects.filter(pk=row.pk).delete()
+            else:
+                # stored as rendered, the replay serializes decimals and dates the same way
+                data = json.loads(JSONRenderer().render(response.data)) if response.data is not None else None
+                IdempotencyKey.objects.filter(pk=row.pk).update(status_code=response.status_code, response=data)
+            return response
+
+        return wrapper
+    return decorator
+
+
+def purge(now=None):
+    '''
+    Deletes keys older than the replay window, returns how many
+    '''
+    window, _ = _config()
+    cutoff = (now or timezone.now()) - datetime.timedelta(seconds=window)
+    deleted, _ = IdempotencyKey.objects.filter(created_at__lt=cutoff).delete()
+    return deleted
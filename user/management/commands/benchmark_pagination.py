@@ -0,0 +1,89 @@
+import statistics
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from rest_framework.test import APIRequestFactory
+
+from api.models import User
+from api.pagination import CatalogKeysetPagination
+from inventory.models import Seller
+from user import models
+from user.product_views import product_list_view
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    '''
+    Compares page 1 with a deep page for page-number and keyset pagination
+    on /user/products/
+
+    Seeds throwaway products inside a transaction that is rolled back, so
+    it is safe to run against any database.
+
+        python manage.py benchmark_pagination --page 10000
+    '''
+    help = 'Benchmark page-number vs keyset pagination for the product list'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--page', type=int, default=10000, help='deep page to compare with page 1')
+        parser.add_argument('--runs', type=int, default=20, help='timed requests per case')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self._run(options['page'], options['runs'])
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def _seed(self, total):
+        suffix = uuid.uuid4().hex[:8]
+        user = User.objects.create_user(f'bench-{suffix}', password=None, role_model='seller')
+        seller = Seller.objects.create(user=user, business_name='bench', gst_number=suffix)
+        category = models.Category.objects.create(name=f'bench-{suffix}')
+        brand = models.Brand.objects.create(name=f'bench-{suffix}')
+
+        models.Product.objects.bulk_create(
+            [
+                models.Product(seller=seller, name=f'bench product {i}', base_price=100 + i % 997,
+                               category=category, brand=brand)
+                for i in range(total)
+            ],
+            batch_size=5000,
+        )
+
+    def _time(self, path, runs):
+        factory = APIRequestFactory()
+        samples = []
+        for _ in range(runs):
+            request = factory.get(path)
+            start = time.perf_counter()
+            response = product_list_view(request)
+            response.render()
+            samples.append((time.perf_counter() - start) * 1000)
+        return statistics.median(samples)
+
+    def _run(self, deep_page, runs):
+        page_size = CatalogKeysetPagination.page_size
+        total = deep_page * page_size + page_size
+        self.stdout.write(f'seeding {total} products ...')
+        self._seed(total)
+
+        # cursor for the deep page: key of the last row of the page before it
+        paginator = CatalogKeysetPagination()
+        boundary = models.Product.objects.order_by('-created_at', '-id')[(deep_page - 1) * page_size - 1]
+        cursor = paginator.encode_cursor('-created_at', (boundary.created_at, boundary.id))
+
+        cases = [
+            ('page-number', 'page 1', '/user/products/'),
+            ('page-number', f'page {deep_page}', f'/user/products/?page={deep_page}'),
+            ('keyset', 'page 1', '/user/products/?pagination=cursor'),
+            ('keyset', f'page {deep_page}', f'/user/products/?cursor={cursor}'),
+        ]
+        for mode, label, path in cases:
+            self.stdout.write(f'{mode:12} {label:12} {self._time(path, runs):8.2f} ms (median of {runs})')
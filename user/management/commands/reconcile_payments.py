@@ -0,0 +1,38 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from user import reconciliation
+
+
+class Command(BaseCommand):
+    '''
+    Asks the payment gateway about pending payments and settles them
+
+    Runs every 30 minutes from celery beat (user.tasks.reconcile_payments),
+    this runs it by hand, e.g. after a webhook outage:
+
+        python manage.py reconcile_payments --older-than 600 --workers 16
+    '''
+    help = 'Reconcile pending payments with the payment gateway'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=None,
+                            help='only payments created at least this many seconds ago')
+        parser.add_argument('--batch-size', type=int, default=None, help='payments per page')
+        parser.add_argument('--chunk-size', type=int, default=None, help='order ids per gateway lookup')
+        parser.add_argument('--workers', type=int, default=None, help='concurrent gateway lookups')
+
+    def handle(self, *args, **options):
+        cutoff = None
+        if options['older_than'] is not None:
+            cutoff = timezone.now() - datetime.timedelta(seconds=options['older_than'])
+
+        stats = reconciliation.reconcile(
+            cutoff=cutoff,
+            batch_size=options['batch_size'],
+            chunk_size=options['chunk_size'],
+            workers=options['workers'],
+        )
+        self.stdout.write(', '.join(f'{key}: {value}' for key, value in stats.items()))
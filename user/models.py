@@ -80,6 +80,13 @@ class Product(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        # keyset pagination seeks on these (api/pagination.py CatalogKeysetPagination)
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='product_created_id_idx'),
+            models.Index(fields=['base_price', 'id'], name='product_price_id_idx'),
+        ]
+
     def __str__(self):
           return f'{self.name}'
 
@@ -291,6 +298,71 @@ class Payment(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     razorpay_order_id = models.CharField(max_length=200, null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            # reconciliation pages through pending payments by (created_at, id)
+            models.Index(fields=['status', 'created_at', 'id'], name='payment_status_created_idx'),
+        ]
     
     def __str__(self):
-        return f"Payment for Order {self.order.order_number}"
\ No newline at end of file
+        return f"Payment for Order {self.order.order_number}"
+
+class WebhookEvent(models.Model):
+    '''
+    Raw razorpay webhook delivery, stored as received and processed by a celery worker
+    '''
+    STATUS = [
+        ('pending', 'Pending'),
+        ('processed', 'Processed'),
+        ('failed', 'Failed'),
+    ]
+
+    # X-Razorpay-Event-Id, or a hash of the body when the header is missing
+    event_id = models.CharField(max_length=100, unique=True)
+    event = models.CharField(max_length=100)
+    razorpay_order_id = models.CharField(max_length=200, null=True, blank=True)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ['received_at', 'id']
+        indexes = [
+            models.Index(fields=['razorpay_order_id', 'status', 'id'], name='webhook_order_status_idx'),
+            models.Index(fields=['status', 'received_at'], name='webhook_status_received_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.event} ({self.event_id})"
+
+
+class IdempotencyKey(models.Model):
+    '''
+    Idempotency-Key sent with an order / payment request and the response it got (user/idempotency.py)
+
+    status_code is null while the first request with the key is running
+    '''
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='idempotency_keys')
+    scope = models.CharField(max_length=50)
+    key = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=16)
+    status_code = models.PositiveSmallIntegerField(null=True, blank=True)
+    response = models.JSONField(null=True, blank=True)
+    # a claim older than this was left by a request that died, the next one takes it over
+    locked_until = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'scope', 'key'], name='idempotency_user_scope_key_uniq'),
+        ]
+        indexes = [
+            # purge() drops keys past the replay window
+            models.Index(fields=['created_at'], name='idempotency_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.scope} {self.key} ({self.user_id})"
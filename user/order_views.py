@@ -12,6 +12,7 @@ from . import serializers
 from . import tasks
 from api.pagination import StandardPagination,LimitOffsetPagination,ProductCursorPagination
 from api.authentication import CookieJWTAuthentication
+from .idempotency import idempotent
 
 from django.shortcuts import get_object_or_404
 from django.db.models import Q
@@ -26,6 +27,7 @@ class OrderView(APIView):
     '''
     permission_classes=[IsBuyer]
 
+    @idempotent('order-create')
     def post(self,request):
          '''
          Place a new Order
@@ -86,6 +88,10 @@ class OrderView(APIView):
              }
              ```
              400 BAD REQUEST : Validation error
+
+         Headers:
+             Idempotency-Key (optional) : retries with the same key replay the first
+                                          response instead of placing another order
          '''
          serializer=serializers.OrderSerializer(data=request.data,context={'request':request})
          if serializer.is_valid():
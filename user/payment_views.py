@@ -3,7 +3,8 @@ from rest_framework.views import APIView
 from rest_framework import generics,mixins,status
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated,AllowAny,IsAdminUser
-import razorpay,hashlib,json,hmac
+import hashlib,json,hmac
+import logging
 
 from django.views.decorators.csrf import csrf_exempt
 from django.http import HttpResponse
@@ -15,16 +16,27 @@ from django.db.models import Q
 from . import models
 from . import serializers
 from . import tasks
+from . import stock
+from . import webhooks
+from inventory import reservations
 
 from django.shortcuts import get_object_or_404
 from django.conf import settings
 
 from api.authentication import CookieJWTAuthentication
+from ecommerce import clients
+from .idempotency import idempotent
 
 
-client = razorpay.Client(
-    auth=(settings.RAZORPAY_KEY_ID, settings.RAZORPAY_KEY_SECRET)
-)
+logger = logging.getLogger(__name__)
+
+
+def _stock_lines(lines):
+    return [
+        {"product":line.product_id,"product_variant":line.variant_id,"quantity":line.quantity}
+        for line in lines
+    ]
+
 
 class CashOnDeliveryView(APIView):
     permission_classes=[IsBuyer]
@@ -40,21 +52,24 @@ class CashOnDeliveryView(APIView):
         if hasattr(order,'payment') and order.payment.status=="completed":
             return Response({'error':'Order already paid'},status=400)
         
-        payment=models.Payment.objects.create(
-            order=order,
-            amount=order.total_amount,
-            status='pending',
-            payment_gateway=None,
+        try:
+            with transaction.atomic():
+                payment=models.Payment.objects.create(
+                    order=order,
+                    amount=order.total_amount,
+                    status='pending',
+                    payment_gateway=None,
 
-        )
+                )
 
-        order.status="processing"
-        order.save()
+                order.status="processing"
+                order.save()
 
-        for item in order.items.select_related("product"):
-            product = item.product
-            product.stock_qty -= item.quantity
-            product.save()
+                stock.commit_order(order)
+                reservations.commit_order(order,user=request.user)
+
+        except stock.InsufficientStock as e:
+            return Response({'error':'some items ran out of stock','items':_stock_lines(e.failed)},status=400)
 
         return Response({
             'message':"Order successfully placed with cash-on-delivery",
@@ -87,8 +102,13 @@ class ConfirmCODPaymentView(APIView):
 
 
 class CreateRazorpayOrderView(APIView):
+    '''
+    retries with the same Idempotency-Key header replay the first response
+    instead of creating another Razorpay order
+    '''
     permission_classes=[IsBuyer]
 
+    @idempotent('razorpay-order-create')
     def post(self,request):
         order_id=request.data.get("order_id")
 
@@ -98,14 +118,14 @@ class CreateRazorpayOrderView(APIView):
             return Response({"error":"Order not Found"},status=400)
         
         #check if already paid
-        if hasattr(order,'payment') and order.payment.staus=='completed':
+        if hasattr(order,'payment') and order.payment.status=='completed':
             return Response({"error":"Order already paid"},status=400)
         
         # Amount in paise as razorpay uses paise as a standard to avoid cal issues
         amount_paise=int(order.total_amount*100)
 
         # create order in Razorpay
-        razorpay_order =client.order.create({
+        razorpay_order =clients.razorpay().order.create({
             "amount":amount_paise,
             "currency":"INR",
             "receipt":order.order_number, 
@@ -166,7 +186,7 @@ class VerifyPaymentView(APIView):
 
         #fetch payment from Razorpay to get method details
         try:
-            razorpay_payment = client.payment.fetch(razorpay_payment_id)
+            razorpay_payment = clients.razorpay().payment.fetch(razorpay_payment_id)
         except Exception:
             return Response({"error": "Could not fetch payment details"}, status=400)
 
@@ -203,20 +223,15 @@ class VerifyPaymentView(APIView):
                 order.save()
 
                 # Deduct stock
-                for item in order.items.select_related("product"):
-                    product = models.Product.objects.select_for_update().get(
-                        id=item.product_id
-                    )
-                    if product.stock_qty < item.quantity:
-                        raise serializers.ValidationError(
-                            f"{product.name} ran out of stock"
-                        )
-                    product.stock_qty -= item.quantity
-                    product.save()
+                stock.commit_order(order)
+                reservations.commit_order(order, user=request.user)
 
         except models.Payment.DoesNotExist:
             return Response({"error": "Payment record not found"}, status=404)
 
+        except stock.InsufficientStock as e:
+            return Response({"error": "some items ran out of stock", "items": _stock_lines(e.failed)}, status=400)
+
         return Response({
             "message": "Payment successful",
             "order_number": order.order_number,
@@ -234,55 +249,19 @@ def razorpay_webhook(request):
     signature=request.headers.get('X-Razorpay-Signature')
 
     try:
-        client.utility.verify_webhook_signature(
+        clients.razorpay().utility.verify_webhook_signature(
             request.body.decode(),
             signature,
-            settings.RAZORPAY_WEBHOOK_SECRET
+            str(settings.RAZORPAY_WEBHOOK_SECRET)
         )
     except Exception:
         return HttpResponse(status=400)
     
-    payload=json.loads(request.body)
-    event=payload.get("event")
-
-    if event == "payment.captured":
-        payment_entity=payload["payload"]["payment"]["entity"]
-        razorpay_order_id=payment_entity['order_id']
-        razorpay_payment_id=payment_entity['id']
-        method=payment_entity.get('method','online_banking')
-
-        method_map = {
-            "upi": "upi",
-            "card": "credit_card",     # refine further if needed
-            "netbanking": "online_banking",
-            "wallet": "wallet",
-        }
-    
-        try:
-            with transaction.atomic():
-                payment=models.Payment.objects.select_related("order").get(razorpay_order_id=razorpay_order_id)
-                payment.status="completed"
-                payment.transaction_id=razorpay_payment_id
-                payment.payment_method=method_map.get(method,"online_banking")
-                payment.payment_date=timezone.now()
-                payment.save()
-
-                order=payment.order
-                order.status="processing"
-                order.save()
-
-            for item in order.items.select_related("product"):
-                product = models.Product.objects.select_for_update().get(id=item.product_id)
-                product.stock_qty -= item.quantity
-                product.save()
-
-        except models.Payment.DoesNotExist:
-            pass  # log this in production
-
-    elif event == "payment.failed":
-        razorpay_order_id = payload["payload"]["payment"]["entity"]["order_id"]
-        models.Payment.objects.filter(
-            razorpay_order_id=razorpay_order_id
-        ).update(status="failed")
+    # payment, order and stock writes run in a celery worker (user/webhooks.py),
+    # the gateway gets its 200 as soon as the event is stored
+    try:
+        webhooks.ingest(request.body,request.headers)
+    except ValueError:
+        return HttpResponse(status=400)
 
     return HttpResponse(status=200)
\ No newline at end of file
@@ -7,15 +7,19 @@ from rest_framework.pagination import LimitOffsetPagination,CursorPagination,Pag
 from .permissions import IsBuyer,IsSeller,IsSellerOrReadOnly,IsProductOwner,IsAdminOrReadonly
 from . import models
 from . import serializers
-from api.pagination import StandardPagination,LimitOffsetPagination,ProductCursorPagination
+from api.pagination import StandardPagination,LimitOffsetPagination,ProductCursorPagination,CatalogKeysetPagination
 from . import tasks
+from .cache import get_product_cache
+from .search import search_index,price_index,facet_counts
+from .suggest import suggest_index
 
 from api.models import User
 from inventory.models import Seller
 from django.shortcuts import get_object_or_404
 from django.db.models import Q
 
-import boto3
+from ecommerce import clients
+from decimal import Decimal,InvalidOperation
 from django.conf import settings
 
 from api.authentication import CookieJWTAuthentication
@@ -27,6 +31,12 @@ class ProductsListAPIView(APIView):
 
     Allows all users (Aunthenticated or not) to:
        - List all available Products 
+
+    Query parameters:
+        pagination : 'cursor' to use keyset pagination (no COUNT, no OFFSET)
+        cursor     : opaque cursor from the 'next'/'previous' links
+        ordering   : '-created_at' (default), 'created_at', 'price', '-price'
+                     (keyset mode only)
         
     '''
 
@@ -53,9 +63,12 @@ class ProductsListAPIView(APIView):
         '''
         queryset=models.Product.objects.select_related(
             'category', 'brand'
-        )
+        ).prefetch_related('images')
         
-        paginator = StandardPagination()
+        if CatalogKeysetPagination.requested(request):
+            paginator = CatalogKeysetPagination()
+        else:
+            paginator = StandardPagination()
         result_page = paginator.paginate_queryset(queryset, request)
    
         serializer = serializers.ProductSerializer(result_page, many=True, context={'request': request}) 
@@ -155,7 +168,16 @@ class ProductDetailView(mixins.RetrieveModelMixin,generics.GenericAPIView):
         
         # print("AUTH CLASS:",self.request.successful_authenticator)
         # print("COOKIES:",self.request.COOKIES)
-        return self.retrieve(request,*args,**kwargs)
+
+        # payload holds absolute urls so the host is part of the cache key
+        data,hit=get_product_cache().get_or_set(
+            kwargs[self.lookup_field],
+            lambda: self.retrieve(request,*args,**kwargs).data,
+            variant=request.build_absolute_uri('/'),
+        )
+        response=Response(data,status=status.HTTP_200_OK)
+        response['X-Cache']='HIT' if hit else 'MISS'
+        return response
     
     
 product_detail_view=ProductDetailView.as_view()
@@ -174,13 +196,21 @@ class ProductSearch(APIView):
         - Price range
 
      Query parameters:
-        ct : Category name
-        n  : Product(partial match)
-        b  : Brand
-        p  : Approximate Price 
+        ct        : Category name
+        n         : search text, matched against name, description, brand and category
+        b         : Brand
+        min_price : lowest effective price (inclusive)
+        max_price : highest effective price (inclusive)
+        price     : Approximate Price (kept for old clients, same as a ±1000 range)
+        sort      : 'price' or '-price' to order by price instead of relevance
+        facets    : '1' to add brand, category and price bucket counts for all matches
+        pagination: 'cursor' to page with opaque keyset cursors instead of page numbers
         
      Note:
-        Price search includes ±1000 range
+        Effective prices are a product's base_price and its active variant prices,
+        a product matches a range if any of them falls inside it
+        Text search is served by the in-memory index in search.py and
+        results are ranked by relevance (BM25)
 
      '''
      queryset=models.Product.objects \
@@ -192,7 +222,7 @@ class ProductSearch(APIView):
      def get_queryset(self):
          return models.Product.objects \
         .select_related('category','brand','seller__user')\
-        .prefetch_related('variants').all()
+        .prefetch_related('variants','images').all()
        
         
      def get(self,request):
@@ -223,36 +253,104 @@ class ProductSearch(APIView):
         name=self.request.GET.get('n',None)
         brand=self.request.GET.get('b',None)
         price=request.query_params.get('price')
+        min_price=request.query_params.get('min_price')
+        max_price=request.query_params.get('max_price')
+        sort=request.query_params.get('sort')
+        with_facets=request.query_params.get('facets') in ('1','true')
        
        
-        queryset=self.get_queryset()
+        # ranked product ids come from the index, only the requested page hits the db
+        product_ids,scores=search_index.rank(name,category=category,brand=brand)
 
-        if category:
-            queryset=queryset.filter(Q(category__name__icontains=category)) 
+        try:
+            if price :
+                value = max(0, min(int(price), 1000000))
+                min_price=max(0,value-1000)
+                max_price=value+1000
+            else:
+                min_price=Decimal(min_price) if min_price else None
+                max_price=Decimal(max_price) if max_price else None
+                if any(p is not None and not p.is_finite() for p in (min_price,max_price)):
+                    raise ValueError("price must be a finite number")
+
+        except (ValueError, TypeError, InvalidOperation):  
+            return Response({"error": "Invalid price"}, status=400)
+
+        if min_price is not None or max_price is not None:
+            in_range=price_index.in_range(min_price,max_price)
+            product_ids=[pid for pid in product_ids if pid in in_range]
+
+        if sort in ('price','-price'):
+            product_ids=price_index.order(product_ids,descending=sort=='-price')
+            ordering,key=sort,price_index.sort_key(descending=sort=='-price')
+        elif scores:
+            ordering,key='relevance',lambda pid: (-scores[pid],pid)
+        else:
+            ordering,key='id',lambda pid: (pid,)
+
+        if CatalogKeysetPagination.requested(request):
+            paginator=CatalogKeysetPagination()
+            page_ids=paginator.paginate_list(product_ids,key,request,ordering)
+        else:
+            paginator=StandardPagination()
+            page_ids=paginator.paginate_queryset(product_ids,request)
+
+        products=self.get_queryset().in_bulk(page_ids)
+        result_page=[products[pid] for pid in page_ids if pid in products]
 
-        if name:
-            queryset=queryset.filter(Q(name__icontains=name)) 
+        serializer=serializers.ProductSearchSerializers(result_page,many=True,context={'request':request})
 
-        if brand:
-            queryset=queryset.filter(Q(brand__name__icontains=brand)) 
+        response=paginator.get_paginated_response(serializer.data)
+        if with_facets:
+            response.data['facets']=facet_counts(product_ids)
+        return response
+product_search_view=ProductSearch.as_view()
 
-        if price :
-            try:
-                value = max(0, min(int(price), 1000000))
-                min_p=max(0,value-1000)
-                max_p=value+1000
-                queryset = queryset.filter(base_price__range=(min_p, max_p))
 
-            except (ValueError, TypeError):  
-                return Response({"error": "Invalid price"}, status=400)
+class ProductSuggestView(APIView):
+    '''
+    Product Suggest API
 
-        paginator=StandardPagination()
-        result_page=paginator.paginate_queryset(queryset,request)
+    Allows all users (Aunthenticated or not) to:
+        - get name completions for a search box while typing
 
-        serializer=serializers.ProductSearchSerializers(result_page,many=True,context={'request':request})
+    Query parameters:
+        q     : typed prefix
+        limit : completions per kind (default 5, max 20)
 
-        return paginator.get_paginated_response(serializer.data)
-product_search_view=ProductSearch.as_view()
+    Note:
+        served from the in-memory sorted arrays in suggest.py, no db query
+    '''
+    permission_classes=[AllowAny]
+
+    def get(self,request):
+        '''
+        Returns product, brand and category completions for a prefix
+
+        Access:
+            public
+        Response:
+            200 ok -completions
+            Example:
+            ```json
+            {
+                "product": [{"id": 1, "name": "samsung s23"}],
+                "brand": [{"id": 1, "name": "samsung"}],
+                "category": []
+            }
+            ```
+            400 BAD REQUEST : invalid limit
+        '''
+        prefix=request.query_params.get('q','')
+
+        try:
+            limit=max(1,min(int(request.query_params.get('limit',5)),20))
+        except (ValueError,TypeError):
+            return Response({"error":"Invalid limit"},status=status.HTTP_400_BAD_REQUEST)
+
+        return Response(suggest_index.suggest(prefix,limit),status=status.HTTP_200_OK)
+
+product_suggest_view=ProductSuggestView.as_view()
 
 
 class ProductImageListview(APIView):
@@ -275,10 +373,6 @@ class ProductImageListview(APIView):
     permission_classes = [IsProductOwner]
 
     queryset = models.ProductImage.objects.all()
-    s3_client=boto3.client("s3",
-                           aws_access_key_id = settings.AWS_ACCESS_KEY_ID,
-                           aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                            region_name=settings.AWS_S3_REGION_NAME )
 
     def get(self,request):
         '''
@@ -317,9 +411,9 @@ class ProductImageListview(APIView):
 
     
         # generate presigned urls for temporary credentials to upload media from front-end
-        presigned_urls=self.s3_client.generate_presigned_url(
+        presigned_urls=clients.s3().generate_presigned_url(
             'put_object',
-            Params={'Bucket':settings.AWS_STORAGE_BUCKET_NAME,'Key':f'{user}/{product_id}/{file_type}/{file_name}'},
+            Params={'Bucket':str(settings.AWS_STORAGE_BUCKET_NAME),'Key':f'{user}/{product_id}/{file_type}/{file_name}'},
             ExpiresIn=3600
         )
         # its url that gets generated after successful upload from front-end
@@ -0,0 +1,219 @@
+'''
+Payment reconciliation
+
+Finds Payment rows stuck in 'pending' because the verify call or the
+webhook never arrived, asks the gateway what happened to them and applies
+the result:
+
+    gateway says   payment        order         stock
+    captured       completed      processing    committed (pending when out of stock)
+    failed         failed         unchanged     reservation released
+    pending        unchanged      unchanged     unchanged
+
+Pending payments older than settings.PAYMENT_RECONCILIATION['GRACE_SECONDS']
+are paged by (created_at, id) with keyset iteration, so a run holds one
+page in memory however many rows there are and never rescans what it has
+passed. Each page is looked up in chunks of CHUNK_SIZE on WORKERS threads
+and written back in one transaction with bulk updates. The gateway is
+reached through a GatewayClient, settings.PAYMENT_RECONCILIATION['CLIENT'];
+FakeGatewayClient answers from memory for tests and local runs.
+'''
+import datetime
+import logging
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db.models import Q
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from ecommerce import clients
+from inventory import reservations
+
+from . import models
+from .webhooks import complete_payment
+
+
+logger = logging.getLogger(__name__)
+
+
+# status: 'captured', 'failed' or 'pending'
+GatewayPayment = namedtuple('GatewayPayment', ['status', 'payment_id', 'method'])
+
+
+def _config():
+    config = getattr(settings, 'PAYMENT_RECONCILIATION', {})
+    return {
+        'CLIENT': config.get('CLIENT', 'user.reconciliation.RazorpayGatewayClient'),
+        'GRACE_SECONDS': config.get('GRACE_SECONDS', 15 * 60),
+        'BATCH_SIZE': config.get('BATCH_SIZE', 500),
+        'CHUNK_SIZE': config.get('CHUNK_SIZE', 50),
+        'WORKERS': config.get('WORKERS', 8),
+    }
+
+
+class GatewayClient:
+    '''
+    Looks up payments by razorpay order id, called from several threads at once
+    '''
+
+    def fetch(self, razorpay_order_ids):
+        '''
+        {razorpay_order_id: GatewayPayment}, ids the gateway does not know may be left out
+        '''
+        raise NotImplementedError
+
+
+class RazorpayGatewayClient(GatewayClient):
+
+    def fetch(self, razorpay_order_ids):
+        # one razorpay client per worker thread, see ecommerce/clients.py
+        client = clients.razorpay()
+        result = {}
+        for razorpay_order_id in razorpay_order_ids:
+            attempts = client.order.payments(razorpay_order_id).get('items', [])
+            captured = [attempt for attempt in attempts if attempt['status'] == 'captured']
+            if captured:
+                result[razorpay_order_id] = GatewayPayment('captured', captured[0]['id'], captured[0].get('method'))
+            elif attempts and all(attempt['status'] == 'failed' for attempt in attempts):
+                result[razorpay_order_id] = GatewayPayment('failed', attempts[-1]['id'], attempts[-1].get('method'))
+            else:
+                # no attempt yet, or authorized and waiting for capture
+                result[razorpay_order_id] = GatewayPayment('pending', None, None)
+        return result
+
+
+class FakeGatewayClient(GatewayClient):
+    '''
+    In-process gateway: payments = {razorpay_order_id: GatewayPayment}
+    '''
+
+    def __init__(self, payments=None):
+        self.payments = dict(payments or {})
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, razorpay_order_ids):
+        with self._lock:
+            self.calls += 1
+        return {
+            razorpay_order_id: self.payments[razorpay_order_id]
+            for razorpay_order_id in razorpay_order_ids
+            if razorpay_order_id in self.payments
+        }
+
+
+def get_gateway_client():
+    return import_string(_config()['CLIENT'])()
+
+
+def pending_pages(cutoff, batch_size):
+    '''
+    Yields lists of (created_at, id, razorpay_order_id) for pending payments created before `cutoff`
+    '''
+    queryset = models.Payment.objects \
+        .filter(status='pending', razorpay_order_id__isnull=False, created_at__lt=cutoff) \
+        .order_by('created_at', 'id') \
+        .values_list('created_at', 'id', 'razorpay_order_id')
+
+    page = list(queryset[:batch_size])
+    while page:
+        yield page
+        if len(page) < batch_size:
+            return
+        created_at, payment_id, _ = page[-1]
+        page = list(queryset.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=payment_id))[:batch_size])
+
+
+def _fetch(client, razorpay_order_ids, chunk_size, executor):
+    chunks = [razorpay_order_ids[i:i + chunk_size] for i in range(0, len(razorpay_order_ids), chunk_size)]
+    results = {}
+    for chunk, future in [(chunk, executor.submit(client.fetch, chunk)) for chunk in chunks]:
+        try:
+            results.update(future.result())
+        except Exception:
+            # left pending, the next run asks again
+            logger.exception(f'gateway lookup failed for {len(chunk)} payments')
+    return results
+
+
+def _capture(payment_ids, results, now):
+    payments = list(
+        models.Payment.objects
+        .select_for_update(of=('self',))
+        .select_related('order')
+        .filter(id__in=payment_ids, status='pending')
+        .order_by('id')
+    )
+
+    orders = []
+    for payment in payments:
+        gateway_payment = results[payment.razorpay_order_id]
+        order = complete_payment(payment, gateway_payment.payment_id, gateway_payment.method, now)
+        if order is not None:
+            orders.append(order)
+
+    models.Payment.objects.bulk_update(
+        payments, ['status', 'transaction_id', 'payment_method', 'payment_date', 'updated_at'])
+    models.Order.objects.bulk_update(orders, ['status', 'updated_at'])
+    return len(payments)
+
+
+def _fail(payment_ids, now):
+    order_ids = list(
+        models.Payment.objects.select_for_update()
+        .filter(id__in=payment_ids, status='pending')
+        .values_list('order_id', flat=True)
+    )
+    models.Payment.objects.filter(order_id__in=order_ids).update(status='failed', updated_at=now)
+
+    reservations.release_orders(order_ids)
+    return len(order_ids)
+
+
+def apply(page, results, now=None):
+    '''
+    Writes the gateway answers for one page, returns (captured, failed)
+    '''
+    now = now or timezone.now()
+    captured, failed = [], []
+    for _, payment_id, razorpay_order_id in page:
+        gateway_payment = results.get(razorpay_order_id)
+        if gateway_payment is None:
+            continue
+        if gateway_payment.status == 'captured':
+            captured.append(payment_id)
+        elif gateway_payment.status == 'failed':
+            failed.append(payment_id)
+
+    with transaction.atomic():
+        return (
+            _capture(captured, results, now) if captured else 0,
+            _fail(failed, now) if failed else 0,
+        )
+
+
+def reconcile(client=None, cutoff=None, batch_size=None, chunk_size=None, workers=None):
+    '''
+    Reconciles every pending payment created before `cutoff`, returns counts per outcome
+    '''
+    config = _config()
+    client = client or get_gateway_client()
+    cutoff = cutoff or timezone.now() - datetime.timedelta(seconds=config['GRACE_SECONDS'])
+    batch_size = batch_size or config['BATCH_SIZE']
+    chunk_size = chunk_size or config['CHUNK_SIZE']
+
+    stats = {'checked': 0, 'captured': 0, 'failed': 0, 'unchanged': 0}
+    with ThreadPoolExecutor(max_workers=workers or config['WORKERS']) as executor:
+        for page in pending_pages(cutoff, batch_size):
+            results = _fetch(client, [row[2] for row in page], chunk_size, executor)
+            captured, failed = apply(page, results)
+
+            stats['checked'] += len(page)
+            stats['captured'] += captured
+            stats['failed'] += failed
+            stats['unchanged'] += len(page) - captured - failed
+    return stats
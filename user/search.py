@@ -0,0 +1,540 @@
+'''
+Product search index
+
+In-memory inverted index over Product name, description, brand and
+category, ranked with BM25. ProductSearch asks the index for an ordered
+list of product ids and only hydrates the page it returns, so no query
+ever runs a leading-wildcard LIKE over the product table.
+
+Every index is:
+    - built lazily from the database on first use (streamed queries)
+    - kept current in this process by signals.py after each commit
+    - rebuilt by a background thread once SEARCH_INDEX['REFRESH_INTERVAL']
+      seconds have passed, which picks up writes made by other workers;
+      requests keep reading the current state until the new one is swapped in
+
+Only the first build runs in a request, there is nothing to serve before it.
+'''
+import logging
+import math
+import re
+import threading
+import time
+from bisect import bisect_left,bisect_right,insort
+
+from django.conf import settings
+from django.db import connection
+
+from . import models
+
+
+logger = logging.getLogger(__name__)
+
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+STOP_WORDS = frozenset([
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'by', 'for', 'from', 'in',
+    'is', 'it', 'of', 'on', 'or', 'the', 'to', 'with',
+])
+
+# name matches count more than a hit deep in the description
+FIELD_WEIGHTS = {
+    'name': 3,
+    'brand': 2,
+    'category': 2,
+    'description': 1,
+}
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text):
+    if not text:
+        return []
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOP_WORDS]
+
+
+def _search_config():
+    return getattr(settings, 'SEARCH_INDEX', {})
+
+
+class CatalogIndex:
+    '''
+    Base class for the in-memory catalog indexes
+
+    Subclasses keep everything they need in a state object and implement:
+        load_rows(product_ids) : rows for the given products (all when None)
+        empty_state()          : a fresh state
+        add(state, row)        : index one row
+        remove(state, pid)     : drop one product
+        finalize(state)        : optional, runs once after a full build
+    '''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._rebuild_lock = threading.Lock()
+        self._built_at = None
+        self._missed = None         # changes seen while rebuild() is loading rows
+        self.state = None
+
+    def is_built(self):
+        return self._built_at is not None
+
+    def _is_stale(self):
+        interval = _search_config().get('REFRESH_INTERVAL', 300)
+        return bool(interval) and time.monotonic() - self._built_at > interval
+
+    def ensure_built(self):
+        if self._built_at is None:
+            with self._rebuild_lock:
+                if self._built_at is None:
+                    self.rebuild()
+        elif self._is_stale() and self._rebuild_lock.acquire(blocking=False):
+            # the request goes on with the current state, the refresh thread releases the lock
+            try:
+                threading.Thread(target=self._refresh, name=f'{type(self).__name__}-refresh', daemon=True).start()
+            except Exception:
+                self._rebuild_lock.release()
+                raise
+
+    def _refresh(self):
+        try:
+            if self._is_stale():
+                self.rebuild()
+        except Exception:
+            logger.exception('%s refresh failed, serving the previous build', type(self).__name__)
+        finally:
+            self._rebuild_lock.release()
+            connection.close()
+
+    def rebuild(self):
+        with self._lock:
+            self._missed = []
+        try:
+            state = self.empty_state()
+            for row in self.load_rows():
+                self.add(state, row)
+            self.finalize(state)
+        except Exception:
+            with self._lock:
+                self._missed = None
+            raise
+
+        with self._lock:
+            missed, self._missed = self._missed, None
+            self.state = state
+            self._built_at = time.monotonic()
+        # the rows may have been read before these commits
+        for change in missed:
+            change()
+
+    def replay_after_rebuild(self, change):
+        '''
+        Keeps a change made while rebuild() is loading rows, it is applied
+        again to the new state once that is swapped in
+        '''
+        with self._lock:
+            if self._missed is not None:
+                self._missed.append(change)
+
+    def update_products(self, product_ids):
+        if not product_ids:
+            return
+        self.replay_after_rebuild(lambda: self.update_products(product_ids))
+        if not self.is_built():
+            return
+        rows = list(self.load_rows(product_ids))
+        with self._lock:
+            for pid in product_ids:
+                self.remove(self.state, pid)
+            for row in rows:
+                self.add(self.state, row)
+
+    def remove_products(self, product_ids):
+        self.replay_after_rebuild(lambda: self.remove_products(product_ids))
+        if not self.is_built():
+            return
+        with self._lock:
+            for pid in product_ids:
+                self.remove(self.state, pid)
+
+    def load_rows(self, product_ids=None):
+        raise NotImplementedError
+
+    def empty_state(self):
+        raise NotImplementedError
+
+    def add(self, state, row):
+        raise NotImplementedError
+
+    def remove(self, state, pid):
+        raise NotImplementedError
+
+    def finalize(self, state):
+        pass
+
+
+class _SearchState:
+
+    def __init__(self):
+        self.postings = {}          # token -> {product_id: weighted tf}
+        self.doc_terms = {}         # product_id -> tokens (used for removal)
+        self.doc_len = {}           # product_id -> weighted length
+        self.ids = []               # sorted product ids, the unfiltered result
+        self.total_len = 0
+        self.brand_of = {}
+        self.category_of = {}
+        self.by_brand = {}          # brand_id -> {product_id}
+        self.by_category = {}       # category_id -> {product_id}
+        self.brand_names = {}
+        self.category_names = {}
+        self.vocab = None           # sorted tokens, rebuilt lazily for prefix lookups
+        self.bulk = True            # full build appends and sorts once in finalize()
+
+
+class ProductSearchIndex(CatalogIndex):
+    '''
+    Inverted index with BM25 ranking
+
+    Query terms are ANDed; the last term is also matched as a prefix so
+    partial input ("gal") still finds "galaxy" like the old icontains did.
+    '''
+
+    fields = ('id', 'name', 'description',
+              'brand_id', 'brand__name', 'category_id', 'category__name')
+
+    def load_rows(self, product_ids=None):
+        queryset = models.Product.objects.all()
+        if product_ids is not None:
+            queryset = queryset.filter(id__in=product_ids)
+        return queryset.values(*self.fields).iterator(chunk_size=2000)
+
+    def empty_state(self):
+        return _SearchState()
+
+    def add(self, state, row):
+        pid = row['id']
+        weighted = {}
+        for field, text in (('name', row['name']), ('description', row['description']),
+                            ('brand', row['brand__name']), ('category', row['category__name'])):
+            weight = FIELD_WEIGHTS[field]
+            for token in tokenize(text):
+                weighted[token] = weighted.get(token, 0) + weight
+
+        for token, tf in weighted.items():
+            postings = state.postings.get(token)
+            if postings is None:
+                postings = state.postings[token] = {}
+                state.vocab = None
+            postings[pid] = tf
+
+        length = sum(weighted.values())
+        if state.bulk:
+            state.ids.append(pid)
+        else:
+            insort(state.ids, pid)
+        state.doc_terms[pid] = tuple(weighted)
+        state.doc_len[pid] = length
+        state.total_len += length
+
+        state.brand_of[pid] = row['brand_id']
+        state.category_of[pid] = row['category_id']
+        state.by_brand.setdefault(row['brand_id'], set()).add(pid)
+        state.by_category.setdefault(row['category_id'], set()).add(pid)
+        state.brand_names[row['brand_id']] = row['brand__name'] or ''
+        state.category_names[row['category_id']] = row['category__name'] or ''
+
+    def remove(self, state, pid):
+        tokens = state.doc_terms.pop(pid, None)
+        if tokens is None:
+            return
+        for token in tokens:
+            postings = state.postings.get(token)
+            if postings is not None:
+                postings.pop(pid, None)
+                if not postings:
+                    del state.postings[token]
+                    state.vocab = None
+
+        del state.ids[bisect_left(state.ids, pid)]
+        state.total_len -= state.doc_len.pop(pid, 0)
+        state.by_brand.get(state.brand_of.pop(pid, None), set()).discard(pid)
+        state.by_category.get(state.category_of.pop(pid, None), set()).discard(pid)
+
+    def finalize(self, state):
+        state.ids.sort()
+        state.bulk = False
+
+    def _expand_prefix(self, state, prefix):
+        if state.vocab is None:
+            state.vocab = sorted(state.postings)
+        vocab = state.vocab
+        start = bisect_left(vocab, prefix)
+        end = start
+        while end < len(vocab) and vocab[end].startswith(prefix):
+            end += 1
+        return vocab[start:end]
+
+    def _matching_ids(self, by_group, names, text):
+        # brand/category tables are tiny, a substring scan over their names is cheap
+        text = text.lower()
+        matched = set()
+        for group_id, name in names.items():
+            if text in name.lower():
+                matched |= by_group.get(group_id, set())
+        return matched
+
+    def candidates(self, category=None, brand=None):
+        '''
+        Product ids matching the category/brand name filters, None when unfiltered
+        '''
+        state = self.state
+        candidates = None
+        if category:
+            candidates = self._matching_ids(state.by_category, state.category_names, category)
+        if brand:
+            matched = self._matching_ids(state.by_brand, state.brand_names, brand)
+            candidates = matched if candidates is None else candidates & matched
+        return candidates
+
+    def search(self, text=None, category=None, brand=None):
+        '''
+        Returns product ids, best match first
+
+        Without text the matches are returned in id order.
+        '''
+        return self.rank(text, category, brand)[0]
+
+    def rank(self, text=None, category=None, brand=None):
+        '''
+        Same as search() but also returns the BM25 score of every match
+        (None without text)
+        '''
+        self.ensure_built()
+
+        with self._lock:
+            state = self.state
+            candidates = self.candidates(category, brand)
+            terms = tokenize(text)
+
+            if not terms:
+                if candidates is None:
+                    return list(state.ids), None
+                if len(candidates) * 2 >= len(state.ids):
+                    # most of the catalog matched, walking the presorted ids beats sorting
+                    return [pid for pid in state.ids if pid in candidates], None
+                return sorted(candidates), None
+
+            total_docs = len(state.doc_len) or 1
+            avg_len = state.total_len / total_docs or 1
+            scores = None
+
+            for position, term in enumerate(terms):
+                if position == len(terms) - 1:
+                    expansions = self._expand_prefix(state, term)
+                else:
+                    expansions = [term] if term in state.postings else []
+
+                term_scores = {}
+                for token in expansions:
+                    postings = state.postings[token]
+                    idf = math.log(1 + (total_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for pid, tf in postings.items():
+                        if candidates is not None and pid not in candidates:
+                            continue
+                        if scores is not None and pid not in scores:
+                            continue
+                        norm = BM25_K1 * (1 - BM25_B + BM25_B * state.doc_len[pid] / avg_len)
+                        term_scores[pid] = term_scores.get(pid, 0.0) + idf * tf * (BM25_K1 + 1) / (tf + norm)
+
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {pid: scores[pid] + s for pid, s in term_scores.items()}
+
+                if not scores:
+                    return [], {}
+
+            return sorted(scores, key=lambda pid: (-scores[pid], pid)), scores
+
+
+class _PriceState:
+
+    def __init__(self):
+        self.entries = []           # sorted (price, product_id), one per effective price
+        self.prices_of = {}         # product_id -> its effective prices
+        self.sort_keys = []         # sorted (lowest price, product_id)
+        self.min_price = {}         # product_id -> lowest price
+        self.bulk = True            # full build appends and sorts once in finalize()
+
+
+class ProductPriceIndex(CatalogIndex):
+    '''
+    Sorted effective-price index
+
+    A product's effective prices are its base_price plus the price of every
+    active variant. Range filters are two binary searches over the sorted
+    entries and price sorting uses the lowest ("from") price, so neither
+    needs a join or an ORDER BY on the product table.
+    '''
+
+    def load_rows(self, product_ids=None):
+        products = models.Product.objects.all()
+        variants = models.ProductVariant.objects.filter(is_active=True)
+        if product_ids is not None:
+            products = products.filter(id__in=product_ids)
+            variants = variants.filter(product_id__in=product_ids)
+
+        variant_prices = {}
+        for product_id, price in variants.values_list('product_id', 'price').iterator(chunk_size=2000):
+            variant_prices.setdefault(product_id, []).append(price)
+
+        for pid, base_price in products.values_list('id', 'base_price').iterator(chunk_size=2000):
+            yield {'id': pid, 'prices': [base_price, *variant_prices.get(pid, ())]}
+
+    def empty_state(self):
+        return _PriceState()
+
+    def add(self, state, row):
+        pid = row['id']
+        prices = tuple(sorted(set(row['prices'])))
+        add = list.append if state.bulk else insort
+        for price in prices:
+            add(state.entries, (price, pid))
+        state.prices_of[pid] = prices
+        state.min_price[pid] = prices[0]
+        add(state.sort_keys, (prices[0], pid))
+
+    def finalize(self, state):
+        state.entries.sort()
+        state.sort_keys.sort()
+        state.bulk = False
+
+    def remove(self, state, pid):
+        prices = state.prices_of.pop(pid, None)
+        if prices is None:
+            return
+        for price in prices:
+            position = bisect_left(state.entries, (price, pid))
+            del state.entries[position]
+        position = bisect_left(state.sort_keys, (state.min_price.pop(pid), pid))
+        del state.sort_keys[position]
+
+    def in_range(self, min_price=None, max_price=None):
+        '''
+        Ids of products with at least one effective price in [min_price, max_price]
+        '''
+        self.ensure_built()
+        with self._lock:
+            entries = self.state.entries
+            start = 0 if min_price is None else bisect_left(entries, (min_price, -math.inf))
+            end = len(entries) if max_price is None else bisect_right(entries, (max_price, math.inf))
+            return {pid for _, pid in entries[start:end]}
+
+    def order(self, product_ids, descending=False):
+        '''
+        Orders product ids by their lowest effective price
+        '''
+        self.ensure_built()
+        with self._lock:
+            state = self.state
+            if len(product_ids) * 2 >= len(state.sort_keys):
+                # most of the catalog matched, walking the presorted keys beats sorting
+                wanted = set(product_ids)
+                ordered = [pid for _, pid in state.sort_keys if pid in wanted]
+                return ordered[::-1] if descending else ordered
+
+            min_price = state.min_price
+            return sorted(product_ids, key=lambda pid: (min_price.get(pid, math.inf), pid), reverse=descending)
+
+    def sort_key(self, descending=False):
+        '''
+        Ascending key for a list produced by order(), json-native so it can
+        be carried in a keyset cursor
+        '''
+        min_price = self.state.min_price
+        sign = -1 if descending else 1
+        return lambda pid: (sign * float(min_price.get(pid, math.inf)), sign * pid)
+
+
+_indexes = []
+
+
+def register(index):
+    _indexes.append(index)
+    return index
+
+
+def any_built():
+    return any(index.is_built() for index in _indexes)
+
+
+def products_changed(product_ids):
+    for index in _indexes:
+        index.update_products(product_ids)
+
+
+def products_removed(product_ids):
+    for index in _indexes:
+        index.remove_products(product_ids)
+
+
+def _price_buckets():
+    return _search_config().get('PRICE_BUCKETS', [0, 1000, 5000, 10000, 25000, 50000, 100000])
+
+
+def facet_counts(product_ids):
+    '''
+    Brand, category and price bucket counts for a matched id set
+
+    One pass over the matched ids with dict lookups, so the cost follows the
+    size of the result and not the size of the catalog. Price buckets use the
+    product's lowest effective price.
+    '''
+    search_index.ensure_built()
+    price_index.ensure_built()
+    edges = _price_buckets()
+
+    brands, categories, buckets = {}, {}, [0] * len(edges)
+
+    with search_index._lock, price_index._lock:
+        state = search_index.state
+        min_price = price_index.state.min_price
+
+        for pid in product_ids:
+            brand_id = state.brand_of.get(pid)
+            if brand_id is not None:
+                brands[brand_id] = brands.get(brand_id, 0) + 1
+
+            category_id = state.category_of.get(pid)
+            if category_id is not None:
+                categories[category_id] = categories.get(category_id, 0) + 1
+
+            price = min_price.get(pid)
+            if price is not None and price >= edges[0]:
+                buckets[bisect_right(edges, price) - 1] += 1
+
+        brand_names = state.brand_names
+        category_names = state.category_names
+
+    def _group(counts, names):
+        return [
+            {'id': group_id, 'name': names.get(group_id), 'count': count}
+            for group_id, count in sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        ]
+
+    return {
+        'brand': _group(brands, brand_names),
+        'category': _group(categories, category_names),
+        'price': [
+            {'min': low, 'max': edges[i + 1] if i + 1 < len(edges) else None, 'count': buckets[i]}
+            for i, low in enumerate(edges)
+            if buckets[i]
+        ],
+    }
+
+
+search_index = register(ProductSearchIndex())
+price_index = register(ProductPriceIndex())
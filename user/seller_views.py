@@ -11,9 +11,9 @@ from . import tasks
 from api.pagination import StandardPagination,LimitOffsetPagination,ProductCursorPagination
 from api.authentication import CookieJWTAuthentication
 
-from inventory.models import Seller
+from inventory.models import Seller,Inventory
 from django.shortcuts import get_object_or_404
-from django.db.models import Q
+from django.db.models import Q,F
 
 
 class SellerAnswers(APIView):
@@ -94,3 +94,58 @@ class SellerAnswers(APIView):
 seller_ans_view=SellerAnswers.as_view()
 
 
+class SellerLowStock(APIView):
+    '''
+    Seller Low Stock API
+
+    Allows verified and Authenticated Sellers to:
+        - list their variants at or below the low stock threshold
+
+    reads the low-stock index (Inventory.low_stock), kept current by every
+    stock change, so it never loads all inventory rows
+    '''
+    permission_classes=[IsSeller]
+
+    def get(self,request):
+        '''
+        Returns the seller's low stock variants, lowest stock first
+
+        Response:
+            200 OK : low stock variants
+            Example:
+            ```json
+            {
+                "count": 1,
+                "next": null,
+                "previous": null,
+                "results": [
+                    {
+                        "product": 1,
+                        "product_name": "samsung s23",
+                        "product_variant": 12,
+                        "sku": "df42ed3111",
+                        "available_stock": 3,
+                        "reserved_stock": 2,
+                        "low_stock_threshold": 10
+                    }
+                ]
+            }
+            ```
+        '''
+        queryset=Inventory.objects \
+            .filter(low_stock=True,product_variant__product__seller__user=request.user) \
+            .order_by('available_stock','product_variant_id') \
+            .values(
+                'product_variant','available_stock','reserved_stock','low_stock_threshold',
+                product=F('product_variant__product_id'),
+                product_name=F('product_variant__product__name'),
+                sku=F('product_variant__sku'),
+            )
+
+        paginator=StandardPagination()
+        result_page=paginator.paginate_queryset(queryset,request)
+        return paginator.get_paginated_response(result_page)
+
+seller_low_stock_view=SellerLowStock.as_view()
+
+
@@ -4,6 +4,10 @@ from rest_framework import serializers
 from django.contrib.auth.password_validation import validate_password
 from rest_framework.response import Response
 from . import models 
+from .cart_store import get_cart_store
+from . import checkout
+from .stock import InsufficientStock
+from inventory import availability,reservations
 from inventory.models import Seller 
 from django.db.models import Q
 from django.utils import timezone
@@ -345,7 +349,7 @@ class CartItemRetrieveSerializers(serializers.ModelSerializer):
 
     product=ProductCartSerializers(read_only=True)
     cartitem=serializers.SerializerMethodField()
-    product_variant=ProductVariantSerializers(many=True,read_only=True)
+    product_variant=ProductVariantSerializers(read_only=True)
     cartprice=serializers.SerializerMethodField() 
 
     class Meta:
@@ -360,7 +364,8 @@ class CartItemRetrieveSerializers(serializers.ModelSerializer):
         return f'{url}{obj}'
     
     def get_cartprice(self, obj):
-        return obj.product.base_price * obj.quantity
+        unit_price=obj.product_variant.price if obj.product_variant else obj.product.base_price
+        return unit_price * obj.quantity
 
 
 class CartItemCreateSerializers(serializers.ModelSerializer):
@@ -381,23 +386,18 @@ class CartItemCreateSerializers(serializers.ModelSerializer):
 
     def validate(self, attrs):
         
-        product=attrs.get('product_id')
-        variant=attrs.get('variant_id')
+        product=attrs.get('product')
+        variant=attrs.get('product_variant')
 
-        if variant and variant.product != product:
+        if variant and variant.product_id != product.id:
             raise serializers.ValidationError(
                 "Selected variant does not belong to this product")
-        
-        if variant:
-            if variant.stock_qty>attrs['quantity']:
-                raise serializers.ValidationError(
-                f"Only {variant.stock_qty} items available"
-                )
-            else :
-                if product.stock_qty > attrs['quantity']:
-                    raise serializers.ValidationError(
-                    f"Only {product.stock_qty} items available"
-                    )
+
+        available=availability.sellable(product.id,variant.id if variant else None) or 0
+        if attrs.get('quantity',1) > available:
+            raise serializers.ValidationError(
+                f"Only {available} items available"
+            )
 
         return attrs
 
@@ -475,38 +475,18 @@ class OrderSerializer(serializers.ModelSerializer):
         if not order_items:
             raise serializers.ValidationError("Order must contain at least one item")
 
-        subtotal = Decimal('0')
-        order_item_objects = []
-
-        for item in order_items:
-            product = models.Product.objects.select_for_update().get(id=item['product'].id)
-            variant = item.get('product_variant')
-            quantity = item['quantity']
-
-            if product.stock_qty < quantity:
-                raise serializers.ValidationError(
-                    f"'{product.name}' only has {product.stock_qty} units left"
-                )
-
-            unit_price = variant.price if variant else product.base_price
-            total_price = quantity * unit_price
-
-            subtotal += total_price
-
-            #  Don't deduct stock here — lets do  it in webhook after payment confirmed
-            # product.stock_qty -= quantity
-            # product.save()
-
-            order_item_objects.append(
-                models.OrderItem(
-                    product=product,
-                    product_variant=variant,
-                    quantity=quantity,
-                    unit_price=unit_price,
-                    total_price=total_price,
-                    discount_applied=Decimal('0'),
-                )
-            )
+        lines = checkout.lines_from_items(order_items)
+
+        # fail fast on one availability lookup, before any lock is taken
+        checkout.check_availability(lines)
+
+        # one locking query per table, ids ascending; stock checked again and
+        # prices computed in memory from the locked rows
+        products, variants = checkout.lock_stock(lines)
+        order_item_objects, subtotal = checkout.price_lines(lines, products, variants)
+
+        #  Don't deduct stock here — lets do  it in webhook after payment confirmed
+
         import uuid
 
         order_number = f"ORD-{uuid.uuid4().hex[:10].upper()}"
@@ -527,14 +507,17 @@ class OrderSerializer(serializers.ModelSerializer):
             **validated_data
         )
 
-        for obj in order_item_objects:
-            obj.order = order
+        checkout.create_order_items(order, order_item_objects)
 
-        models.OrderItem.objects.bulk_create(order_item_objects)
+        # hold the units until payment, released by the sweeper if it never comes
+        try:
+            reservations.reserve(order, user=self.context['request'].user)
+        except InsufficientStock as e:
+            raise serializers.ValidationError(
+                [f"variant {line.variant_id} does not have {line.quantity} units left to reserve" for line in e.failed]
+            )
 
-        cart=models.Cart.objects.get(user=self.context['request'].user)
-        
-        models.CartItem.objects.filter(cart=cart).delete()
+        get_cart_store().clear(self.context['request'].user)
 
         return order
     
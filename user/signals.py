@@ -0,0 +1,121 @@
+from django.db import transaction
+from django.db.models.signals import post_save,post_delete
+from django.dispatch import receiver
+
+from . import models
+from . import search
+from .cache import get_product_cache
+from .suggest import suggest_index
+from api.models import User
+from inventory import availability,reservations
+from inventory.models import Inventory,Seller
+
+
+def _bump_product(product_id):
+    # bump after commit so a reader can never cache uncommitted rows under the new version
+    if product_id:
+        transaction.on_commit(lambda: get_product_cache().bump(product_id))
+
+
+def _bump_catalog():
+    transaction.on_commit(lambda: get_product_cache().bump_catalog())
+
+
+def _reindex(product_ids):
+    transaction.on_commit(lambda: search.products_changed(product_ids))
+
+
+@receiver([post_save,post_delete],sender=models.Product)
+def product_changed(sender,instance,**kwargs):
+    _bump_product(instance.pk)
+
+
+@receiver([post_save,post_delete],sender=models.ProductVariant)
+@receiver([post_save,post_delete],sender=models.ProductImage)
+@receiver([post_save,post_delete],sender=models.Review)
+@receiver([post_save,post_delete],sender=models.QnA)
+def product_child_changed(sender,instance,**kwargs):
+    _bump_product(instance.product_id)
+
+
+@receiver([post_save,post_delete],sender=models.Brand)
+@receiver([post_save,post_delete],sender=models.Category)
+def group_changed(sender,instance,created=False,**kwargs):
+    # cached payloads embed brand and category names, a new row is in none of them
+    if not created:
+        _bump_catalog()
+
+
+@receiver(post_save,sender=User)
+def seller_user_changed(sender,instance,created,update_fields=None,**kwargs):
+    # payloads embed the seller's username; login only writes last_login
+    if created or (update_fields is not None and 'username' not in update_fields):
+        return
+    if Seller.objects.filter(user=instance).exists():
+        _bump_catalog()
+
+
+@receiver([post_save,post_delete],sender=models.Product)
+def product_stock_changed(sender,instance,**kwargs):
+    availability.invalidate(product_ids=[instance.pk])
+
+
+@receiver([post_save,post_delete],sender=models.ProductVariant)
+def variant_stock_changed(sender,instance,**kwargs):
+    availability.invalidate(variant_ids=[instance.pk])
+
+
+@receiver(post_save,sender=models.ProductVariant)
+def variant_restocked(sender,instance,created,update_fields=None,**kwargs):
+    # Inventory.total_stock follows stock_qty once the variant has a row (inventory/reservations.py)
+    if created or (update_fields is not None and 'stock_qty' not in update_fields):
+        return
+    reservations.sync_stock([instance.pk])
+
+
+@receiver([post_save,post_delete],sender=Inventory)
+def inventory_changed(sender,instance,**kwargs):
+    availability.invalidate(variant_ids=[instance.product_variant_id])
+
+
+@receiver(post_save,sender=models.Product)
+def index_product(sender,instance,**kwargs):
+    _reindex([instance.pk])
+
+
+@receiver([post_save,post_delete],sender=models.ProductVariant)
+def index_variant(sender,instance,**kwargs):
+    # variant prices feed the product's effective prices
+    _reindex([instance.product_id])
+
+
+@receiver(post_delete,sender=models.Product)
+def unindex_product(sender,instance,**kwargs):
+    product_id=instance.pk
+    transaction.on_commit(lambda: search.products_removed([product_id]))
+
+
+@receiver(post_save,sender=models.Brand)
+@receiver(post_save,sender=models.Category)
+def reindex_group(sender,instance,created,**kwargs):
+    # a renamed brand/category changes the tokens of all its products
+    if created or not search.any_built():
+        return
+    field='brand_id' if sender is models.Brand else 'category_id'
+    _reindex(list(models.Product.objects.filter(**{field:instance.pk}).values_list('id',flat=True)))
+
+
+@receiver(post_save,sender=models.Brand)
+@receiver(post_save,sender=models.Category)
+def suggest_group(sender,instance,**kwargs):
+    kind='brand' if sender is models.Brand else 'category'
+    group_id,name=instance.pk,instance.name
+    transaction.on_commit(lambda: suggest_index.update_group(kind,group_id,name))
+
+
+@receiver(post_delete,sender=models.Brand)
+@receiver(post_delete,sender=models.Category)
+def unsuggest_group(sender,instance,**kwargs):
+    kind='brand' if sender is models.Brand else 'category'
+    group_id=instance.pk
+    transaction.on_commit(lambda: suggest_index.remove_group(kind,group_id))
@@ -0,0 +1,111 @@
+'''
+Stock commits
+
+Deducts stock for confirmed orders with conditional UPDATEs
+
+    UPDATE ... SET stock_qty = stock_qty - n WHERE id = ? AND stock_qty >= n
+
+one per product and one per variant, so the database does the check and the
+decrement in a single step: no row is read into Python, two confirmations
+can never both spend the last unit and nothing is lost between a read and
+a save. A variant line takes stock from the variant and from its product
+(Product.stock_qty holds the total over all variants).
+
+QuerySet.update() sends no post_save, the product detail cache and the
+availability cache (inventory/availability.py) are invalidated here.
+Inventory rows are not touched: payment paths take the same units from
+them with inventory.reservations.commit_order().
+'''
+from collections import defaultdict, namedtuple
+
+from django.db import transaction
+from django.db.models import F
+
+from . import models
+from .cache import get_product_cache
+from inventory import availability
+
+
+StockLine = namedtuple('StockLine', ['product_id', 'variant_id', 'quantity'])
+
+
+class InsufficientStock(Exception):
+    '''
+    Raised by commit() when some lines could not be deducted, nothing is deducted then
+    '''
+
+    def __init__(self, failed):
+        self.failed = failed
+        super().__init__(f'{len(failed)} line(s) out of stock')
+
+
+def lines_for_order(order):
+    return [
+        StockLine(product_id, variant_id, quantity)
+        for product_id, variant_id, quantity in
+        order.items.values_list('product_id', 'product_variant_id', 'quantity')
+    ]
+
+
+def _totals(lines):
+    products = defaultdict(int)
+    variants = defaultdict(int)
+    for line in lines:
+        products[line.product_id] += line.quantity
+        if line.variant_id:
+            variants[line.variant_id] += line.quantity
+    return products, variants
+
+
+def decrement(lines):
+    '''
+    Runs the conditional UPDATEs for `lines` and returns the lines that failed
+
+    Rows are updated in ascending id order (products, then variants), the same
+    order checkout.lock_stock() locks them in. Lines that succeeded stay
+    deducted, use commit() for all or nothing.
+    '''
+    products, variants = _totals(lines)
+    failed_products, failed_variants = set(), set()
+
+    for product_id in sorted(products):
+        quantity = products[product_id]
+        updated = models.Product.objects \
+            .filter(id=product_id, stock_qty__gte=quantity) \
+            .update(stock_qty=F('stock_qty') - quantity)
+        if not updated:
+            failed_products.add(product_id)
+
+    for variant_id in sorted(variants):
+        quantity = variants[variant_id]
+        updated = models.ProductVariant.objects \
+            .filter(id=variant_id, stock_qty__gte=quantity) \
+            .update(stock_qty=F('stock_qty') - quantity)
+        if not updated:
+            failed_variants.add(variant_id)
+
+    changed = set(products) - failed_products
+    transaction.on_commit(lambda: [get_product_cache().bump(product_id) for product_id in changed])
+    availability.invalidate(changed, set(variants) - failed_variants)
+
+    return [
+        line for line in lines
+        if line.product_id in failed_products or line.variant_id in failed_variants
+    ]
+
+
+def commit(lines):
+    '''
+    Deducts stock for all `lines` or for none of them
+
+    Raises InsufficientStock with the failed lines, the savepoint is rolled back first.
+    '''
+    with transaction.atomic():
+        failed = decrement(lines)
+        if failed:
+            raise InsufficientStock(failed)
+    return lines
+
+
+def commit_order(order):
+    return commit(lines_for_order(order))
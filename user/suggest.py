@@ -0,0 +1,121 @@
+'''
+Prefix autocomplete
+
+Sorted arrays of normalized names for products, brands and categories.
+A lookup is one binary search per kind plus a short forward scan, so the
+frontend can call it on every keystroke instead of running ProductSearch.
+
+Every word start of a name is indexed, "macbook pro" is found by both
+"mac" and "pro".
+'''
+from bisect import bisect_left,insort
+
+from . import models
+from .search import CatalogIndex,TOKEN_RE,register
+
+
+KINDS = ('product', 'brand', 'category')
+
+
+def _keys(name):
+    words = TOKEN_RE.findall((name or '').lower())
+    return [' '.join(words[i:]) for i in range(len(words))]
+
+
+class _SuggestState:
+
+    def __init__(self):
+        self.entries = {kind: [] for kind in KINDS}     # kind -> sorted (key, id)
+        self.keys_of = {}                               # (kind, id) -> keys
+        self.labels = {}                                # (kind, id) -> display name
+        self.bulk = True
+
+
+class SuggestIndex(CatalogIndex):
+
+    def load_rows(self, product_ids=None):
+        products = models.Product.objects.all()
+        if product_ids is not None:
+            products = products.filter(id__in=product_ids)
+        for pid, name in products.values_list('id', 'name').iterator(chunk_size=2000):
+            yield {'kind': 'product', 'id': pid, 'name': name}
+
+        if product_ids is None:
+            for kind, model in (('brand', models.Brand), ('category', models.Category)):
+                for group_id, name in model.objects.values_list('id', 'name'):
+                    yield {'kind': kind, 'id': group_id, 'name': name}
+
+    def empty_state(self):
+        return _SuggestState()
+
+    def add(self, state, row):
+        kind, item_id = row['kind'], row['id']
+        keys = _keys(row['name'])
+        entries = state.entries[kind]
+        for key in keys:
+            if state.bulk:
+                entries.append((key, item_id))
+            else:
+                insort(entries, (key, item_id))
+        state.keys_of[(kind, item_id)] = keys
+        state.labels[(kind, item_id)] = row['name']
+
+    def finalize(self, state):
+        for entries in state.entries.values():
+            entries.sort()
+        state.bulk = False
+
+    def remove(self, state, pid, kind='product'):
+        keys = state.keys_of.pop((kind, pid), None)
+        if keys is None:
+            return
+        entries = state.entries[kind]
+        for key in keys:
+            position = bisect_left(entries, (key, pid))
+            if position < len(entries) and entries[position] == (key, pid):
+                del entries[position]
+        state.labels.pop((kind, pid), None)
+
+    def update_group(self, kind, group_id, name):
+        self.replay_after_rebuild(lambda: self.update_group(kind, group_id, name))
+        if not self.is_built():
+            return
+        with self._lock:
+            self.remove(self.state, group_id, kind)
+            self.add(self.state, {'kind': kind, 'id': group_id, 'name': name})
+
+    def remove_group(self, kind, group_id):
+        self.replay_after_rebuild(lambda: self.remove_group(kind, group_id))
+        if not self.is_built():
+            return
+        with self._lock:
+            self.remove(self.state, group_id, kind)
+
+    def suggest(self, prefix, limit=5):
+        '''
+        Returns up to `limit` completions per kind, in alphabetical order
+        '''
+        prefix = ' '.join(TOKEN_RE.findall((prefix or '').lower()))
+        if not prefix:
+            return {kind: [] for kind in KINDS}
+
+        self.ensure_built()
+        result = {}
+        with self._lock:
+            state = self.state
+            for kind in KINDS:
+                entries = state.entries[kind]
+                position = bisect_left(entries, (prefix,))
+                seen = []
+                while position < len(entries) and len(seen) < limit:
+                    key, item_id = entries[position]
+                    if not key.startswith(prefix):
+                        break
+                    if item_id not in seen:
+                        seen.append(item_id)
+                    position += 1
+                result[kind] = [{'id': item_id, 'name': state.labels[(kind, item_id)]} for item_id in seen]
+        return result
+
+
+suggest_index = register(SuggestIndex())
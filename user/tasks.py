@@ -1,6 +1,6 @@
 from celery import shared_task
 from django.conf import settings
-import boto3
+from ecommerce import clients
 import logging
 
 logger = logging.getLogger(__name__)
@@ -8,10 +8,9 @@ logger = logging.getLogger(__name__)
 @shared_task
 def notify_product_creator(product_name,username):
   try:
-    sns_client=boto3.client('sns',region_name= settings.AWS_S3_REGION_NAME)
-    SNS_TOPIC_ARN=settings.AWS_SNS_ARN
+    SNS_TOPIC_ARN=str(settings.AWS_SNS_ARN)
 
-    sns_client.publish(TopicArn=SNS_TOPIC_ARN,
+    clients.sns().publish(TopicArn=SNS_TOPIC_ARN,
                                 Message=f'$Mr.{username} you added {product_name}',
                                 Subject="seller created product",)
 
@@ -21,14 +20,12 @@ def notify_product_creator(product_name,username):
 @shared_task(bind=True,max_retries=3,default_retry_delay=60)
 
 def delete_product(user_name,product_id):
-  s3_client=boto3.client("s3",
-                           aws_access_key_id = settings.AWS_ACCESS_KEY_ID,
-                           aws_secret_access_key=settings.AWS_SECRET_ACCESS_KEY,
-                            region_name=settings.AWS_S3_REGION_NAME )
+  s3_client=clients.s3()
+  bucket=str(settings.AWS_STORAGE_BUCKET_NAME)
   try:
 
     response=s3_client.list_objects_v2(
-      Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+      Bucket=bucket,
       Prefix=f'{user_name}/{product_id}' 
       )
     
@@ -37,9 +34,68 @@ def delete_product(user_name,product_id):
         objects=[{'Key':obj['Key']} for obj in response['Contents']]
 
         s3_client.delete_objects(
-          Bucket=settings.AWS_STORAGE_BUCKET_NAME,
+          Bucket=bucket,
           Delete={'Objects':objects}
         )
 
   except Exception as e:
     logger.error(f's3 object deletion for product image failed:{e}')
+
+@shared_task
+def flush_idle_carts():
+  '''
+  writes carts that have been idle for CART_STORAGE['IDLE_FLUSH_SECONDS']
+  from the redis/local cart store to Cart/CartItem (no-op for the database store)
+  '''
+  from .cart_store import get_cart_store
+
+  idle_seconds=settings.CART_STORAGE.get('IDLE_FLUSH_SECONDS',15*60)
+  flushed=get_cart_store().flush_idle(idle_seconds)
+  if flushed:
+    logger.info(f'flushed {flushed} idle carts')
+  return flushed
+
+@shared_task(acks_late=True)
+def process_webhook_events(razorpay_order_id):
+  '''
+  handles the stored webhook events of one razorpay order in arrival order
+  '''
+  from . import webhooks
+
+  return webhooks.process_order(razorpay_order_id)
+
+@shared_task
+def process_pending_webhook_events():
+  '''
+  picks up webhook events whose task was lost or that are waiting for a retry
+  '''
+  from . import webhooks
+
+  processed=webhooks.process_pending()
+  if processed:
+    logger.info(f'processed {processed} pending webhook events')
+  return processed
+
+@shared_task
+def reconcile_payments():
+  '''
+  settles pending payments whose verify call and webhook never arrived
+  '''
+  from . import reconciliation
+
+  stats=reconciliation.reconcile()
+  if stats['captured'] or stats['failed']:
+    logger.info(f'payment reconciliation: {stats}')
+  return stats
+
+@shared_task
+def purge_idempotency_keys():
+  '''
+  deletes Idempotency-Key rows past their replay window
+  '''
+  from . import idempotency
+
+  deleted=idempotency.purge()
+  if deleted:
+    logger.info(f'purged {deleted} idempotency keys')
+  return deleted
@@ -1,3 +1,619 @@
-from django.test import TestCase
+import datetime
+import hashlib
+import hmac
+import json
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+from django.core.cache import cache
+from django.db import connection,transaction
+from django.test import TestCase,TransactionTestCase,override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.test import APIClient
+
+from api.models import User
+from inventory.models import Inventory,Seller,StockReservation
+from user import checkout,models,reconciliation,stock,webhooks
+from user.search import ProductSearchIndex
+
+
+LOCMEM_CACHES={'default':{'BACKEND':'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def make_catalog(count,stock_qty=10,variant_stock_qty=5):
+    '''
+    a seller with `count` products, one variant each
+    '''
+    seller_user=User.objects.create_user('seller','seller@example.com','pw',role_model='seller')
+    seller=Seller.objects.create(user=seller_user,business_name='seller',gst_number='GST1')
+    category=models.Category.objects.create(name='phones')
+    brand=models.Brand.objects.create(name='samsung')
+
+    products=[]
+    for i in range(count):
+        product=models.Product.objects.create(seller=seller,name=f'phone {i}',base_price=1000+i,
+                                              category=category,brand=brand,stock_qty=stock_qty,sku=f'P{i}')
+        models.ProductVariant.objects.create(product=product,color='blue',size='m',price=900+i,
+                                             stock_qty=variant_stock_qty,sku=f'V{i}')
+        models.ProductImage.objects.create(product=product,image_url='https://example.com/p.jpg')
+        products.append(product)
+    return products
+
+
+@override_settings(CACHES=LOCMEM_CACHES,CART_STORAGE={'BACKEND':'database'})
+class CartQueryCountTest(TestCase):
+    '''
+    GET /user/cart/ runs the same number of queries whatever the cart size
+    '''
+
+    # count, one page of cart items joined to their products, then one prefetch
+    # each for images, variants and reviews
+    QUERIES=5
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products=make_catalog(20)
+        cls.buyer=User.objects.create_user('buyer','buyer@example.com','pw',role_model='buyer')
+        cls.cart=models.Cart.objects.create(user=cls.buyer)
+
+    def setUp(self):
+        cache.clear()
+        self.client=APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def fill_cart(self,count):
+        for product in self.products[:count]:
+            models.CartItem.objects.create(cart=self.cart,product=product,
+                                           product_variant=product.variants.first(),quantity=1)
+
+    def test_one_item(self):
+        self.fill_cart(1)
+        with self.assertNumQueries(self.QUERIES):
+            response=self.client.get('/user/cart/')
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(len(response.json()),1)
+
+    def test_twenty_items(self):
+        self.fill_cart(20)
+        with self.assertNumQueries(self.QUERIES):
+            response=self.client.get('/user/cart/')
+        self.assertEqual(response.status_code,200)
+        self.assertEqual(len(response.json()),5)
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class CheckoutLockTest(TestCase):
+    '''
+    checkout.lock_stock() / price_lines(): ordered locks, stock checked on the locked rows
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products=make_catalog(3,stock_qty=10,variant_stock_qty=5)
+        cls.variants=[product.variants.get() for product in cls.products]
+        cls.buyer=User.objects.create_user('buyer','buyer@example.com','pw',role_model='buyer')
+
+    def setUp(self):
+        cache.clear()
+
+    def line(self,index,quantity,variant=False):
+        product=self.products[index]
+        return checkout.CheckoutLine(product.id,self.variants[index].id if variant else None,quantity)
+
+    def price(self,lines):
+        products,variants=checkout.lock_stock(lines)
+        return checkout.price_lines(lines,products,variants)
+
+    def test_one_locking_query_per_table_in_id_order(self):
+        # lines deliberately out of id order
+        lines=[self.line(2,1,variant=True),self.line(0,1),self.line(1,1,variant=True)]
+        with CaptureQueriesContext(connection) as queries:
+            products,variants=checkout.lock_stock(lines)
+
+        self.assertEqual(len(queries),2)
+        product_sql,variant_sql=(query['sql'] for query in queries)
+        self.assertIn('"user_product"',product_sql)
+        self.assertIn('ORDER BY "user_product"."id" ASC',product_sql)
+        self.assertIn('ORDER BY "user_productvariant"."id" ASC',variant_sql)
+        self.assertEqual(list(products),sorted(products))
+        self.assertEqual(list(variants),sorted(variants))
+
+    def test_lines_within_stock_are_priced(self):
+        order_items,subtotal=self.price([self.line(0,5,variant=True),self.line(1,10)])
+        self.assertEqual(len(order_items),2)
+        self.assertEqual(subtotal,5*self.variants[0].price+10*self.products[1].base_price)
+
+    def test_variant_quantities_are_added_up(self):
+        with self.assertRaises(serializers.ValidationError):
+            self.price([self.line(0,3,variant=True),self.line(0,3,variant=True)])
+
+    def test_variant_lines_count_against_their_product(self):
+        # 5 units of the variant and 6 of the product alone: 11 > 10
+        with self.assertRaises(serializers.ValidationError):
+            self.price([self.line(0,5,variant=True),self.line(0,6)])
+
+    def test_stale_cache_is_caught_under_the_lock(self):
+        checkout.check_availability([self.line(0,8)])  # caches 10 units
+        models.Product.objects.filter(id=self.products[0].id).update(stock_qty=2)
+        checkout.check_availability([self.line(0,8)])
+        with self.assertRaises(serializers.ValidationError):
+            self.price([self.line(0,8)])
+
+    def test_unpaid_orders_hold_product_units(self):
+        order=models.Order.objects.create(user=self.buyer,order_number='held',subtotal=0,total_amount=0)
+        models.OrderItem.objects.create(order=order,product=self.products[0],quantity=6,unit_price=1,total_price=6)
+
+        with self.assertRaises(serializers.ValidationError):
+            self.price([self.line(0,6)])
+        self.price([self.line(0,4)])
+
+        order.status='processing'
+        order.save()
+        self.price([self.line(0,6)])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StockDecrementRaceTest(TestCase):
+    '''
+    stock.decrement() / commit() when the variant row changes after the caller checked it
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.product=make_catalog(1,stock_qty=10,variant_stock_qty=5)[0]
+        cls.variant=cls.product.variants.get()
+
+    def setUp(self):
+        cache.clear()
+        self.line=stock.StockLine(self.product.id,self.variant.id,4)
+
+    def sold_elsewhere(self,stock_qty):
+        '''
+        patches the variant manager so another writer sets stock_qty right before the UPDATE runs
+        '''
+        manager=models.ProductVariant.objects
+
+        def filter(*args,**kwargs):
+            manager.all().filter(id=self.variant.id).update(stock_qty=stock_qty)
+            return manager.all().filter(*args,**kwargs)
+        return mock.patch.object(manager,'filter',side_effect=filter)
+
+    def stock_qty(self):
+        self.product.refresh_from_db()
+        self.variant.refresh_from_db()
+        return self.product.stock_qty,self.variant.stock_qty
+
+    def test_decrement_returns_the_line_and_writes_no_negative_stock(self):
+        self.assertGreaterEqual(self.variant.stock_qty,self.line.quantity)
+        with self.sold_elsewhere(2):
+            failed=stock.decrement([self.line])
+
+        self.assertEqual(failed,[self.line])
+        # the product row was still deducted, decrement() is not all or nothing
+        self.assertEqual(self.stock_qty(),(6,2))
+
+    def test_commit_rolls_back_the_product(self):
+        with self.sold_elsewhere(2),self.assertRaises(stock.InsufficientStock) as raised:
+            stock.commit([self.line])
+
+        self.assertEqual(raised.exception.failed,[self.line])
+        # the stand-in writer ran inside the same savepoint and was rolled back with it
+        self.assertEqual(self.stock_qty(),(10,5))
+
+
+@override_settings(CACHES=LOCMEM_CACHES,CART_STORAGE={'BACKEND':'database'})
+class ConcurrentCheckoutTest(TransactionTestCase):
+    '''
+    Checkouts racing for the same stock: the locks let exactly one through
+
+    Row locks on postgres, the write lock every sqlite transaction takes at
+    BEGIN IMMEDIATE (settings.DATABASES) otherwise.
+    '''
+
+    def setUp(self):
+        self.product=make_catalog(1,stock_qty=10,variant_stock_qty=5)[0]
+        self.variant=self.product.variants.get()
+        self.buyer=User.objects.create_user('buyer','buyer@example.com','pw',role_model='buyer')
+        self.address=models.Address.objects.create(user=self.buyer,city='c',state='s',country='in',phone_number='1')
+
+    def place_order(self,statuses,item,barrier=None):
+        client=APIClient()
+        client.force_authenticate(self.buyer)
+        try:
+            if barrier is not None:
+                barrier.wait()
+            response=client.post('/user/order/',{
+                'shipping_address':self.address.id,
+                'billing_address':self.address.id,
+                'items':[item],
+            },format='json')
+            statuses.append(response.status_code)
+        finally:
+            connection.close()
+
+    def race(self,count,item):
+        barrier=threading.Barrier(count)
+        statuses=[]
+        threads=[threading.Thread(target=self.place_order,args=(statuses,item,barrier)) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return sorted(statuses)
+
+    def test_one_of_three_orders_fits(self):
+        self.assertEqual(self.race(3,{'product':self.product.id,'quantity':6}),[201,400,400])
+        self.assertEqual(models.Order.objects.count(),1)
+
+    def test_one_of_two_variant_orders_is_reserved(self):
+        item={'product':self.product.id,'product_variant':self.variant.id,'quantity':3}
+        self.assertEqual(self.race(2,item),[201,400])
+
+        inventory=Inventory.objects.get(product_variant=self.variant)
+        self.assertEqual((inventory.available_stock,inventory.reserved_stock),(2,3))
+        self.assertEqual(StockReservation.objects.get().quantity,3)
+
+    def test_checkout_waits_for_the_lock_holder_and_sees_its_write(self):
+        locked,release=threading.Event(),threading.Event()
+
+        def sell_elsewhere():
+            # another transaction holds the product row while it sells 6 units
+            try:
+                with transaction.atomic():
+                    product=models.Product.objects.select_for_update().get(id=self.product.id)
+                    product.stock_qty-=6
+                    product.save(update_fields=['stock_qty'])
+                    locked.set()
+                    release.wait(10)
+            finally:
+                connection.close()
+
+        holder=threading.Thread(target=sell_elsewhere)
+        holder.start()
+        self.assertTrue(locked.wait(10))
+
+        statuses=[]
+        checkout_thread=threading.Thread(target=self.place_order,
+                                         args=(statuses,{'product':self.product.id,'quantity':6}))
+        checkout_thread.start()
+        # without the lock the checkout would read 10 units and answer right away
+        checkout_thread.join(0.5)
+        self.assertTrue(checkout_thread.is_alive())
+        self.assertEqual(statuses,[])
+
+        release.set()
+        holder.join()
+        checkout_thread.join()
+        self.assertEqual(statuses,[400])
+        self.assertFalse(models.Order.objects.exists())
+
+
+def place_order(buyer,product,quantity=1):
+    '''
+    an unpaid order for one variant line through the order view, its units reserved
+    '''
+    address=models.Address.objects.create(user=buyer,city='c',state='s',country='in',phone_number='1')
+    client=APIClient()
+    client.force_authenticate(buyer)
+    response=client.post('/user/order/',{
+        'shipping_address':address.id,
+        'billing_address':address.id,
+        'items':[{'product':product.id,'product_variant':product.variants.get().id,'quantity':quantity}],
+    },format='json')
+    assert response.status_code==201,response.content
+    return models.Order.objects.latest('id')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ReconciliationTest(TestCase):
+    '''
+    reconcile() against FakeGatewayClient: captured, failed and unchanged payments
+    '''
+
+    def setUp(self):
+        cache.clear()
+        self.products=make_catalog(3,stock_qty=10,variant_stock_qty=5)
+        self.buyer=User.objects.create_user('buyer','buyer@example.com','pw',role_model='buyer')
+        self.orders=[place_order(self.buyer,product,2) for product in self.products]
+        for i,order in enumerate(self.orders):
+            models.Payment.objects.create(order=order,amount=order.total_amount,razorpay_order_id=f'rzp_{i}')
+
+    def reconcile(self,payments):
+        client=reconciliation.FakeGatewayClient(payments)
+        return reconciliation.reconcile(client=client,cutoff=timezone.now()+datetime.timedelta(seconds=1),
+                                        batch_size=2,chunk_size=1,workers=2)
+
+    def inventory(self,index):
+        return Inventory.objects.get(product_variant__product=self.products[index])
+
+    def test_captured_failed_and_unchanged(self):
+        stats=self.reconcile({
+            'rzp_0':reconciliation.GatewayPayment('captured','pay_0','upi'),
+            'rzp_1':reconciliation.GatewayPayment('failed','pay_1','card'),
+        })
+        self.assertEqual(stats,{'checked':3,'captured':1,'failed':1,'unchanged':1})
+
+        captured,failed,unchanged=(models.Payment.objects.select_related('order').get(order=order) for order in self.orders)
+
+        self.assertEqual((captured.status,captured.transaction_id,captured.payment_method),('completed','pay_0','upi'))
+        self.assertEqual(captured.order.status,'processing')
+        self.assertEqual(self.products[0].variants.get().stock_qty,3)
+        self.assertEqual((self.inventory(0).available_stock,self.inventory(0).reserved_stock),(3,0))
+        self.assertEqual(StockReservation.objects.get(order=self.orders[0]).status,'committed')
+
+        self.assertEqual(failed.status,'failed')
+        self.assertEqual(failed.order.status,'pending')
+        self.assertEqual((self.inventory(1).available_stock,self.inventory(1).reserved_stock),(5,0))
+        self.assertEqual(StockReservation.objects.get(order=self.orders[1]).status,'released')
+
+        self.assertEqual(unchanged.status,'pending')
+        self.assertEqual((self.inventory(2).available_stock,self.inventory(2).reserved_stock),(3,2))
+        self.assertEqual(StockReservation.objects.get(order=self.orders[2]).status,'active')
+
+        # a second run only sees the payment still pending
+        self.assertEqual(self.reconcile({})['checked'],1)
+
+    def test_captured_without_stock_keeps_the_order_pending(self):
+        models.ProductVariant.objects.filter(product=self.products[0]).update(stock_qty=1)
+        self.reconcile({'rzp_0':reconciliation.GatewayPayment('captured','pay_0','upi')})
+
+        payment=models.Payment.objects.select_related('order').get(order=self.orders[0])
+        self.assertEqual(payment.status,'completed')
+        self.assertEqual(payment.order.status,'pending')
+        self.assertEqual(StockReservation.objects.get(order=self.orders[0]).status,'active')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class IdempotencyKeyTest(TestCase):
+    '''
+    Idempotency-Key on POST /user/order/
+    '''
+
+    def setUp(self):
+        cache.clear()
+        self.product=make_catalog(1,stock_qty=10,variant_stock_qty=5)[0]
+        self.buyers=[User.objects.create_user(f'buyer{i}',f'buyer{i}@example.com','pw',role_model='buyer')
+                     for i in range(2)]
+
+    def post(self,buyer,quantity=1,key='key-1'):
+        address=models.Address.objects.filter(user=buyer).first() or \
+            models.Address.objects.create(user=buyer,city='c',state='s',country='in',phone_number='1')
+        client=APIClient()
+        client.force_authenticate(buyer)
+        return client.post('/user/order/',{
+            'shipping_address':address.id,
+            'billing_address':address.id,
+            'items':[{'product':self.product.id,'quantity':quantity}],
+        },format='json',HTTP_IDEMPOTENCY_KEY=key)
+
+    def test_repeat_with_the_same_body_is_replayed(self):
+        first=self.post(self.buyers[0])
+        repeat=self.post(self.buyers[0])
+
+        self.assertEqual(first.status_code,201)
+        self.assertEqual(repeat.status_code,201)
+        self.assertEqual(repeat['Idempotent-Replayed'],'true')
+        self.assertEqual(repeat.json(),first.json())
+        self.assertEqual(models.Order.objects.count(),1)
+
+    def test_repeat_with_another_body_is_rejected(self):
+        self.post(self.buyers[0],quantity=1)
+        response=self.post(self.buyers[0],quantity=2)
+
+        self.assertEqual(response.status_code,422)
+        self.assertEqual(models.Order.objects.count(),1)
+
+    def test_keys_are_per_user(self):
+        first=self.post(self.buyers[0])
+        other=self.post(self.buyers[1])
+
+        self.assertEqual(other.status_code,201)
+        self.assertNotIn('Idempotent-Replayed',other)
+        self.assertNotEqual(other.json(),first.json())
+        self.assertEqual(models.Order.objects.count(),2)
+        self.assertEqual(models.IdempotencyKey.objects.count(),2)
+
+    def test_key_is_released_when_the_view_raises(self):
+        with mock.patch('user.checkout.lock_stock',side_effect=RuntimeError('db went away')):
+            with self.assertRaises(RuntimeError):
+                self.post(self.buyers[0])
+        self.assertFalse(models.IdempotencyKey.objects.exists())
+
+        # the retry runs the view instead of replaying or waiting on the dead claim
+        retry=self.post(self.buyers[0])
+        self.assertEqual(retry.status_code,201)
+        self.assertNotIn('Idempotent-Replayed',retry)
+        self.assertEqual(models.Order.objects.count(),1)
+
+
+def webhook_payload(event,razorpay_order_id,payment_id='pay_1',method='upi'):
+    return {'event':event,'payload':{'payment':{'entity':{
+        'id':payment_id,'order_id':razorpay_order_id,'method':method}}}}
+
+
+@override_settings(RAZORPAY_WEBHOOK_SECRET='whsec',RAZORPAY_KEY_ID='key',RAZORPAY_KEY_SECRET='secret')
+@mock.patch('user.tasks.process_webhook_events.delay')
+class WebhookViewTest(TestCase):
+    '''
+    POST /user/payments/webhook/: signature check and dedup on X-Razorpay-Event-Id
+    '''
+
+    def deliver(self,payload,event_id='evt_1',secret='whsec'):
+        body=json.dumps(payload).encode()
+        signature=hmac.new(secret.encode(),body,hashlib.sha256).hexdigest()
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/user/payments/webhook/',body,content_type='application/json',
+                                    HTTP_X_RAZORPAY_SIGNATURE=signature,HTTP_X_RAZORPAY_EVENT_ID=event_id)
+
+    def test_bad_signature_is_rejected(self,delay):
+        response=self.deliver(webhook_payload('payment.captured','rzp_1'),secret='not-the-secret')
+        self.assertEqual(response.status_code,400)
+        self.assertFalse(models.WebhookEvent.objects.exists())
+        self.assertFalse(delay.called)
+
+    def test_event_is_stored_and_queued(self,delay):
+        payload=webhook_payload('payment.captured','rzp_1')
+        self.assertEqual(self.deliver(payload).status_code,200)
+        # the gateway retries the same event id
+        self.assertEqual(self.deliver(payload).status_code,200)
+
+        event=models.WebhookEvent.objects.get()
+        self.assertEqual((event.event_id,event.razorpay_order_id,event.status),('evt_1','rzp_1','pending'))
+        delay.assert_called_once_with('rzp_1')
+
+
+@override_settings(CACHES=LOCMEM_CACHES,WEBHOOKS={'BATCH_SIZE':100,'MAX_ATTEMPTS':2})
+class WebhookProcessingTest(TestCase):
+    '''
+    webhooks.process_order() / process_pending(): arrival order, retries and the payment writes
+    '''
+
+    def setUp(self):
+        cache.clear()
+        self.received_at=timezone.now()-datetime.timedelta(minutes=5)
+
+    def store(self,event_id,payload,seconds):
+        '''
+        a pending event received `seconds` after self.received_at
+        '''
+        event=models.WebhookEvent.objects.create(event_id=event_id,event=payload['event'],
+                                                 razorpay_order_id=webhooks._razorpay_order_id(payload),
+                                                 payload=payload)
+        models.WebhookEvent.objects.filter(id=event.id) \
+            .update(received_at=self.received_at+datetime.timedelta(seconds=seconds))
+        return event
+
+    def statuses(self):
+        return dict(models.WebhookEvent.objects.values_list('event_id','status'))
+
+    def test_events_of_an_order_run_in_arrival_order(self):
+        # stored out of arrival order
+        self.store('late',webhook_payload('payment.failed','rzp_1'),2)
+        self.store('early',webhook_payload('payment.captured','rzp_1'),1)
+        self.store('other',webhook_payload('payment.captured','rzp_2'),0)
+
+        handled=[]
+        with mock.patch('user.webhooks.handle',side_effect=lambda event: handled.append(event.event_id)):
+            self.assertEqual(webhooks.process_order('rzp_1'),2)
+
+        self.assertEqual(handled,['early','late'])
+        self.assertEqual(self.statuses(),{'early':'processed','late':'processed','other':'pending'})
+
+    def test_failure_delivered_after_the_capture_does_not_undo_it(self):
+        product=make_catalog(1)[0]
+        buyer=User.objects.create_user('buyer','buyer@example.com','pw',role_model='buyer')
+        order=place_order(buyer,product,2)
+        models.Payment.objects.create(order=order,amount=order.total_amount,razorpay_order_id='rzp_1')
+        self.store('captured',webhook_payload('payment.captured','rzp_1','pay_1','card'),1)
+        self.store('failed',webhook_payload('payment.failed','rzp_1','pay_0'),2)
+
+        self.assertEqual(webhooks.process_order('rzp_1'),2)
+
+        payment=models.Payment.objects.select_related('order').get(order=order)
+        self.assertEqual((payment.status,payment.transaction_id,payment.payment_method),
+                         ('completed','pay_1','credit_card'))
+        self.assertEqual(payment.order.status,'processing')
+        self.assertEqual(StockReservation.objects.get(order=order).status,'committed')
+
+    def test_failing_event_is_retried_and_holds_back_its_order(self):
+        self.store('first',webhook_payload('payment.captured','rzp_1'),1)
+        self.store('second',webhook_payload('payment.failed','rzp_1'),2)
+        self.store('other',webhook_payload('payment.captured','rzp_2'),3)
+
+        calls=[]
+
+        def handle(event):
+            calls.append(event.event_id)
+            if event.event_id=='first' and calls.count('first')==1:
+                raise RuntimeError('gateway hiccup')
+
+        with mock.patch('user.webhooks.handle',side_effect=handle),self.assertLogs('user.webhooks','ERROR'):
+            # the other order is not held back
+            self.assertEqual(webhooks.process_pending(),1)
+            self.assertEqual(self.statuses(),{'first':'pending','second':'pending','other':'processed'})
+            self.assertEqual(models.WebhookEvent.objects.get(event_id='first').last_error,'gateway hiccup')
+
+            self.assertEqual(webhooks.process_pending(),2)
+
+        self.assertEqual(calls,['first','other','first','second'])
+        self.assertEqual(self.statuses(),{'first':'processed','second':'processed','other':'processed'})
+        self.assertEqual(models.WebhookEvent.objects.get(event_id='first').attempts,2)
+
+    def test_event_gives_up_after_max_attempts(self):
+        self.store('broken',webhook_payload('payment.captured','rzp_1'),1)
+        self.store('next',webhook_payload('payment.failed','rzp_1'),2)
+
+        def handle(event):
+            if event.event_id=='broken':
+                raise RuntimeError('bad payload')
+
+        with mock.patch('user.webhooks.handle',side_effect=handle),self.assertLogs('user.webhooks','ERROR') as logs:
+            self.assertEqual(webhooks.process_pending(),0)
+            # second and last attempt: marked failed, the next event goes through
+            self.assertEqual(webhooks.process_pending(),1)
+            self.assertEqual(webhooks.process_pending(),0)
+
+        self.assertEqual(len(logs.records),2)
+        self.assertEqual(self.statuses(),{'broken':'failed','next':'processed'})
+
+
+class SearchIndexRefreshTest(TestCase):
+    '''
+    CatalogIndex refreshes off the request thread, ProductSearchIndex keeps its ids presorted
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products=make_catalog(4)
+
+    def setUp(self):
+        self.index=ProductSearchIndex()
+        self.index.rebuild()
+
+    def test_stale_index_is_rebuilt_in_another_thread(self):
+        done=threading.Event()
+        threads=[]
+
+        def rebuild():
+            threads.append(threading.current_thread())
+            done.set()
+
+        self.index._built_at=time.monotonic()-10**6
+        with mock.patch.object(self.index,'rebuild',side_effect=rebuild),mock.patch('user.search.connection'):
+            ids,_=self.index.rank()
+            self.assertTrue(done.wait(5))
+
+        # answered from the state it already had
+        self.assertEqual(ids,[product.id for product in self.products])
+        self.assertIsNot(threads[0],threading.current_thread())
+
+    def test_changes_made_during_a_rebuild_are_kept(self):
+        load_rows=self.index.load_rows
+        added=[]
+
+        def slow_load_rows(product_ids=None):
+            rows=list(load_rows(product_ids))
+            if product_ids is None and not added:
+                # committed after the full build read its rows
+                product=models.Product.objects.create(seller=self.products[0].seller,name='tablet',base_price=1,
+                                                      category=self.products[0].category,
+                                                      brand=self.products[0].brand,sku='T1')
+                added.append(product.id)
+                self.index.update_products([product.id])
+            return iter(rows)
+
+        with mock.patch.object(self.index,'load_rows',side_effect=slow_load_rows):
+            self.index.rebuild()
+        self.assertEqual(self.index.search('tablet'),added)
+
+    def test_unfiltered_ids_stay_sorted(self):
+        first,*_,last=self.products
+        self.index.remove_products([first.id])
+        self.assertEqual(self.index.search(),[product.id for product in self.products[1:]])
+
+        self.index.update_products([first.id,last.id])
+        self.assertEqual(self.index.search(),[product.id for product in self.products])
+        self.assertEqual(self.index.search(brand='samsung'),[product.id for product in self.products])
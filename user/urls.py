@@ -8,6 +8,7 @@ urlpatterns=[
     path('product/create/',product_views.product_create_view,name='product-create'),
     path('product/detail/<int:pk>',product_views.product_detail_view,name='product-detail'),
     path('product/search/',product_views.product_search_view,name='product-search'),
+    path('product/suggest/',product_views.product_suggest_view,name='product-suggest'),
     path('product/image/',product_views.productImage_retrieve_view,name='product-image'),
     path('product/categories/',views.category_view,name='category-create'),
     path('product/detail/review/',views.review_list_view,name='product-review'),
@@ -15,13 +16,17 @@ urlpatterns=[
     path('product/customer-qxn/',views.customer_qxns_view,name='qna'),
     path('address/',views.address_create_view,name='address-create'),
     path('cart/',cart_views.cartitem_view,name='cart-item'),
+    path('cart/summary/',cart_views.cart_summary_view,name='cart-summary'),
+    path('cart/batch/',cart_views.cart_batch_view,name='cart-batch'),
     path('brand/',views.brand_list_create_view,name='brands'),
     path('whishlist/',cart_views.wishlist_view,name='whishlist'),
     path('order/',order_views.order_list_create_view,name='order'),
     path('seller/orders/', order_views.seller_order_list_view),
+    path('seller/low-stock/',seller_views.seller_low_stock_view,name='seller-low-stock'),
     path("payments/cod/", payment_views.CashOnDeliveryView.as_view()),        
     path("payments/cod/<int:order_id>/confirm/", payment_views.ConfirmCODPaymentView.as_view()),
     path("payments/create/", payment_views.CreateRazorpayOrderView.as_view()),
     path("payments/verify/", payment_views.VerifyPaymentView.as_view()),
+    path("payments/webhook/", payment_views.razorpay_webhook),
 
 ]
\ No newline at end of file
@@ -10,8 +10,8 @@ from api.authentication import CookieJWTAuthentication
 from . import models
 from . import serializers
 
-import anthropic
 from django.conf import settings
+from ecommerce import clients
 
 
 class AddressView(generics.GenericAPIView):
@@ -513,8 +513,11 @@ class AnthropicProxyView(APIView):
             if auth_header.startswith("Bearer "):
                 jwt_token = auth_header.split(" ", 1)[1]
 
+        # the SDK takes over a second to import, load it on the first prompt instead of at worker boot
+        import anthropic
+
         try:
-            client = anthropic.Anthropic(api_key=settings.ANTHROPIC_API_KEY)
+            client = clients.anthropic()
 
             message = client.beta.messages.create(
                 model="claude-opus-4-5",
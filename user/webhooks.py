@@ -0,0 +1,222 @@
+'''
+Razorpay webhook queue
+
+The webhook view only verifies the signature and stores the delivery as a
+WebhookEvent, deduplicated on X-Razorpay-Event-Id, then answers 200. The
+payment, order and stock writes happen in a celery worker:
+
+    ingest(body, headers)             view    store event, queue process_order()
+    process_order(razorpay_order_id)  worker  pending events of one order, oldest first
+    process_pending()                 beat    anything left pending (lost task, retries)
+
+Events of one razorpay order are handled in the order they arrived: the
+worker locks all of that order's pending rows with one SELECT ... FOR UPDATE
+ordered by arrival, so a second worker for the same order waits and then
+only sees what is still pending. Different orders run in parallel.
+
+Delivery is at least once. A worker that dies leaves its events pending,
+the task is acked late and the beat sweep picks up the rest, so handlers
+must be safe to run twice (a completed payment is left alone). A failing
+event is retried up to settings.WEBHOOKS['MAX_ATTEMPTS'] times and holds
+back the later events of its order until then.
+'''
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from inventory import reservations
+
+from . import models
+from . import stock
+
+
+logger = logging.getLogger(__name__)
+
+
+METHOD_MAP = {
+    "upi": "upi",
+    "card": "credit_card",     # refine further if needed
+    "netbanking": "online_banking",
+    "wallet": "wallet",
+}
+
+
+def _config():
+    config = getattr(settings, 'WEBHOOKS', {})
+    return config.get('BATCH_SIZE', 100), config.get('MAX_ATTEMPTS', 10)
+
+
+def _razorpay_order_id(payload):
+    entities = payload.get('payload') or {}
+    payment = (entities.get('payment') or {}).get('entity') or {}
+    order = (entities.get('order') or {}).get('entity') or {}
+    return payment.get('order_id') or order.get('id')
+
+
+def ingest(body, headers):
+    '''
+    Stores a verified delivery, returns the new WebhookEvent or None for a duplicate
+
+    Raises ValueError when the body is not JSON.
+    '''
+    payload = json.loads(body)
+    event_id = headers.get('X-Razorpay-Event-Id') or hashlib.sha256(body).hexdigest()
+    razorpay_order_id = _razorpay_order_id(payload)
+
+    try:
+        with transaction.atomic():
+            event = models.WebhookEvent.objects.create(
+                event_id=event_id[:100],
+                event=payload.get('event', ''),
+                razorpay_order_id=razorpay_order_id,
+                payload=payload,
+            )
+    except IntegrityError:
+        # gateway retry of an event we already have
+        return None
+
+    transaction.on_commit(lambda: _enqueue(razorpay_order_id))
+    return event
+
+
+def _enqueue(razorpay_order_id):
+    from .tasks import process_webhook_events
+
+    try:
+        process_webhook_events.delay(razorpay_order_id)
+    except Exception as e:
+        # the event is stored, the beat sweep will process it
+        logger.warning(f'could not queue webhook processing for {razorpay_order_id}: {e}')
+
+
+def complete_payment(payment, transaction_id, method, now):
+    '''
+    Marks a locked pending payment completed and commits its order's stock
+
+    Returns the order moved to 'processing', or None when the stock is gone.
+    Nothing is saved, the caller writes the payment and the order.
+    '''
+    payment.status = "completed"
+    payment.transaction_id = transaction_id
+    payment.payment_method = METHOD_MAP.get(method, "online_banking")
+    payment.payment_date = now
+    payment.updated_at = now
+
+    order = payment.order
+    try:
+        with transaction.atomic():
+            stock.commit_order(order)
+            reservations.commit_order(order)
+    except stock.InsufficientStock as e:
+        # money is captured but the stock is gone: keep the order pending for a refund
+        logger.error(f'order {order.order_number} paid but out of stock: {e.failed}')
+        return None
+
+    order.status = "processing"
+    order.updated_at = now
+    return order
+
+
+def _payment_captured(payload):
+    payment_entity = payload["payload"]["payment"]["entity"]
+    razorpay_order_id = payment_entity['order_id']
+
+    try:
+        payment = models.Payment.objects.select_for_update().select_related("order") \
+            .get(razorpay_order_id=razorpay_order_id)
+    except models.Payment.DoesNotExist:
+        logger.warning(f'webhook for unknown razorpay order {razorpay_order_id}')
+        return
+
+    # redelivered events must not deduct stock twice
+    if payment.status == "completed":
+        return
+
+    order = complete_payment(payment, payment_entity['id'], payment_entity.get('method'), timezone.now())
+    payment.save()
+    if order is not None:
+        order.save()
+
+
+def _payment_failed(payload):
+    razorpay_order_id = payload["payload"]["payment"]["entity"]["order_id"]
+
+    # a failure delivered after the capture must not undo it
+    models.Payment.objects.filter(razorpay_order_id=razorpay_order_id) \
+        .exclude(status="completed").update(status="failed")
+
+    # give the held units back instead of waiting for the reservation to expire
+    order_ids = list(models.Order.objects.filter(payment__razorpay_order_id=razorpay_order_id)
+                     .exclude(payment__status="completed").values_list('id', flat=True))
+    reservations.release_orders(order_ids)
+
+
+HANDLERS = {
+    "payment.captured": _payment_captured,
+    "payment.failed": _payment_failed,
+}
+
+
+def handle(event):
+    handler = HANDLERS.get(event.event)
+    if handler is not None:
+        handler(event.payload)
+
+
+def process_order(razorpay_order_id, limit=None):
+    '''
+    Handles the pending events of one razorpay order oldest first, returns how many succeeded
+
+    Each event runs in its own savepoint. The first one that fails is
+    retried later and the events behind it stay pending.
+    '''
+    _, max_attempts = _config()
+    processed = 0
+
+    with transaction.atomic():
+        order_filter = {'razorpay_order_id__isnull': True} if razorpay_order_id is None \
+            else {'razorpay_order_id': razorpay_order_id}
+        events = models.WebhookEvent.objects.select_for_update() \
+            .filter(status='pending', **order_filter) \
+            .order_by('received_at', 'id')
+        if limit:
+            events = events[:limit]
+
+        for event in events:
+            event.attempts += 1
+            try:
+                with transaction.atomic():
+                    handle(event)
+            except Exception as e:
+                logger.exception(f'webhook event {event.event_id} failed (attempt {event.attempts})')
+                event.last_error = str(e)
+                if event.attempts >= max_attempts:
+                    event.status = 'failed'
+                event.save(update_fields=['attempts', 'last_error', 'status'])
+                if event.status == 'pending':
+                    break
+                continue
+
+            event.status = 'processed'
+            event.processed_at = timezone.now()
+            event.save(update_fields=['attempts', 'status', 'processed_at'])
+            processed += 1
+
+    return processed
+
+
+def process_pending(batch_size=None):
+    '''
+    Processes the orders of the oldest `batch_size` pending events, returns how many succeeded
+    '''
+    batch_size = batch_size or _config()[0]
+    razorpay_order_ids = models.WebhookEvent.objects \
+        .filter(status='pending') \
+        .order_by('received_at', 'id') \
+        .values_list('razorpay_order_id', flat=True)[:batch_size]
+
+    return sum(process_order(razorpay_order_id) for razorpay_order_id in dict.fromkeys(razorpay_order_ids))